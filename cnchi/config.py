@@ -29,8 +29,10 @@
 
 """ Configuration module for Cnchi """
 
+import copy
 import multiprocessing
 import os
+import pickle
 import strictyaml as yaml
 from strictyaml.validators import CommentedMap
 
@@ -113,6 +115,7 @@ settings = {
     'network_manager': 'NetworkManager',
     'partition_mode': 'automatic',
     'password': '',
+    'pipelined_install': True,
     'rankmirrors_done': False,
     'rankmirrors_result': '',
     'require_password': True,
@@ -145,16 +148,31 @@ settings = {
     'zfs_pool_name': 'antergos'}
 
 
+# Maximum size of the (pickled) settings shared between processes
+SETTINGS_MAX_SIZE = 1024 * 1024
+
+
 class Settings(object):
-    """ Store all Cnchi setup options here """
+    """ Store all Cnchi setup options here.
+        Settings are shared with child processes through a snapshot in
+        shared memory. Each process keeps its own copy of it and only reads
+        it again when another process has changed it (its version is
+        different), so getting a setting does not need to copy them all """
 
     def __init__(self):
         """ Initialize default configuration """
 
-        # Creates a one element size queue
-        self.settings = multiprocessing.Queue(1)
+        self.lock = multiprocessing.Lock()
+        # Snapshot (pickled settings), its size and version
+        self.buffer = multiprocessing.RawArray('c', SETTINGS_MAX_SIZE)
+        self.size = multiprocessing.RawValue('Q', 0)
+        self.version = multiprocessing.RawValue('Q', 0)
+
+        # This process copy of the settings (version 0 has none)
+        self.local_version = 0
+        self.local_settings = {}
 
-        self.settings.put({
+        self._update_settings({
             'alternate_package_list': '',
             'auto_device': '/dev/sda',
             'bootloader': 'grub2',
@@ -207,6 +225,7 @@ class Settings(object):
             'network_manager': 'NetworkManager',
             'partition_mode': 'automatic',
             'password': '',
+            'pipelined_install': True,
             'rankmirrors_done': False,
             'rankmirrors_result': '',
             'require_password': True,
@@ -238,35 +257,60 @@ class Settings(object):
             'zfs_pool_name': 'antergos',
             'zfs_pool_id': 0})
 
+    def _load_settings(self):
+        """ Reads the shared snapshot if it has changed since this process
+            read it. Must be called with self.lock held """
+        if self.local_version != self.version.value:
+            data = memoryview(self.buffer)[:self.size.value]
+            self.local_settings = pickle.loads(data)
+            self.local_version = self.version.value
+
     def _get_settings(self):
-        """ Get a copy of our settings """
-        settings = self.settings.get()
-        copy = settings.copy()
-        self.settings.put(settings)
-        return copy
+        """ Returns this process copy of our settings """
+        if self.local_version != self.version.value:
+            with self.lock:
+                self._load_settings()
+        return self.local_settings
+
+    def _store_settings(self, settings):
+        """ Shares settings with all processes. Must be called with
+            self.lock held """
+        data = pickle.dumps(settings, pickle.HIGHEST_PROTOCOL)
+        if len(data) > SETTINGS_MAX_SIZE:
+            raise ValueError("Settings are too big to be shared")
+        self.buffer[:len(data)] = data
+        self.size.value = len(data)
+        self.version.value += 1
+        self.local_settings = settings
+        self.local_version = self.version.value
 
     def _update_settings(self, new_settings):
         """ Updates global settings """
-        settings = self.settings.get()
-        try:
+        with self.lock:
+            self._load_settings()
+            settings = self.local_settings.copy()
             settings.update(new_settings)
-        finally:
-            self.settings.put(settings)
+            self._store_settings(settings)
 
     def get(self, key):
         """ Get one setting value """
-        settings = self._get_settings()
-        return settings.get(key, None)
+        value = self._get_settings().get(key, None)
+        if isinstance(value, (list, dict, set)):
+            # Do not let callers modify our copy
+            value = copy.deepcopy(value)
+        return value
 
     def set(self, key, value):
         """ Set one setting's value """
-        settings = self._get_settings()
-        current = settings.get(key, 'keyerror')
-        exists = 'keyerror' != current
+        with self.lock:
+            self._load_settings()
+            settings = self.local_settings.copy()
+            current = settings.get(key, 'keyerror')
+            exists = 'keyerror' != current
 
-        if exists and current and isinstance(current, list) and not isinstance(value, list):
-            settings[key].append(value)
-        else:
-            settings[key] = value
+            if exists and current and isinstance(current, list) and not isinstance(value, list):
+                settings[key] = current + [value]
+            else:
+                settings[key] = value
 
-        self._update_settings(settings)
+            self._store_settings(settings)
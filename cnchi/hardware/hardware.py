@@ -29,12 +29,328 @@
 
 """ Hardware related packages installation """
 
+import hashlib
 import logging
 import os
+import sqlite3
 import subprocess
+import threading
+
+import info
 
 _HARDWARE_PATH = '/usr/share/cnchi/cnchi/hardware'
 
+_PCI_DEVICES_PATH = '/sys/bus/pci/devices'
+_USB_DEVICES_PATH = '/sys/bus/usb/devices'
+
+# Devices do not change while Cnchi runs, so they are only read once
+_DEVICES_CACHE = {}
+_DEVICES_LOCK = threading.Lock()
+
+# Driver classes already imported (module name: class)
+_DRIVER_CLASSES = {}
+
+# Match tables of all drivers, compiled by build_database (see
+# utils/py/build_hardware_db.py), so drivers do not need to be imported
+# to know which ones support the devices found
+_HARDWARE_DB_PATH = '/usr/share/cnchi/data/hardware.db'
+_HARDWARE_DB_VERSION = 1
+
+# Bytes of the database file sqlite may read through mmap
+_HARDWARE_DB_MMAP_SIZE = 8 * 1024 * 1024
+
+# Opened database (False if it can't be used)
+_DRIVER_DATABASE = None
+_DRIVER_DATABASE_LOCK = threading.Lock()
+
+
+def read_sys_file(path):
+    """ Returns contents of a sysfs file (without newline) """
+    with open(path) as sys_file:
+        return sys_file.read().strip()
+
+
+def hex_id(value):
+    """ Returns an id in the form lspci -n and lsusb show it ("0x10de") """
+    if value.startswith("0x"):
+        value = value[2:]
+    return "0x" + value.lower()
+
+
+def read_pci_devices():
+    """ Gets (class id, vendor id, product id) of all pci devices """
+    devices = []
+    if not os.path.isdir(_PCI_DEVICES_PATH):
+        # No pci bus
+        return devices
+
+    for name in sorted(os.listdir(_PCI_DEVICES_PATH)):
+        path = os.path.join(_PCI_DEVICES_PATH, name)
+        try:
+            # class is 0xCCSSPP (class, subclass, programming interface)
+            class_id = hex_id(read_sys_file(os.path.join(path, "class")))[0:4]
+            vendor_id = hex_id(read_sys_file(os.path.join(path, "vendor")))
+            product_id = hex_id(read_sys_file(os.path.join(path, "device")))
+            devices.append((class_id, vendor_id, product_id))
+        except OSError as err:
+            logging.warning("Cannot read pci device %s: %s", name, err)
+    return devices
+
+
+def read_usb_devices():
+    """ Gets (class id, vendor id, product id) of all usb devices.
+        Class id is always "0" (as Cnchi does not use usb classes) """
+    devices = []
+    if not os.path.isdir(_USB_DEVICES_PATH):
+        # No usb bus
+        return devices
+
+    for name in sorted(os.listdir(_USB_DEVICES_PATH)):
+        path = os.path.join(_USB_DEVICES_PATH, name)
+        vendor_path = os.path.join(path, "idVendor")
+        # Interfaces (1-1:1.0) are listed too, but only devices have ids
+        if not os.path.exists(vendor_path):
+            continue
+        try:
+            vendor_id = hex_id(read_sys_file(vendor_path))
+            product_id = hex_id(read_sys_file(os.path.join(path, "idProduct")))
+            devices.append(("0", vendor_id, product_id))
+        except OSError as err:
+            logging.warning("Cannot read usb device %s: %s", name, err)
+    return devices
+
+
+def get_cached_devices(bus, read_devices):
+    """ Returns devices of bus, reading them the first time only """
+    with _DEVICES_LOCK:
+        devices = _DEVICES_CACHE.get(bus)
+        if devices is None:
+            devices = tuple(read_devices())
+            _DEVICES_CACHE[bus] = devices
+        return devices
+
+
+def get_pci_devices():
+    """ Returns (cached) pci devices """
+    return get_cached_devices("pci", read_pci_devices)
+
+
+def get_usb_devices():
+    """ Returns (cached) usb devices """
+    return get_cached_devices("usb", read_usb_devices)
+
+
+def get_driver_module_names(hardware_path=None):
+    """ Returns names of all driver modules in the hardware folder """
+    hardware_path = hardware_path or _HARDWARE_PATH
+    non_valid = ["__init__.py", "hardware.py"]
+    return [
+        filename[:-len(".py")] for filename in sorted(os.listdir(hardware_path))
+        if filename.endswith(".py") and filename not in non_valid]
+
+
+def get_driver_class(module_name):
+    """ Imports a driver module (only once) and returns its driver class
+        (None if it can't be imported) """
+    if module_name in _DRIVER_CLASSES:
+        return _DRIVER_CLASSES[module_name]
+
+    # This is unsafe, but we don't care if
+    # somebody wants Cnchi to run code arbitrarily.
+    driver_class = None
+    name = ""
+    package = module_name
+    try:
+        if __name__ != "__main__":
+            package = "hardware." + module_name
+        name = module_name.capitalize()
+        # This instruction is the same as "from package import name"
+        module = __import__(package, fromlist=[name])
+        class_name = getattr(module, "CLASS_NAME")
+        driver_class = getattr(module, class_name)
+    except ImportError as err:
+        logging.error("Error importing %s from %s : %s", name, package, err)
+    except Exception as ex:
+        logging.error("Unexpected error importing %s", package)
+        template = "An exception of type {0} occured. Arguments:\n{1!r}"
+        message = template.format(type(ex).__name__, ex.args)
+        logging.error(message)
+
+    _DRIVER_CLASSES[module_name] = driver_class
+    return driver_class
+
+
+def get_driver_classes(module_names=None):
+    """ Returns driver classes of module_names (all modules in the
+        hardware folder by default) """
+    if module_names is None:
+        module_names = get_driver_module_names()
+    driver_classes = []
+    for module_name in module_names:
+        driver_class = get_driver_class(module_name)
+        if driver_class is not None:
+            driver_classes.append(driver_class)
+    return driver_classes
+
+
+def get_modules_signature(hardware_path=None):
+    """ Returns Cnchi's version and the name and size of all driver
+        modules. It is a cheap first check to know if the compiled database
+        is up to date (modules are only stat'ed, none of them is read) """
+    hardware_path = hardware_path or _HARDWARE_PATH
+    modules = []
+    for module_name in get_driver_module_names(hardware_path):
+        module_path = os.path.join(hardware_path, module_name + ".py")
+        modules.append("{0}:{1}".format(module_name, os.path.getsize(module_path)))
+    return "{0} {1}".format(info.CNCHI_VERSION, ",".join(modules))
+
+
+def get_modules_hash(hardware_path=None):
+    """ Returns a hash of the sources of all driver modules. It is only
+        checked when get_modules_signature matches, as it has to read them """
+    hardware_path = hardware_path or _HARDWARE_PATH
+    modules_hash = hashlib.sha256()
+    for module_name in get_driver_module_names(hardware_path):
+        modules_hash.update(module_name.encode())
+        with open(os.path.join(hardware_path, module_name + ".py"), 'rb') as module_file:
+            modules_hash.update(module_file.read())
+    return modules_hash.hexdigest()
+
+
+def build_database(db_path, hardware_path=None):
+    """ Compiles match tables of all drivers into a sqlite database """
+    tmp_path = db_path + ".tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    connection = sqlite3.connect(tmp_path)
+    with connection:
+        connection.executescript("""
+            CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE drivers (
+                module TEXT PRIMARY KEY, class_name TEXT,
+                class_id TEXT, vendor_id TEXT, priority INTEGER,
+                proprietary INTEGER, graphic INTEGER, enabled INTEGER,
+                any_device INTEGER);
+            CREATE TABLE devices (
+                module TEXT, product_id TEXT, vendor_id TEXT,
+                PRIMARY KEY (module, product_id, vendor_id)) WITHOUT ROWID;
+            """)
+        for module_name in get_driver_module_names(hardware_path):
+            driver_class = get_driver_class(module_name)
+            if driver_class is None:
+                continue
+            driver = driver_class()
+            connection.execute(
+                "INSERT INTO drivers VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (module_name, driver.class_name, driver.class_id or "",
+                 driver.vendor_id or "", driver.priority,
+                 int(driver.is_proprietary()), int(driver.is_graphic_driver()),
+                 int(driver.enabled), int(not driver.devices)))
+            rows = []
+            for device in driver.devices:
+                if isinstance(device, tuple):
+                    # (vendor id, product id)
+                    rows.append((module_name, device[1], device[0]))
+                else:
+                    rows.append((module_name, device, ""))
+            connection.executemany("INSERT INTO devices VALUES (?, ?, ?)", rows)
+        connection.executemany(
+            "INSERT INTO meta VALUES (?, ?)",
+            [("version", str(_HARDWARE_DB_VERSION)),
+             ("signature", get_modules_signature(hardware_path)),
+             ("hash", get_modules_hash(hardware_path))])
+    connection.execute("VACUUM")
+    connection.close()
+    os.replace(tmp_path, db_path)
+
+
+class DriverDatabase(object):
+    """ Read only access to the compiled driver database """
+
+    def __init__(self, path):
+        uri = "file:{0}?mode=ro".format(path)
+        self.connection = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        self.connection.execute("PRAGMA mmap_size = {0}".format(_HARDWARE_DB_MMAP_SIZE))
+        self.lock = threading.Lock()
+
+    def get_meta(self, key):
+        """ Returns a value stored in the meta table """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def find(self, class_id, vendor_id, product_id):
+        """ Returns module names of the drivers that support a device
+            (same rules as Hardware.check_device) """
+        with self.lock:
+            rows = self.connection.execute("""
+                SELECT module FROM drivers
+                WHERE enabled
+                    AND (class_id = '' OR class_id = ?)
+                    AND (vendor_id = '' OR vendor_id = ?)
+                    AND (any_device OR EXISTS (
+                        SELECT 1 FROM devices
+                        WHERE devices.module = drivers.module
+                            AND devices.product_id = ?
+                            AND (devices.vendor_id = '' OR devices.vendor_id = ?)))
+                ORDER BY module""", (class_id, vendor_id, product_id, vendor_id)).fetchall()
+        return [row[0] for row in rows]
+
+
+def get_driver_database():
+    """ Opens (only once) the compiled driver database. Returns None if
+        it does not exist or if it does not match the driver modules """
+    global _DRIVER_DATABASE
+
+    with _DRIVER_DATABASE_LOCK:
+        if _DRIVER_DATABASE is None:
+            _DRIVER_DATABASE = False
+            if os.path.exists(_HARDWARE_DB_PATH):
+                try:
+                    database = DriverDatabase(_HARDWARE_DB_PATH)
+                    if database.get_meta("version") != str(_HARDWARE_DB_VERSION):
+                        logging.debug("Hardware database version has changed, it won't be used")
+                    elif (database.get_meta("signature") != get_modules_signature() or
+                          database.get_meta("hash") != get_modules_hash()):
+                        logging.debug("Hardware database is out of date, it won't be used")
+                    else:
+                        _DRIVER_DATABASE = database
+                except (sqlite3.Error, OSError) as err:
+                    logging.warning("Cannot open hardware database: %s", err)
+        return _DRIVER_DATABASE or None
+
+
+class DriverIndex(object):
+    """ Drivers indexed by (class id, vendor id). Drivers without class id
+        or vendor id support any class or vendor, so they are stored
+        under None """
+
+    def __init__(self, drivers):
+        self.drivers = {}
+        for driver in drivers:
+            if not driver.enabled:
+                continue
+            key = (driver.class_id or None, driver.vendor_id or None)
+            self.drivers.setdefault(key, []).append(driver)
+        # Keep the order in which drivers were loaded
+        self.order = {driver: index for index, driver in enumerate(drivers)}
+
+    def find(self, class_id, vendor_id, product_id):
+        """ Returns drivers that support a device """
+        candidates = []
+        for key in ((class_id, vendor_id), (class_id, None),
+                    (None, vendor_id), (None, None)):
+            candidates.extend(self.drivers.get(key, []))
+        found = [
+            driver for driver in candidates
+            if driver.check_device(class_id, vendor_id, product_id)]
+        found.sort(key=self.order.get)
+        return found
+
 
 class Hardware(object):
     """ This is an abstract class. You need to use this as base """
@@ -43,7 +359,8 @@ class Hardware(object):
         self.class_name = class_name
         self.class_id = class_id
         self.vendor_id = vendor_id
-        self.devices = devices
+        # Product ids are only used to check membership
+        self.devices = frozenset(devices or [])
         self.priority = priority
         self.enabled = enabled
 
@@ -78,7 +395,9 @@ class Hardware(object):
         if self.vendor_id and vendor_id != self.vendor_id:
             return False
 
-        if self.devices and product_id not in self.devices:
+        # Devices can be product ids or (vendor id, product id) tuples
+        if (self.devices and product_id not in self.devices and
+                (vendor_id, product_id) not in self.devices):
             return False
 
         return True
@@ -92,22 +411,15 @@ class Hardware(object):
 
         # Get PCI devices
         try:
-            cmd = ["lspci", "-n"]
-            lines = subprocess.check_output(cmd, stderr=subprocess.STDOUT)
-            lines = lines.decode().split("\n")
-        except subprocess.CalledProcessError as err:
-            logging.warning("Cannot detect hardware components : %s", err.output.decode())
+            devices = get_pci_devices()
+        except OSError as err:
+            logging.warning("Cannot detect hardware components : %s", err)
             return False
 
-        for line in lines:
-            if len(line) > 0:
-                class_id = "0x{0}".format(line.split()[1].rstrip(":")[0:2])
-                if class_id == self.class_id:
-                    dev = line.split()[2].split(":")
-                    vendor_id = "0x{0}".format(dev[0])
-                    product_id = "0x{0}".format(dev[1])
-                    if vendor_id == self.vendor_id and product_id in self.devices:
-                        return True
+        for (class_id, vendor_id, product_id) in devices:
+            if (class_id == self.class_id and vendor_id == self.vendor_id and
+                    product_id in self.devices):
+                return True
         return False
 
     @staticmethod
@@ -192,7 +504,8 @@ class HardwareInstall(object):
     def __init__(self, use_proprietary_graphic_drivers=False):
         self.use_proprietary_graphic_drivers = use_proprietary_graphic_drivers
 
-        # All available objects
+        # All available objects (only the ones needed by the devices
+        # found if the compiled driver database is used)
         self.all_objects = []
 
         # All objects that support devices found
@@ -202,67 +515,86 @@ class HardwareInstall(object):
         # All objects that are really used
         self.objects_used = []
 
-        dirs = os.listdir(_HARDWARE_PATH)
-
-        # We scan the folder for py files.
-        # This is unsafe, but we don't care if
-        # somebody wants Cnchi to run code arbitrarily.
-        for filename in dirs:
-            non_valid = ["__init__.py", "hardware.py"]
-            if filename.endswith(".py") and filename not in non_valid:
-                filename = filename[:-len(".py")]
-                name = ""
-                try:
-                    if __name__ == "__main__":
-                        package = filename
-                    else:
-                        package = "hardware." + filename
-                    name = filename.capitalize()
-                    # This instruction is the same as "from package import name"
-                    class_name = getattr(__import__(package, fromlist=[name]), "CLASS_NAME")
-                    obj = getattr(__import__(package, fromlist=[class_name]), class_name)()
-                    self.all_objects.append(obj)
-                except ImportError as err:
-                    logging.error("Error importing %s from %s : %s", name, package, err)
-                except Exception as ex:
-                    logging.error("Unexpected error importing %s", package)
-                    template = "An exception of type {0} occured. Arguments:\n{1!r}"
-                    message = template.format(type(ex).__name__, ex.args)
-                    logging.error(message)
-
         try:
             # Detect devices
             devices = self.get_devices()
-        except subprocess.CalledProcessError as err:
-            txt = "Unable to scan devices, command {0} failed: {1}"
-            txt = txt.format(err.cmd, err.output.decode())
-            logging.error(txt)
+        except OSError as err:
+            logging.error("Unable to scan devices: %s", err)
             return
 
+        # Find objects that support the devices we've found.
+        database = get_driver_database()
+        if database is not None:
+            self.find_drivers_in_database(database, devices)
+        else:
+            self.find_drivers(devices)
+
+        self.select_drivers()
+
+    @staticmethod
+    def create_driver(driver_class):
+        """ Creates a driver object (None if it fails) """
+        try:
+            return driver_class()
+        except Exception as ex:
+            logging.error("Unexpected error creating %s", driver_class.__name__)
+            template = "An exception of type {0} occured. Arguments:\n{1!r}"
+            message = template.format(type(ex).__name__, ex.args)
+            logging.error(message)
+        return None
+
+    def add_found(self, device, drivers):
+        """ Stores drivers that support device """
+        (class_id, vendor_id, product_id) = device
+        for obj in drivers:
+            logging.debug(
+                "Driver %s is needed by (%s, %s, %s)",
+                obj.class_name, class_id, vendor_id, product_id)
+        if drivers:
+            self.objects_found[device] = drivers
+
+    def find_drivers(self, devices):
+        """ Loads all driver modules and tests them against devices """
+        for driver_class in get_driver_classes():
+            obj = self.create_driver(driver_class)
+            if obj is not None:
+                self.all_objects.append(obj)
+
         logging.debug(
             "Cnchi will test %d drivers for %d hardware devices",
             len(self.all_objects),
             len(devices))
 
-        # Find objects that support the devices we've found.
-        self.objects_found = {}
-        for obj in self.all_objects:
-            for device in devices:
-                (class_id, vendor_id, product_id) = device
-                check = obj.check_device(
-                    class_id=class_id,
-                    vendor_id=vendor_id,
-                    product_id=product_id)
-                if check:
-                    logging.debug(
-                        "Driver %s is needed by (%s, %s, %s)",
-                        obj.class_name, class_id, vendor_id, product_id)
-                    # print("Driver", obj.class_name, "is needed by", class_id, vendor_id, product_id)
-                    if device not in self.objects_found:
-                        self.objects_found[device] = [obj]
+        driver_index = DriverIndex(self.all_objects)
+        for device in devices:
+            self.add_found(device, driver_index.find(*device))
+
+    def find_drivers_in_database(self, database, devices):
+        """ Finds drivers that support devices using the compiled
+            database. Only the driver modules needed are loaded """
+        objects = {}
+        for device in devices:
+            drivers = []
+            for module_name in database.find(*device):
+                if module_name not in objects:
+                    driver_class = get_driver_class(module_name)
+                    if driver_class is not None:
+                        objects[module_name] = self.create_driver(driver_class)
                     else:
-                        self.objects_found[device].append(obj)
+                        objects[module_name] = None
+                if objects[module_name] is not None:
+                    drivers.append(objects[module_name])
+            self.add_found(device, drivers)
 
+        self.all_objects = [obj for obj in objects.values() if obj is not None]
+        logging.debug(
+            "Hardware database: %d drivers needed by %d hardware devices",
+            len(self.all_objects),
+            len(devices))
+
+    def select_drivers(self):
+        """ Chooses which drivers will be used (objects_used) when there
+            is more than one for a device """
         self.objects_used = []
         for device in self.objects_found:
             drivers_available = self.objects_found[device]
@@ -315,30 +647,7 @@ class HardwareInstall(object):
     @staticmethod
     def get_devices():
         """ Gets a list of all pci/usb devices """
-        devices = []
-
-        # Get PCI devices
-        cmd = ["/usr/bin/lspci", "-n"]
-        lines = subprocess.check_output(cmd, stderr=subprocess.STDOUT)
-        lines = lines.decode().split("\n")
-
-        for line in lines:
-            if len(line) > 0:
-                class_id = line.split()[1].rstrip(":")[0:2]
-                dev = line.split()[2].split(":")
-                devices.append(("0x" + class_id, "0x" + dev[0], "0x" + dev[1]))
-
-        # Get USB devices
-        cmd = ["/usr/bin/lsusb"]
-        lines = subprocess.check_output(cmd, stderr=subprocess.STDOUT)
-        lines = lines.decode().split("\n")
-
-        for line in lines:
-            if len(line) > 0:
-                dev = line.split()[5].split(":")
-                devices.append(("0", "0x" + dev[0], "0x" + dev[1]))
-
-        return devices
+        return list(get_pci_devices()) + list(get_usb_devices())
 
     def get_packages(self):
         """ Get pacman package list for all detected devices """
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# deferred_tasks.py
+#
+# Copyright © 2013-2016 Antergos
+#
+# This file is part of Cnchi.
+#
+# Cnchi is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cnchi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# The following additional terms are in effect as per Section 7 of the license:
+#
+# The preservation of all legal notices and author attributions in
+# the material or in the Appropriate Legal Notices displayed
+# by works containing it is required.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cnchi; If not, see <http://www.gnu.org/licenses/>.
+
+
+""" Tasks that are not needed to boot the new system (man pages index,
+    pkgfile database...) are run in its first boot instead of making
+    the user wait for them while installing """
+
+import logging
+import os
+
+from misc.run_cmd import chroot_call
+
+DEST_DIR = "/install"
+
+SYSTEMD_UNITS_DIR = "usr/lib/systemd/system"
+SERVICE_NAME = "cnchi-deferred-{0}.service"
+
+# Tasks run after the first boot of the installed system. When the package
+# ships a timer that already does the same job, that timer is enabled instead
+DEFERRED_TASKS = [
+    # Create an initial database for mandb
+    {'name': 'mandb',
+     'cmd': ["/usr/bin/mandb", "--quiet"],
+     'timer': "man-db.timer",
+     'network': False},
+    # Initialise pkgfile (pacman .files metadata explorer) database
+    {'name': 'pkgfile',
+     'cmd': ["/usr/bin/pkgfile", "--update"],
+     'timer': "pkgfile-update.timer",
+     'network': True}]
+
+
+def get_service(task):
+    """ Returns the contents of the unit that runs a task.
+        Type=exec does not hold multi-user.target until the task finishes.
+        The unit disables itself only if the task succeeds, so it is
+        retried in the next boot otherwise (no network, for instance) """
+    service_name = SERVICE_NAME.format(task['name'])
+    lines = [
+        "# Written by Cnchi. Runs a task deferred while installing",
+        "[Unit]",
+        "Description=Cnchi deferred installation task ({0})".format(task['name'])]
+    if task.get('network'):
+        lines.extend([
+            "Wants=network-online.target",
+            "After=network-online.target"])
+    lines.extend([
+        "",
+        "[Service]",
+        "Type=exec",
+        "ExecStart={0}".format(" ".join(task['cmd'])),
+        "ExecStopPost=/bin/sh -c '[ \"$$SERVICE_RESULT\" = success ] && "
+        "/usr/bin/systemctl disable {0}'".format(service_name),
+        # Do not slow down the user's first session
+        "Nice=19",
+        "IOSchedulingClass=idle",
+        "",
+        "[Install]",
+        "WantedBy=multi-user.target",
+        ""])
+    return "\n".join(lines)
+
+
+def setup(tasks=None, dest_dir=DEST_DIR):
+    """ Enables the timer or installs and enables a service for each task.
+        Tasks whose program is not installed are skipped """
+    if tasks is None:
+        tasks = DEFERRED_TASKS
+
+    for task in tasks:
+        if not os.path.exists(os.path.join(dest_dir, task['cmd'][0][1:])):
+            continue
+
+        timer = task.get('timer')
+        if timer and os.path.exists(os.path.join(dest_dir, SYSTEMD_UNITS_DIR, timer)):
+            chroot_call(['systemctl', 'enable', timer], dest_dir)
+            logging.debug("Timer %s enabled (%s)", timer, task['name'])
+            continue
+
+        service_name = SERVICE_NAME.format(task['name'])
+        service_path = os.path.join(dest_dir, "etc/systemd/system", service_name)
+        os.makedirs(os.path.dirname(service_path), mode=0o755, exist_ok=True)
+        with open(service_path, 'w') as service_file:
+            service_file.write(get_service(task))
+
+        chroot_call(['systemctl', 'enable', service_name], dest_dir)
+        logging.debug("%s will be run in first boot", task['name'])
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# cache_import.py
+#
+# Copyright © 2013-2016 Antergos
+#
+# This file is part of Cnchi.
+#
+# Cnchi is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cnchi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# The following additional terms are in effect as per Section 7 of the license:
+#
+# The preservation of all legal notices and author attributions in
+# the material or in the Appropriate Legal Notices displayed
+# by works containing it is required.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cnchi; If not, see <http://www.gnu.org/licenses/>.
+
+
+""" Puts packages from a user's cache directory into pacman's cache
+    without copying their data whenever it is possible """
+
+import errno
+import fcntl
+import logging
+import os
+import shutil
+
+# ioctl to share data blocks between two files (btrfs, xfs)
+FICLONE = 0x40049409
+
+# Link methods (from cheapest to most expensive)
+HARDLINK = "hardlink"
+REFLINK = "reflink"
+KERNEL_COPY = "kernel copy"
+COPY = "copy"
+
+# Errors meaning "this method is not supported here, try the next one"
+UNSUPPORTED_ERRORS = (
+    errno.EXDEV, errno.EPERM, errno.EACCES, errno.EINVAL, errno.ENOSYS,
+    errno.EOPNOTSUPP, errno.ENOTTY, errno.EBADF, errno.EMLINK, errno.EROFS)
+
+
+def hardlink(src, dst):
+    """ Makes dst another name of src (same filesystem only) """
+    os.link(src, dst)
+
+
+def reflink(src, dst):
+    """ Makes dst share src data blocks (copy on write filesystems only) """
+    with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+        fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+
+
+def kernel_copy(src, dst):
+    """ Copies src to dst without moving data through user space """
+    with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+        src_fd = src_file.fileno()
+        dst_fd = dst_file.fileno()
+        remaining = os.fstat(src_fd).st_size
+        copy_file_range = getattr(os, 'copy_file_range', None)
+        while remaining > 0:
+            if copy_file_range:
+                try:
+                    copied = copy_file_range(src_fd, dst_fd, remaining)
+                except OSError as err:
+                    if err.errno not in UNSUPPORTED_ERRORS:
+                        raise
+                    # Not supported between these filesystems, use sendfile
+                    copy_file_range = None
+                    continue
+            else:
+                copied = os.sendfile(dst_fd, src_fd, None, remaining)
+            if copied == 0:
+                break
+            remaining -= copied
+    if remaining > 0:
+        raise OSError(errno.EIO, "Short copy", src)
+
+
+def copy(src, dst):
+    """ Regular copy """
+    shutil.copyfile(src, dst)
+
+
+IMPORT_METHODS = (
+    (HARDLINK, hardlink),
+    (REFLINK, reflink),
+    (KERNEL_COPY, kernel_copy),
+    (COPY, copy))
+
+
+def import_file(src, dst, zero_copy_only=False):
+    """ Puts src in dst trying (in this order) a hard link, a reflink,
+        an in-kernel copy and a regular copy.
+        If zero_copy_only is True, only hard links and reflinks are tried.
+        Returns the method used or None if none worked """
+    tmp_dst = dst + ".import"
+    for name, method in IMPORT_METHODS:
+        if zero_copy_only and name not in (HARDLINK, REFLINK):
+            break
+        try:
+            if os.path.lexists(tmp_dst):
+                os.remove(tmp_dst)
+            method(src, tmp_dst)
+            if name != HARDLINK:
+                shutil.copymode(src, tmp_dst)
+            os.replace(tmp_dst, dst)
+            return name
+        except OSError as err:
+            if err.errno not in UNSUPPORTED_ERRORS:
+                logging.debug("Can't %s %s to %s : %s", name, src, dst, err)
+    if os.path.lexists(tmp_dst):
+        os.remove(tmp_dst)
+    return None
@@ -35,8 +35,9 @@ import queue
 import download.download_requests as download_requests
 
 import installation.download.metalink as ml
+import installation.download.mirror_health as mh
 import misc.extra as misc
-from installation import pacman as pac
+from installation.pacman import handle_pool
 
 
 class DownloadPackages(object):
@@ -78,8 +79,15 @@ class DownloadPackages(object):
         # List of packages' metalinks
         self.metalinks = None
 
-    def start(self, metalinks=None):
-        """ Begin download """
+        # Mirror statistics (shared by all downloads)
+        self.mirror_health = mh.MirrorHealth()
+
+        # Position of each mirror in rankmirrors_result (see get_mirror_ranks)
+        self.mirror_ranks = None
+
+    def start(self, metalinks=None, order=None, downloaded_cb=None):
+        """ Begin download. See download_requests.Download
+            for order and downloaded_cb """
         if metalinks:
             self.metalinks = metalinks
 
@@ -92,26 +100,64 @@ class DownloadPackages(object):
             txt = _("Can't create download package list.")
             raise misc.InstallError(txt)
 
+        if self.settings:
+            # Mirrorlist may have changed since metalinks were created
+            # (rankmirrors may have finished), so read it again
+            self.mirror_ranks = None
+            self.sort_metalinks_urls()
+
         download = download_requests.Download(
             self.pacman_cache_dir,
             self.xz_cache_dirs,
-            self.callback_queue)
+            self.callback_queue,
+            mirror_health=self.mirror_health,
+            use_caches_in_place=True,
+            downloaded_cb=downloaded_cb)
 
-        if not download.start(self.metalinks):
+        if not download.start(self.metalinks, order=order):
             # When we can't download (even one package), we stop right here
             txt = _("Can't download needed packages. Cnchi can't continue.")
             raise misc.InstallError(txt)
 
+    def get_mirror_ranks(self):
+        """ Returns a dict with the position of each mirror (scheme and host)
+            in the mirrorlist we created earlier """
+        if self.mirror_ranks is None:
+            self.mirror_ranks = {}
+            ranked = self.settings.get('rankmirrors_result') if self.settings else None
+            for position, ranked_url in enumerate(ranked or []):
+                self.mirror_ranks.setdefault(mh.get_mirror(ranked_url), position)
+        return self.mirror_ranks
+
     def url_sort_helper(self, url):
         """ helper method for sorting mirror urls """
         if not url:
             return 9999
         # Use the mirrorlist we created earlier to determine a url's priority
-        ranked = self.settings.get('rankmirrors_result')
-        # Use the first part of the URL to find its position in the ranked mirror list
-        partial = '/'.join(url.split('/')[:3])
-        position = [i for i, s in enumerate(ranked) if partial in s] or [9999]
-        return position[0]
+        return self.get_mirror_ranks().get(mh.get_mirror(url), 9999)
+
+    def sort_metalinks_urls(self):
+        """ Sorts the urls of all metalinks at once. Mirrors are ordered by
+            their measured speed (if any) and then by their position in
+            the mirrorlist we created earlier """
+        health_key = self.mirror_health.get_sort_key()
+        ranks = self.get_mirror_ranks()
+        # Sort key of each mirror (all packages share the same mirrors)
+        mirror_keys = {}
+
+        def sort_key(url):
+            """ Sort key of url """
+            if not url:
+                return (2, 0, 9999)
+            mirror = mh.get_mirror(url)
+            key = mirror_keys.get(mirror)
+            if key is None:
+                key = health_key(url) + (ranks.get(mirror, 9999),)
+                mirror_keys[mirror] = key
+            return key
+
+        for element in self.metalinks.values():
+            element.urls.sort(key=sort_key)
 
     @misc.raise_privileges
     def create_metalinks_list(self):
@@ -119,13 +165,11 @@ class DownloadPackages(object):
 
         self.queue_event('percent', '0')
         self.queue_event('info', _('Creating the list of packages to download...'))
-        processed_packages = 0
-        total_packages = len(self.package_names)
 
         self.metalinks = {}
 
         try:
-            pacman = pac.Pac(
+            pacman = handle_pool.get_pac(
                 conf_path=self.pacman_conf_file,
                 callback_queue=self.callback_queue)
             if pacman is None:
@@ -138,39 +182,24 @@ class DownloadPackages(object):
             return
 
         try:
-            for package_name in self.package_names:
-                metalink = ml.create(pacman, package_name, self.pacman_conf_file)
-                if metalink is None:
-                    txt = "Error creating metalink for package %s. Installation will stop"
-                    logging.error(txt, package_name)
-                    txt = _("Error creating metalink for package {0}. "
-                            "Installation will stop").format(package_name)
-                    raise misc.InstallError(txt)
-
-                # Get metalink info
-                metalink_info = ml.get_info(metalink)
-
-                # Update downloads list with the new info from
-                # the processed metalink
-                for key in metalink_info:
-                    if key not in self.metalinks:
-                        self.metalinks[key] = metalink_info[key]
-                        urls = metalink_info[key]['urls']
-                        if self.settings:
-                            # Sort urls based on the mirrorlist
-                            # we created earlier
-                            sorted_urls = sorted(
-                                urls,
-                                key=self.url_sort_helper)
-                            self.metalinks[key]['urls'] = sorted_urls
-                        else:
-                            # When testing, settings is not available
-                            self.metalinks[key]['urls'] = urls
-
-                # Show progress to the user
-                processed_packages += 1
-                percent = round(float(processed_packages / total_packages), 2)
-                self.queue_event('percent', str(percent))
+            # Resolve all packages (and their dependencies) at once
+            self.metalinks = ml.create_download_dict(
+                pacman,
+                self.package_names,
+                self.pacman_conf_file)
+            if self.metalinks is None:
+                txt = "Error creating the list of packages to download. Installation will stop"
+                logging.error(txt)
+                txt = _("Error creating the list of packages to download. "
+                        "Installation will stop")
+                raise misc.InstallError(txt)
+
+            if self.settings:
+                # Sort urls based on the mirrorlist we created earlier
+                # (when testing, settings is not available)
+                self.sort_metalinks_urls()
+
+            self.queue_event('percent', '1')
         except Exception as ex:
             template = "Can't create download set. An exception of type {0} occured. Arguments:\n{1!r}"
             message = template.format(type(ex).__name__, ex.args)
@@ -178,16 +207,6 @@ class DownloadPackages(object):
             self.metalinks = None
             return
 
-        try:
-            pacman.release()
-            del pacman
-        except Exception as ex:
-            self.metalinks = None
-            template = "Can't release pyalpm. An exception of type {0} occured. Arguments:\n{1!r}"
-            message = template.format(type(ex).__name__, ex.args)
-            logging.error(message)
-            return
-
         # Overwrite last event (to clean up the last message)
         self.queue_event('info', "")
 
@@ -32,22 +32,81 @@
 import os
 import logging
 import queue
-import shutil
 import requests
 import time
-import hashlib
 import socket
-import io
 import threading
+import urllib.parse
+
+import installation.download.cache_import as cache_import
+import installation.download.hash_cache as hash_cache
+import installation.download.mirror_health as mh
+
+# Number of packages that are downloaded at the same time
+MAX_WORKERS = 8
+
+# Maximum number of simultaneous connections to the same mirror
+MAX_HOST_CONNECTIONS = 3
+
+# Seconds to wait for a connection of the best mirror when all mirrors of
+# a package are busy, before looking for a free one again
+HOST_WAIT_TIME = 0.5
+
+# Maximum bytes (sum of package sizes) being downloaded at the same time
+MAX_INFLIGHT_BYTES = 256 * 1024 * 1024
+
+# Size of the blocks read from the network
+DOWNLOAD_BUFFER_SIZE = 256 * 1024
+
+# Minimum time (in seconds) between two progress updates
+PROGRESS_INTERVAL = 0.25
+
+# Packages bigger than this are downloaded from several mirrors at once
+SEGMENTED_MIN_SIZE = 32 * 1024 * 1024
+
+# Size of each piece of a package downloaded from several mirrors
+SEGMENT_SIZE = 4 * 1024 * 1024
+
+# Maximum number of mirrors used to download the same package
+MAX_SEGMENT_MIRRORS = 4
 
 
 def get_md5(file_name):
-    """ Gets md5 hash from a file """
-    md5_hash = hashlib.md5()
-    with open(file_name, "rb") as myfile:
-        for line in myfile:
-            md5_hash.update(line)
-    return md5_hash.hexdigest()
+    """ Gets md5 hash from a file (only reads it if its hash
+        is not already in the hash cache) """
+    return hash_cache.get_digest(file_name, 'md5')
+
+
+def get_element_size(element):
+    """ Returns package size (in bytes) stored in a metalink element """
+    try:
+        return int(element.size)
+    except (TypeError, ValueError):
+        return 0
+
+
+def get_file_size(path):
+    """ Returns path size (0 if it does not exist) """
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def get_written_prefix(ranges):
+    """ Returns how many bytes from the beginning of a file have been
+        written, given the (start, end) byte ranges written to it """
+    prefix = 0
+    for start, end in sorted(ranges):
+        if start > prefix:
+            break
+        prefix = max(prefix, end + 1)
+    return prefix
+
+
+def get_url_host(url):
+    """ Returns the host part of an url (used to limit connections) """
+    return urllib.parse.urlsplit(url).netloc
 
 
 class CopyToCache(threading.Thread):
@@ -63,41 +122,304 @@ class CopyToCache(threading.Thread):
         for xz_cache_dir in self.xz_cache_dirs:
             dst = os.path.join(xz_cache_dir, basename)
             # Try to copy the file, do not worry if it's not possible
+            cache_import.import_file(self.origin, dst)
+
+
+class HostLimiter(object):
+    """ Limits the number of simultaneous connections to each mirror """
+
+    def __init__(self, max_connections):
+        self.max_connections = max_connections
+        self.semaphores = {}
+        self.lock = threading.Lock()
+
+    def get_semaphore(self, url):
+        """ Returns (creating it if necessary) the semaphore of url's host """
+        host = get_url_host(url)
+        with self.lock:
+            if host not in self.semaphores:
+                self.semaphores[host] = threading.BoundedSemaphore(
+                    self.max_connections)
+            return self.semaphores[host]
+
+    def acquire_any(self, urls):
+        """ Takes a connection of the first url (urls are sorted, best
+            first) whose host is not busy and returns that url. It only
+            waits when the hosts of all urls are busy """
+        while True:
+            for url in urls:
+                if self.get_semaphore(url).acquire(blocking=False):
+                    return url
+            if self.get_semaphore(urls[0]).acquire(timeout=HOST_WAIT_TIME):
+                return urls[0]
+
+    def release(self, url):
+        """ Gives back the connection taken by acquire_any """
+        self.get_semaphore(url).release()
+
+
+class ByteBudget(object):
+    """ Bounds the amount of bytes being downloaded at the same time.
+        A package bigger than the whole budget takes all of it, so it will
+        be downloaded alone instead of blocking forever. """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.inflight = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, size):
+        """ Waits until there is room for size bytes and reserves them.
+            Returns the amount of bytes actually reserved """
+        size = min(size, self.max_bytes)
+        with self.condition:
+            while self.inflight > 0 and self.inflight + size > self.max_bytes:
+                self.condition.wait()
+            self.inflight += size
+        return size
+
+    def release(self, size):
+        """ Frees size bytes previously reserved with acquire """
+        with self.condition:
+            self.inflight -= size
+            self.condition.notify_all()
+
+
+class DownloadProgress(object):
+    """ Aggregates progress of all download workers and sends it
+        (at most once every PROGRESS_INTERVAL seconds) to Cnchi """
+
+    def __init__(self, download, total_downloads, total_bytes):
+        self.download = download
+        self.total_downloads = total_downloads
+        self.total_bytes = total_bytes
+        self.downloaded = 0
+        self.completed_bytes = 0
+        # Bytes counted for each package that is not finished yet
+        self.element_bytes = {}
+        self.current = ""
+        self.start_time = time.perf_counter()
+        self.last_update = 0
+        self.lock = threading.Lock()
+
+    def package_started(self, element):
+        """ A worker has begun processing a package """
+        with self.lock:
+            self.current = "{0} {1}".format(
+                element.identity, element.version)
+        self.update()
+
+    def add_bytes(self, element, length):
+        """ A worker has received length bytes of element """
+        with self.lock:
+            counted = self.element_bytes.get(element.identity, 0)
+            self.element_bytes[element.identity] = counted + length
+            self.completed_bytes += length
+        self.update()
+
+    def discard_bytes(self, element, kept=0):
+        """ A download attempt of element has failed. Only the kept bytes
+            (the ones that will be resumed) still count """
+        with self.lock:
+            counted = self.element_bytes.get(element.identity, 0)
+            if counted > kept:
+                self.completed_bytes -= counted - kept
+                self.element_bytes[element.identity] = kept
+        self.update()
+
+    def package_done(self, element):
+        """ A package is in the pacman cache. If it has been found in a cache
+            (or resumed from a previous download) count its missing bytes """
+        with self.lock:
+            self.downloaded += 1
+            counted = self.element_bytes.pop(element.identity, 0)
+            self.completed_bytes += get_element_size(element) - counted
+        self.update(force=True)
+
+    def update(self, force=False):
+        """ Sends progress events to Cnchi's queue """
+        now = time.perf_counter()
+        with self.lock:
+            if not force and now - self.last_update < PROGRESS_INTERVAL:
+                return
+            self.last_update = now
+            downloaded = self.downloaded
+            completed_bytes = self.completed_bytes
+            current = self.current
+
+        txt = _("Fetching {0} ({1}/{2})...").format(
+            current,
+            min(downloaded + 1, self.total_downloads),
+            self.total_downloads)
+        self.download.queue_event('info', txt)
+
+        if self.total_bytes > 0:
+            percent = round(float(completed_bytes / self.total_bytes), 2)
+            self.download.queue_event('percent', min(percent, 1.0))
+        else:
+            percent = 0
+
+        bps = completed_bytes // max(now - self.start_time, 0.001)
+        msg = self.download.format_progress_message(percent, bps)
+        self.download.queue_event('progress_bar_show_text', msg)
+
+        downloads_percent = round(float(downloaded / self.total_downloads), 2)
+        self.download.queue_event('downloads_percent', str(downloads_percent))
+
+
+class DownloadWorker(threading.Thread):
+    """ Thread that takes packages from the pending queue and puts them
+        into the pacman cache (from a cache dir or downloading them) """
+
+    def __init__(self, download, pending):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.download = download
+        self.pending = pending
+
+    def run(self):
+        while not self.download.stop_event.is_set():
             try:
-                shutil.copy(self.origin, dst)
-            except (FileNotFoundError, FileExistsError, OSError):
-                pass
+                element = self.pending.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                if not self.download.process_element(element):
+                    # None of the mirror urls works.
+                    # Stop right here, so the user does not have to wait
+                    # to download the other packages.
+                    logging.error(
+                        "Can't download %s, even after trying all available mirrors",
+                        element.filename)
+                    self.download.stop_event.set()
+            except Exception as ex:
+                template = "Error downloading {0}. An exception of type {1} occured. Arguments:\n{2!r}"
+                message = template.format(element.filename, type(ex).__name__, ex.args)
+                logging.error(message)
+                self.download.stop_event.set()
+            finally:
+                self.pending.task_done()
+
+
+class SegmentWorker(threading.Thread):
+    """ Thread that downloads pieces (byte ranges) of a package from a mirror
+        and writes them in their place inside the .part file.
+        If its mirror fails, it switches to another one """
+
+    def __init__(self, download, element, segments, urls, url_index, part_fd, written):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.download = download
+        self.element = element
+        self.segments = segments
+        self.urls = urls
+        self.url_index = url_index
+        self.part_fd = part_fd
+        # (start, end) of the byte ranges already written (shared by all workers)
+        self.written = written
+        self.received = 0
+        self.failed = False
+
+    def run(self):
+        failures = 0
+        while not self.download.stop_event.is_set():
+            try:
+                start, end = self.segments.get_nowait()
+            except queue.Empty:
+                break
+            url = self.urls[self.url_index]
+            written = self.download.download_segment(
+                self.element, url, self.part_fd, start, end)
+            self.received += written
+            if written > 0:
+                self.written.append((start, start + written - 1))
+            if start + written <= end:
+                # Give the missing bytes back and try with the next mirror
+                self.segments.put((start + written, end))
+                failures += 1
+                if failures >= len(self.urls):
+                    self.failed = True
+                    break
+                self.url_index = (self.url_index + 1) % len(self.urls)
 
 
 class Download(object):
     """ Class to download packages using requests
         This class tries to previously download all necessary packages for
-        Antergos installation using requests """
-
-    def __init__(self, pacman_cache_dir, xz_cache_dirs, callback_queue):
-        """ Initialize Download class. Gets default configuration """
+        Antergos installation using requests.
+        Several packages are downloaded at the same time (see MAX_WORKERS) """
+
+    def __init__(
+            self,
+            pacman_cache_dir,
+            xz_cache_dirs,
+            callback_queue,
+            max_workers=MAX_WORKERS,
+            max_host_connections=MAX_HOST_CONNECTIONS,
+            max_inflight_bytes=MAX_INFLIGHT_BYTES,
+            mirror_health=None,
+            use_caches_in_place=False,
+            downloaded_cb=None):
+        """ Initialize Download class. Gets default configuration.
+            If use_caches_in_place is True, packages found in xz_cache_dirs
+            are only linked (or cloned) into pacman_cache_dir. When that is
+            not possible they are left where they are, so xz_cache_dirs must
+            also be pacman cache dirs when installing.
+            downloaded_cb(element) is called (from the worker threads) each
+            time a package is ready in the cache """
         self.pacman_cache_dir = pacman_cache_dir
         self.xz_cache_dirs = xz_cache_dirs
         self.callback_queue = callback_queue
+        self.use_caches_in_place = use_caches_in_place
+        self.downloaded_cb = downloaded_cb
+
+        self.max_workers = max(1, max_workers)
+        self.host_limiter = HostLimiter(max_host_connections)
+        self.byte_budget = ByteBudget(max_inflight_bytes)
+
+        # Mirror statistics shared by all workers
+        if mirror_health is None:
+            mirror_health = mh.MirrorHealth()
+        self.mirror_health = mirror_health
+
+        # Set when a package can't be downloaded (stops all workers)
+        self.stop_event = threading.Event()
+
+        # Each worker thread uses its own requests session (keep-alive)
+        self.local = threading.local()
+
+        self.progress = None
 
         # Check that pacman cache directory exists
         os.makedirs(self.pacman_cache_dir, mode=0o755, exist_ok=True)
 
         # Stores last issued event (to prevent repeating events)
         self.last_event = {}
+        self.last_event_lock = threading.Lock()
 
         self.copy_to_cache_threads = []
 
+    def get_session(self):
+        """ Returns this thread's requests session """
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_maxsize=self.host_limiter.max_connections)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self.local.session = session
+        return session
 
     def is_hash_ok(self, path, element=None, md5hash=None):
         """ Checks file md5 hash """
         # Note: path must exist!
 
         if element:
-            # element['hash'] is not always available
-            md5hash = element.get('hash', False)
-            identity = element['identity']
-            filename = element['filename']
+            # element.hash is not always available
+            md5hash = element.hash
+            identity = element.identity
+            filename = element.filename
         elif md5hash:
             identity = path
             filename = path
@@ -115,101 +437,133 @@ class Download(object):
         # If we reach this point, md5 hash is ok
         return True
 
-    def start(self, downloads):
-        """ Downloads using requests """
-        downloaded = 0
+    def start(self, downloads, order=None):
+        """ Downloads using requests.
+            downloads is a dict of metalink.MetalinkFile records.
+            order (optional) is a dict with the priority of each package
+            (lower values are downloaded first) """
         total_downloads = len(downloads)
 
         self.queue_event('downloads_progress_bar', 'show')
         self.queue_event('downloads_percent', '0')
+        self.queue_event('percent', '0')
 
         self.copy_to_cache_threads = []
+        self.stop_event.clear()
 
         logging.debug(
-            "Downloading packages to pacman cache dir '%s'",
-            self.pacman_cache_dir)
-
-        while len(downloads) > 0:
-            needs_to_download = True
+            "Downloading packages to pacman cache dir '%s' (%d workers)",
+            self.pacman_cache_dir,
+            self.max_workers)
+
+        # Start with the biggest packages, so they do not end up
+        # being downloaded alone at the end
+        elements = sorted(
+            downloads.values(),
+            key=get_element_size,
+            reverse=True)
+        if order:
+            # Stable sort, keeps bigger packages first inside each priority
+            elements.sort(key=lambda element: order.get(element.identity, len(order)))
+
+        total_bytes = sum(get_element_size(element) for element in elements)
+        self.progress = DownloadProgress(self, total_downloads, total_bytes)
+
+        pending = queue.Queue()
+        for element in elements:
+            pending.put(element)
+
+        workers = []
+        for _index in range(min(self.max_workers, total_downloads)):
+            worker = DownloadWorker(self, pending)
+            workers.append(worker)
+            worker.start()
+
+        for worker in workers:
+            worker.join()
+
+        if self.stop_event.is_set():
+            return False
 
-            # Get package to download from downloads list
-            identity, element = downloads.popitem()
+        self.queue_event('progress_bar_show_text', '')
 
-            self.queue_event('percent', '0')
+        # Wait until all xz packages are also copied to provided cache (if any)
+        for cache_thread in self.copy_to_cache_threads:
+            cache_thread.join()
 
-            txt = _("Fetching {0} {1} ({2}/{3})...").format(
-                element['identity'],
-                element['version'],
-                downloaded + 1,
-                total_downloads)
-            self.queue_event('info', txt)
+        # Remember verified hashes for the next time
+        hash_cache.save()
 
-            dst_path = os.path.join(self.pacman_cache_dir, element['filename'])
+        self.queue_event('downloads_progress_bar', 'hide')
+        return True
 
-            if os.path.exists(dst_path):
-                # File already exists in destination pacman's cache
-                # (previous install?). We check the file md5 hash.
-                if not self.is_hash_ok(path=dst_path, element=element):
-                    # We're sure it's a wrong hash. Force to download it
-                    needs_to_download = True
-                else:
-                    needs_to_download = False
-                    logging.debug(
-                        "File %s found in %s cache, there is no need to download it",
-                        element['filename'],
-                        self.pacman_cache_dir)
-            else:
-                needs_to_download = True
-                # Check all cache directories
-                for xz_cache_dir in self.xz_cache_dirs:
-                    dst_xz_cache_path = os.path.join(
-                        xz_cache_dir,
-                        element['filename'])
-
-                    if (os.path.exists(dst_xz_cache_path) and
-                            self.is_hash_ok(path=dst_xz_cache_path, element=element)):
-                        # We're lucky, the package is already downloaded
-                        # in the cache the user has given us
-                        # and its md5 checks out (if there is a md5)
-                        try:
-                            shutil.copy(dst_xz_cache_path, dst_path)
-                            needs_to_download = False
-                            logging.debug(
-                                "%s found in %s cache, there is no need to download it",
-                                element['filename'],
-                                xz_cache_dir)
-                            # Get out of the cache for loop, as we managed
-                            # to find the package in this cache directory
-                            break
-                        except OSError as os_error:
-                            needs_to_download = True
-                            logging.debug(
-                                "Error copying %s to %s : %s",
-                                dst_xz_cache_path,
-                                dst_path,
-                                os_error)
-
-            if needs_to_download and not self.download_package(element, dst_path):
-                # None of the mirror urls works.
-                # Stop right here, so the user does not have to wait
-                # to download the other packages.
-                logging.error(
-                    "Can't download %s, even after trying all available mirrors",
-                    element['filename'])
-                return False
-            else:
-                downloaded += 1
+    def process_element(self, element):
+        """ Puts the package described by element in pacman's cache.
+            Returns False if it can't be done """
+        needs_to_download = True
 
-            self.queue_event('progress_bar_show_text', '')
+        self.progress.package_started(element)
 
-            downloads_percent = round(float(downloaded / total_downloads), 2)
-            self.queue_event('downloads_percent', str(downloads_percent))
+        dst_path = os.path.join(self.pacman_cache_dir, element.filename)
 
-        # Wait until all xz packages are also copied to provided cache (if any)
-        for cache_thread in self.copy_to_cache_threads:
-            cache_thread.join()
+        if os.path.exists(dst_path):
+            # File already exists in destination pacman's cache
+            # (previous install?). We check the file md5 hash.
+            if not self.is_hash_ok(path=dst_path, element=element):
+                # We're sure it's a wrong hash. Force to download it
+                needs_to_download = True
+            else:
+                needs_to_download = False
+                logging.debug(
+                    "File %s found in %s cache, there is no need to download it",
+                    element.filename,
+                    self.pacman_cache_dir)
+        else:
+            needs_to_download = True
+            # Check all cache directories
+            for xz_cache_dir in self.xz_cache_dirs:
+                dst_xz_cache_path = os.path.join(
+                    xz_cache_dir,
+                    element.filename)
+
+                if (os.path.exists(dst_xz_cache_path) and
+                        self.is_hash_ok(path=dst_xz_cache_path, element=element)):
+                    # We're lucky, the package is already downloaded
+                    # in the cache the user has given us
+                    # and its md5 checks out (if there is a md5)
+                    method = cache_import.import_file(
+                        dst_xz_cache_path,
+                        dst_path,
+                        zero_copy_only=self.use_caches_in_place)
+                    if method or self.use_caches_in_place:
+                        needs_to_download = False
+                        logging.debug(
+                            "%s found in %s cache (%s), there is no need to download it",
+                            element.filename,
+                            xz_cache_dir,
+                            method or "used in place")
+                        # Get out of the cache for loop, as we managed
+                        # to find the package in this cache directory
+                        break
+                    else:
+                        needs_to_download = True
+                        logging.debug(
+                            "Error copying %s to %s",
+                            dst_xz_cache_path,
+                            dst_path)
+
+        if needs_to_download:
+            reserved = self.byte_budget.acquire(get_element_size(element))
+            try:
+                download_ok = self.download_package(element, dst_path)
+            finally:
+                self.byte_budget.release(reserved)
+            if not download_ok:
+                return False
 
-        self.queue_event('downloads_progress_bar', 'hide')
+        self.progress.package_done(element)
+        if self.downloaded_cb:
+            self.downloaded_cb(element)
         return True
 
     def download_package(self, element, dst_path):
@@ -220,21 +574,48 @@ class Download(object):
 
         logging.debug(
             "Looking for %s-%s in %d mirrors...",
-            element['identity'],
-            element['version'],
-            len(element['urls']))
-
-        for url in element['urls']:
-            # Let's catch empty values as well as None just to be safe
-            if not url:
-                # Something bad has happened, let's try another mirror
-                download_ok = False
-                logging.debug(
-                    "Package %s-%s has an empty url for this mirror",
-                    element['identity'],
-                    element['version'])
-            else:
-                download_ok = self.download_url(url, dst_path)
+            element.identity,
+            element.version,
+            len(element.urls))
+
+        size = get_element_size(element)
+        part_path = self.get_part_path(dst_path)
+        if size >= SEGMENTED_MIN_SIZE and not os.path.exists(part_path):
+            if self.download_segmented(element, dst_path, size):
+                return True
+            # Fall back to downloading it from one mirror at a time
+            # (resuming from the pieces we already have, if any)
+            self.progress.discard_bytes(element, get_file_size(part_path))
+
+        download_ok = False
+        tried = set()
+
+        while True:
+            if self.stop_event.is_set():
+                return False
+
+            # Sort mirrors again before each try, as other threads may have
+            # found that some of them are failing (or are faster than others)
+            element.urls = self.mirror_health.rank(element.urls)
+            untried = [url for url in element.urls if url and url not in tried]
+            if not untried:
+                break
+
+            # Use the best healthy mirror that has a free connection, so
+            # workers spread over mirrors instead of waiting for the first one
+            healthy = [url for url in untried if self.mirror_health.is_healthy(url)]
+            url = self.host_limiter.acquire_any(healthy or untried)
+            tried.add(url)
+            try:
+                download_ok = self.download_url(
+                    url,
+                    dst_path,
+                    md5hash=element.hash,
+                    size=size,
+                    sha256=element.sha256,
+                    element=element)
+            finally:
+                self.host_limiter.release(url)
 
             if download_ok:
                 # Copy downloaded xz file to the cache the user has provided, too.
@@ -246,62 +627,233 @@ class Download(object):
                 # self.copy_to_cache_threads += [copy_to_cache_thread]
                 # copy_to_cache_thread.start()
 
-                # Get out of the for loop, as we managed
+                # Get out of the loop, as we managed
                 # to download the package
                 break
             else:
                 # requests failed to obtain the file. Wrong url?
+                # Try the next healthy mirror right away (it will resume
+                # the download from where this one stopped)
                 msg = "Can't download %s, Cnchi will try another mirror."
                 logging.debug(msg, url)
-                # delays for 60 seconds
-                time.sleep(60)
+                self.progress.discard_bytes(element, get_file_size(part_path))
 
         return download_ok
 
-    def download_url(self, url, dst_path, md5hash=""):
-        percent = 0
+    def download_segmented(self, element, dst_path, size):
+        """ Splits the package in SEGMENT_SIZE pieces and downloads them
+            from the healthiest mirrors at the same time.
+            The result is checked against the package hashes """
+        part_path = self.get_part_path(dst_path)
+        urls = [
+            url for url in self.mirror_health.rank(element.urls)
+            if url and self.mirror_health.supports_ranges(url)]
+        urls = urls[:MAX_SEGMENT_MIRRORS]
+        if len(urls) < 2:
+            return False
+
+        logging.debug(
+            "Downloading %s from %d mirrors at the same time",
+            element.filename,
+            len(urls))
+
+        segments = queue.Queue()
+        for start in range(0, size, SEGMENT_SIZE):
+            segments.put((start, min(start + SEGMENT_SIZE, size) - 1))
+
+        written = []
+        with open(part_path, 'wb') as part_file:
+            part_file.truncate(size)
+            workers = []
+            for url_index in range(len(urls)):
+                worker = SegmentWorker(
+                    self, element, segments, urls, url_index, part_file.fileno(), written)
+                workers.append(worker)
+                worker.start()
+            for worker in workers:
+                worker.join()
+
+            if self.stop_event.is_set() or not segments.empty():
+                # Keep only the bytes we have from the beginning of the
+                # file, so the download can be resumed with a range request
+                part_file.truncate(get_written_prefix(written))
+                return False
+
+        # Pieces arrive in any order, so hashes can't be calculated
+        # while downloading
+        digests = hash_cache.calculate_digests(part_path)
+        if ((element.hash and element.hash != digests['md5']) or
+                (element.sha256 and element.sha256 != digests['sha256'])):
+            logging.warning("Hash of file %s does not match!", element.filename)
+            os.remove(part_path)
+            return False
+
+        os.replace(part_path, dst_path)
+        hash_cache.add(dst_path, digests)
+        return True
+
+    def download_segment(self, element, url, part_fd, start, end):
+        """ Downloads bytes start to end (both included) of url and writes
+            them at the same position of part_fd.
+            Returns the number of bytes written """
+        written = 0
+        headers = {'Range': 'bytes={0}-{1}'.format(start, end)}
+        try:
+            with self.host_limiter.get_semaphore(url):
+                time_start = time.perf_counter()
+                req = self.get_session().get(
+                    url, stream=True, timeout=30, headers=headers)
+                latency = time.perf_counter() - time_start
+                # Closing the response gives its connection back to the pool
+                with req:
+                    if req.status_code == requests.codes.ok:
+                        # Mirror works, but it does not support ranges
+                        self.mirror_health.record_no_ranges(url)
+                        return 0
+                    if req.status_code != requests.codes.partial_content:
+                        logging.debug(
+                            "Mirror returned status %d for a range of %s",
+                            req.status_code,
+                            url)
+                        self.mirror_health.record_failure(url)
+                        return 0
+
+                    for data in req.iter_content(DOWNLOAD_BUFFER_SIZE):
+                        if not data or self.stop_event.is_set():
+                            break
+                        # Do not write beyond the requested range
+                        data = data[:end + 1 - start - written]
+                        os.pwrite(part_fd, data, start + written)
+                        written += len(data)
+                        self.progress.add_bytes(element, len(data))
+                        if start + written > end:
+                            break
+            self.mirror_health.record_success(
+                url, latency, written, time.perf_counter() - time_start)
+        except (socket.timeout,
+                requests.exceptions.Timeout,
+                requests.exceptions.ConnectionError,
+                requests.exceptions.ChunkedEncodingError) as connection_error:
+            logging.debug(connection_error)
+            self.mirror_health.record_failure(url)
+        return written
+
+    @staticmethod
+    def get_part_path(dst_path):
+        """ Returns the path where a package is stored while downloading """
+        return dst_path + ".part"
+
+    def download_url(self, url, dst_path, md5hash="", size=0, sha256="", element=None):
+        """ Downloads url to dst_path. Data is stored in a .part file first,
+            so a failed download can be resumed later (from this or another
+            mirror) using a http range request.
+            If size is given, the final file size is checked against it.
+            Hashes are calculated while data arrives, and checked against
+            md5hash and sha256 (if given) without reading the file again.
+            Received bytes are added to element's progress (if given).
+            The caller must hold a connection of url's host (see HostLimiter) """
+        part_path = self.get_part_path(dst_path)
+
+        try:
+            offset = os.path.getsize(part_path)
+        except OSError:
+            offset = 0
+
+        if size and offset > size:
+            # Bigger than it should be, this .part file is no good
+            logging.debug("Discarding bad partial download %s", part_path)
+            os.remove(part_path)
+            offset = 0
+
+        headers = {}
+        if offset > 0:
+            headers['Range'] = 'bytes={0}-'.format(offset)
+
         completed_length = 0
-        start = time.perf_counter()
+        multi_hash = hash_cache.MultiHash()
         try:
+            start = time.perf_counter()
             # By default, get waits five minutes before
             # issuing a timeout, which is too much.
-            req = requests.get(url, stream=True, timeout=30)
-            if req.status_code == requests.codes.ok:
-                # Get total file length
-                try:
-                    total_length = int(req.headers.get('content-length'))
-                except TypeError as err:
-                    total_length = 0
+            req = self.get_session().get(
+                url, stream=True, timeout=30, headers=headers)
+            latency = time.perf_counter() - start
+            # Closing the response gives its connection back to the pool
+            with req:
+                if (req.status_code == requests.codes.requested_range_not_satisfiable and
+                        size and offset == size):
+                    # We already have the whole file
+                    mode = None
+                    multi_hash.update_from_file(part_path)
+                elif offset > 0 and req.status_code == requests.codes.partial_content:
+                    logging.debug("Resuming download of %s from byte %d", url, offset)
+                    mode = 'ab'
+                    # Hashes must include what we already have
+                    multi_hash.update_from_file(part_path)
+                elif req.status_code == requests.codes.ok:
+                    # Server does not support ranges (or there was
+                    # nothing to resume), start from the beginning
+                    offset = 0
+                    mode = 'wb'
+                    if element is not None:
+                        self.progress.discard_bytes(element)
+                else:
                     logging.debug(
-                        "Metalink for package %s has no size info", url)
-
-                with open(dst_path, 'wb') as xz_file:
-                    for data in req.iter_content(io.DEFAULT_BUFFER_SIZE):
-                        if not data:
-                            break
-                        xz_file.write(data)
-                        completed_length += len(data)
-                        old_percent = percent
-                        if total_length > 0:
-                            percent = float(completed_length / total_length)
-                            percent = round(percent, 2)
-                        else:
-                            percent += 0.1
-                        if old_percent != percent:
-                            self.queue_event('percent', percent)
-                        bps = completed_length // (time.perf_counter() - start)
-                        msg = self.format_progress_message(percent, bps)
-                        self.queue_event('progress_bar_show_text', msg)
-
-                # Check hash of downloaded package
-                if md5hash and not self.is_hash_ok(path=dst_path, md5hash=md5hash):
-                    # Wrong md5! Force to download it again
+                        "Mirror returned status %d for %s", req.status_code, url)
+                    if req.status_code == requests.codes.requested_range_not_satisfiable:
+                        # Can't resume this .part file, start again next time
+                        os.remove(part_path)
+                    self.mirror_health.record_failure(url)
                     return False
+
+                if mode:
+                    with open(part_path, mode) as xz_file:
+                        for data in req.iter_content(DOWNLOAD_BUFFER_SIZE):
+                            if not data or self.stop_event.is_set():
+                                break
+                            xz_file.write(data)
+                            multi_hash.update(data)
+                            completed_length += len(data)
+                            if element is not None:
+                                self.progress.add_bytes(element, len(data))
+
+            if self.stop_event.is_set():
+                return False
+
+            self.mirror_health.record_success(
+                url, latency, completed_length, time.perf_counter() - start)
+
+            total_length = offset + completed_length
+            if size and total_length != size:
+                logging.debug(
+                    "Downloaded %d bytes of %s, but it should be %d bytes long",
+                    total_length,
+                    url,
+                    size)
+                if total_length > size:
+                    os.remove(part_path)
+                return False
+
+            digests = multi_hash.hexdigests()
+            if ((md5hash and md5hash != digests['md5']) or
+                    (sha256 and sha256 != digests['sha256'])):
+                # Wrong hash! Force to download it again
+                logging.warning("Hash of file %s does not match!", url)
+                os.remove(part_path)
+                self.mirror_health.record_failure(url)
+                return False
+
+            os.replace(part_path, dst_path)
+
+            # Hashes are already checked, do not read the file again later
+            hash_cache.add(dst_path, digests)
         except (socket.timeout,
                 requests.exceptions.Timeout,
                 requests.exceptions.ConnectionError,
                 requests.exceptions.ChunkedEncodingError) as connection_error:
+            # Keep the .part file, next try will resume it
             logging.debug(connection_error)
+            self.mirror_health.record_failure(url)
             return False
 
         return True
@@ -326,12 +878,13 @@ class Download(object):
                 logging.debug("{0}: {1}".format(event_type, event_text))
             return
 
-        if event_type in self.last_event:
-            if self.last_event[event_type] == event_text:
-                # do not repeat same event
-                return
+        with self.last_event_lock:
+            if event_type in self.last_event:
+                if self.last_event[event_type] == event_text:
+                    # do not repeat same event
+                    return
 
-        self.last_event[event_type] = event_text
+            self.last_event[event_type] = event_text
 
         try:
             # Add the event
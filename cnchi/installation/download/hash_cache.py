@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# hash_cache.py
+#
+# Copyright © 2013-2016 Antergos
+#
+# This file is part of Cnchi.
+#
+# Cnchi is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cnchi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# The following additional terms are in effect as per Section 7 of the license:
+#
+# The preservation of all legal notices and author attributions in
+# the material or in the Appropriate Legal Notices displayed
+# by works containing it is required.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cnchi; If not, see <http://www.gnu.org/licenses/>.
+
+
+""" Remembers package hashes so files are not read again and again.
+    Each cache directory has an index file (kept in INDEX_DIR, so nothing
+    is written in the target's pacman cache nor in read only caches) with
+    the md5 and sha256 hashes of its packages. An entry is only used while
+    the package's size, modification time and inode do not change """
+
+import hashlib
+import json
+import logging
+import os
+import threading
+
+INDEX_DIR = "/tmp/cnchi-hash-index"
+INDEX_VERSION = 2
+
+# Hashes calculated when reading a file
+ALGORITHMS = ('md5', 'sha256')
+
+READ_BUFFER_SIZE = 1024 * 1024
+
+
+def get_index_path(directory):
+    """ Returns the path of the index file of directory """
+    name = hashlib.sha256(directory.encode()).hexdigest()
+    return os.path.join(INDEX_DIR, name + ".json")
+
+
+def get_file_key(stat):
+    """ Returns the values that must not change for a hash to be valid """
+    return [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+
+
+class MultiHash(object):
+    """ Calculates all hashes (see ALGORITHMS) of some data at once """
+
+    def __init__(self):
+        self.hashes = [hashlib.new(algorithm) for algorithm in ALGORITHMS]
+
+    def update(self, data):
+        """ Adds more data to all hashes """
+        for new_hash in self.hashes:
+            new_hash.update(data)
+
+    def update_from_file(self, path):
+        """ Adds the contents of the file path """
+        with open(path, 'rb') as hash_file:
+            buf = hash_file.read(READ_BUFFER_SIZE)
+            while buf:
+                self.update(buf)
+                buf = hash_file.read(READ_BUFFER_SIZE)
+
+    def hexdigests(self):
+        """ Returns a dict with all hashes (algorithm: hexdigest) """
+        return {
+            algorithm: new_hash.hexdigest()
+            for algorithm, new_hash in zip(ALGORITHMS, self.hashes)}
+
+
+def calculate_digests(path):
+    """ Reads path once and returns all its hashes """
+    multi_hash = MultiHash()
+    multi_hash.update_from_file(path)
+    return multi_hash.hexdigests()
+
+
+class HashIndex(object):
+    """ Hash index of the files in a directory """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = get_index_path(directory)
+        self.files = {}
+        self.modified = False
+        self.load()
+
+    def load(self):
+        """ Loads index file (if any) """
+        try:
+            with open(self.path, 'r') as index_file:
+                data = json.load(index_file)
+            if (data.get('version') == INDEX_VERSION and
+                    data.get('directory') == self.directory):
+                self.files = data.get('files', {})
+        except (OSError, ValueError) as err:
+            if not isinstance(err, FileNotFoundError):
+                logging.debug("Can't load hash index %s: %s", self.path, err)
+
+    def save(self):
+        """ Writes index file (if it has changed) """
+        if not self.modified:
+            return
+        tmp_path = self.path + ".tmp"
+        try:
+            os.makedirs(INDEX_DIR, mode=0o755, exist_ok=True)
+            with open(tmp_path, 'w') as index_file:
+                json.dump(
+                    {'version': INDEX_VERSION,
+                     'directory': self.directory,
+                     'files': self.files},
+                    index_file)
+            os.replace(tmp_path, self.path)
+            self.modified = False
+        except OSError as err:
+            logging.debug("Can't save hash index %s: %s", self.path, err)
+
+    def get(self, name, stat):
+        """ Returns stored hashes of file name if it has not changed """
+        entry = self.files.get(name)
+        if entry and entry[:3] == get_file_key(stat):
+            return entry[3]
+        return None
+
+    def set(self, name, stat, digests):
+        """ Stores hashes of file name """
+        self.files[name] = get_file_key(stat) + [digests]
+        self.modified = True
+
+
+class HashCache(object):
+    """ Hash indexes of all directories used by Cnchi """
+
+    def __init__(self):
+        self.indexes = {}
+        self.lock = threading.Lock()
+
+    def get_index(self, directory):
+        """ Returns (loading it if necessary) directory's index.
+            Must be called with self.lock held """
+        index = self.indexes.get(directory)
+        if index is None:
+            index = HashIndex(directory)
+            self.indexes[directory] = index
+        return index
+
+    def get_digest(self, path, algorithm):
+        """ Returns path's hash. It is only calculated if it is not
+            in the index or if the file has changed """
+        path = os.path.abspath(path)
+        directory, name = os.path.split(path)
+        stat = os.stat(path)
+        with self.lock:
+            digests = self.get_index(directory).get(name, stat)
+        if digests is None:
+            digests = calculate_digests(path)
+            with self.lock:
+                self.get_index(directory).set(name, stat, digests)
+        return digests[algorithm]
+
+    def add(self, path, digests):
+        """ Stores already calculated hashes of path (a file that has just
+            been downloaded, for instance) """
+        path = os.path.abspath(path)
+        directory, name = os.path.split(path)
+        stat = os.stat(path)
+        with self.lock:
+            self.get_index(directory).set(name, stat, digests)
+
+    def save(self):
+        """ Writes all modified indexes """
+        with self.lock:
+            for index in self.indexes.values():
+                index.save()
+
+
+# All Cnchi modules share the same hash cache
+HASH_CACHE = HashCache()
+
+
+def get_digest(path, algorithm):
+    """ Returns path's hash using the shared hash cache """
+    return HASH_CACHE.get_digest(path, algorithm)
+
+
+def add(path, digests):
+    """ Stores path's hashes in the shared hash cache """
+    HASH_CACHE.add(path, digests)
+
+
+def save():
+    """ Writes the shared hash cache indexes """
+    HASH_CACHE.save()
@@ -31,71 +31,29 @@
 """ Operations with metalinks """
 
 import argparse
-import hashlib
 import logging
 import os
 import re
-import tempfile
 import xml.dom.minidom as minidom
 from collections import deque
 
+import installation.download.hash_cache as hash_cache
+
 try:
     import pyalpm
 except ImportError:
     pass
 
-try:
-    import xml.etree.cElementTree as eTree
-except ImportError:
-    import xml.etree.ElementTree as eTree
-
 MAX_URLS = 15
 
 
 def get_info(metalink):
-    """ Reads metalink xml info and returns it """
-
-    # tag = "{urn:ietf:params:xml:ns:metalink}"
-
-    temp_file = tempfile.NamedTemporaryFile(delete=False)
-    temp_file.write(str(metalink).encode('UTF-8'))
-    temp_file.close()
-
+    """ Returns metalink package records (MetalinkFile objects) in a dict
+        indexed by package name. Databases and signature files are skipped """
     metalink_info = {}
-    element = {}
-
-    for event, elem in eTree.iterparse(temp_file.name, events=('start', 'end')):
-        if event == "start":
-            if elem.tag.endswith("file"):
-                element['filename'] = elem.attrib['name']
-            elif elem.tag.endswith("identity"):
-                element['identity'] = elem.text
-            elif elem.tag.endswith("size"):
-                element['size'] = elem.text
-            elif elem.tag.endswith("version"):
-                element['version'] = elem.text
-            elif elem.tag.endswith("description"):
-                element['description'] = elem.text
-            elif elem.tag.endswith("hash"):
-                element['hash'] = elem.text
-            elif elem.tag.endswith("url"):
-                try:
-                    element['urls'].append(elem.text)
-                except KeyError:
-                    element['urls'] = [elem.text]
-        if event == "end":
-            if elem.tag.endswith("file"):
-                # Limit to MAX_URLS for file
-                if len(element['urls']) > MAX_URLS:
-                    element['urls'] = element['urls'][:MAX_URLS]
-                key = element['identity']
-                metalink_info[key] = element.copy()
-                element.clear()
-                elem.clear()
-
-    if os.path.exists(temp_file.name):
-        os.remove(temp_file.name)
-
+    for metalink_file in metalink:
+        if metalink_file.identity is not None:
+            metalink_info[metalink_file.identity] = metalink_file
     return metalink_info
 
 
@@ -137,6 +95,52 @@ def create(alpm, package_name, pacman_conf_file):
     return metalink
 
 
+def create_download_dict(alpm, package_names, pacman_conf_file):
+    """ Resolves all package_names and their dependencies in one pass and
+        returns the downloads dict (same format as get_info) directly,
+        without creating a metalink xml for each package """
+
+    options = ["--conf", pacman_conf_file, "--noconfirm", "--all-deps"]
+    options.extend(package_names)
+
+    try:
+        download_queue, not_found, missing_deps = build_download_queue(alpm, args=options)
+    except Exception as ex:
+        template = "Unable to create download queue. An exception of type {0} occured. Arguments:\n{1!r}"
+        message = template.format(type(ex).__name__, ex.args)
+        logging.error(message)
+        return None
+
+    if not_found:
+        msg = "Can't find these packages: "
+        for pkg_not_found in sorted(not_found):
+            msg = msg + pkg_not_found + " "
+        logging.error(msg)
+        return None
+
+    if missing_deps:
+        msg = "Can't resolve these dependencies: "
+        for missing in sorted(missing_deps):
+            msg = msg + missing + " "
+        logging.error(msg)
+        return None
+
+    return download_queue_to_dict(download_queue)
+
+
+def download_queue_to_dict(download_queue):
+    """ Converts a download_queue object to a downloads dict
+        (package name -> MetalinkFile).
+        Only sync packages are added (databases and signature files
+        are not downloaded by Cnchi) """
+    downloads = {}
+
+    for pkg, urls, _sigs in download_queue.sync_pkgs:
+        downloads[pkg.name] = MetalinkFile.from_pkg(pkg, urls)
+
+    return downloads
+
+
 """ From here comes modified code from pm2ml
     pm2ml is Copyright (C) 2012-2013 Xyne
     More info: http://xyne.archlinux.ca/projects/pm2ml """
@@ -155,70 +159,111 @@ def download_queue_to_metalink(download_queue):
     return metalink
 
 
+class MetalinkFile(object):
+    """ A file (package, database or signature) of a metalink.
+        Databases and signatures only have filename and urls """
+
+    __slots__ = (
+        'filename', 'identity', 'size', 'version',
+        'description', 'hash', 'sha256', 'urls')
+
+    def __init__(self, filename, urls, identity=None, size=0, version=None,
+                 description=None, md5hash=None, sha256=None):
+        self.filename = filename
+        self.identity = identity
+        self.size = size
+        self.version = version
+        self.description = description
+        # hash is the md5 hash of the package
+        self.hash = md5hash
+        self.sha256 = sha256
+        # Limit to MAX_URLS for file
+        self.urls = list(urls)[:MAX_URLS]
+
+    @classmethod
+    def from_pkg(cls, pkg, urls):
+        """ Creates a MetalinkFile from a pyalpm package """
+        return cls(
+            filename=pkg.filename,
+            urls=urls,
+            identity=pkg.name,
+            size=pkg.size,
+            version=pkg.version,
+            description=pkg.desc,
+            md5hash=pkg.md5sum,
+            sha256=pkg.sha256sum)
+
+    def __repr__(self):
+        return 'MetalinkFile({0!r})'.format(self.filename)
+
+
 class Metalink(object):
-    """ Metalink class """
+    """ Metalink class. Stores its files as MetalinkFile records,
+        xml is only created when asked for (see to_xml) """
     def __init__(self):
-        self.doc = minidom.getDOMImplementation().createDocument(None, "metalink", None)
-        self.doc.documentElement.setAttribute('xmlns', "urn:ietf:params:xml:ns:metalink")
-        self.files = self.doc.documentElement
+        self.files = []
 
-    # def __del__(self):
-    #    self.doc.unlink()
+    def __iter__(self):
+        return iter(self.files)
+
+    def __len__(self):
+        return len(self.files)
 
     def __str__(self):
         """ Get a string representation of a metalink """
-        return re.sub(
+        return self.to_xml()
+
+    def to_xml(self):
+        """ Exports the metalink as a xml string """
+        doc = minidom.getDOMImplementation().createDocument(None, "metalink", None)
+        doc.documentElement.setAttribute('xmlns', "urn:ietf:params:xml:ns:metalink")
+
+        for metalink_file in self.files:
+            file_ = doc.createElement("file")
+            file_.setAttribute("name", metalink_file.filename)
+            doc.documentElement.appendChild(file_)
+            if metalink_file.identity is not None:
+                for tag, value, attrs in (
+                        ('identity', metalink_file.identity, ()),
+                        ('size', metalink_file.size, ()),
+                        ('version', metalink_file.version, ()),
+                        ('description', metalink_file.description, ()),
+                        ('hash', metalink_file.sha256, (('type', 'sha256'),)),
+                        ('hash', metalink_file.hash, (('type', 'md5'),))):
+                    tag = doc.createElement(tag)
+                    file_.appendChild(tag)
+                    tag.appendChild(doc.createTextNode(str(value)))
+                    for key, val in attrs:
+                        tag.setAttribute(key, val)
+            for url in metalink_file.urls:
+                url_tag = doc.createElement('url')
+                file_.appendChild(url_tag)
+                url_tag.appendChild(doc.createTextNode(url))
+
+        xml = re.sub(
             r'(?<=>)\n\s*([^\s<].*?)\s*\n\s*',
             r'\1',
-            self.doc.toprettyxml(indent=' ')
+            doc.toprettyxml(indent=' ')
         )
-
-    def add_urls(self, element, urls):
-        """Add URL elements to the given element."""
-        for url in urls:
-            url_tag = self.doc.createElement('url')
-            element.appendChild(url_tag)
-            url_val = self.doc.createTextNode(url)
-            url_tag.appendChild(url_val)
+        doc.unlink()
+        return xml
 
     def add_sync_pkg(self, pkg, urls, sigs=False):
         """Add a sync db package."""
-        file_ = self.doc.createElement("file")
-        file_.setAttribute("name", pkg.filename)
-        self.files.appendChild(file_)
-        for tag, db_attr, attrs in (
-                ('identity', 'name', ()),
-                ('size', 'size', ()),
-                ('version', 'version', ()),
-                ('description', 'desc', ()),
-                ('hash', 'sha256sum', (('type', 'sha256'),)),
-                ('hash', 'md5sum', (('type', 'md5'),))):
-            tag = self.doc.createElement(tag)
-            file_.appendChild(tag)
-            val = self.doc.createTextNode(str(getattr(pkg, db_attr)))
-            tag.appendChild(val)
-            for key, val in attrs:
-                tag.setAttribute(key, val)
         urls = list(urls)
-        self.add_urls(file_, urls)
+        self.files.append(MetalinkFile.from_pkg(pkg, urls))
         if sigs:
             self.add_file(pkg.filename + '.sig', (u + '.sig' for u in urls))
 
     def add_file(self, name, urls):
         """Add a signature file."""
-        file_ = self.doc.createElement("file")
-        file_.setAttribute("name", name)
-        self.files.appendChild(file_)
-        self.add_urls(file_, urls)
+        self.files.append(MetalinkFile(name, urls))
 
     def add_db(self, db, sigs=False):
         """Add a sync db."""
-        file_ = self.doc.createElement("file")
         name = db.name + '.db'
-        file_.setAttribute("name", name)
-        self.files.appendChild(file_)
         urls = list(os.path.join(url, db.name + '.db') for url in db.servers)
-        self.add_urls(file_, urls)
+        self.files.append(MetalinkFile(name, urls))
         if sigs:
             self.add_file(name + '.sig', (u + '.sig' for u in urls))
 
@@ -336,7 +381,7 @@ def build_download_queue(alpm, args=None):
     found = set()
 
     one_repo_groups = ['cinnamon', 'mate', 'mate-extra']
-    antdb = [db for db in handle.get_syncdbs() if 'antergos' == db.name]
+    antdb = [db for db in alpm.get_syncdbs() if 'antergos' == db.name]
     antdb = antdb[0]
     one_repo_groups = [antdb.read_grp(one_repo_group) for one_repo_group in one_repo_groups]
     one_repo_pkgs = {pkg for one_repo_group in one_repo_groups
@@ -347,7 +392,7 @@ def build_download_queue(alpm, args=None):
 
     for pkg in requested:
         other_grp = PkgSet()
-        for db in handle.get_syncdbs():
+        for db in alpm.get_syncdbs():
             if pkg in one_repo_pkgs and 'antergos' != db.name:
                 # pkg should be sourced from the antergos repo only.
                 db = antdb
@@ -371,16 +416,23 @@ def build_download_queue(alpm, args=None):
     # Resolve dependencies.
     if other and not pargs.nodeps:
         queue = deque(other)
+        # pkgcache builds a new list each time it is accessed, get them once
         local_cache = handle.get_localdb().pkgcache
-        syncdbs = handle.get_syncdbs()
-        seen = set(queue)
+        sync_caches = [alpm.get_pkgcache(db) for db in alpm.get_syncdbs()]
+        seen = set(pkg.name for pkg in queue)
+        # Dependencies already resolved (many packages share the same deps)
+        satisfiers = {}
         while queue:
             pkg = queue.popleft()
             for dep in pkg.depends:
-                if pyalpm.find_satisfier(local_cache, dep) is None or pargs.alldeps:
-                    for db in syncdbs:
-                        prov = pyalpm.find_satisfier(db.pkgcache, dep)
+                if dep in satisfiers:
+                    continue
+                satisfiers[dep] = None
+                if pargs.alldeps or pyalpm.find_satisfier(local_cache, dep) is None:
+                    for sync_cache in sync_caches:
+                        prov = pyalpm.find_satisfier(sync_cache, dep)
                         if prov is not None:
+                            satisfiers[dep] = prov
                             other.add(prov)
                             if prov.name not in seen:
                                 seen.add(prov.name)
@@ -393,11 +445,12 @@ def build_download_queue(alpm, args=None):
     not_found = requested - found
     if pargs.needed:
         other = PkgSet(list(check_cache(conf, other)))
+        hash_cache.save()
 
     download_queue = DownloadQueue()
 
     if pargs.db:
-        for db in handle.get_syncdbs():
+        for db in alpm.get_syncdbs():
             try:
                 siglevel = conf[db.name]['SigLevel'].split()[0]
             except KeyError:
@@ -421,16 +474,9 @@ def build_download_queue(alpm, args=None):
 
 
 def get_checksum(path, typ):
-    """ Returns checksum of a file """
-    new_hash = hashlib.new(typ)
-    block_size = new_hash.block_size
+    """ Returns checksum of a file (from the hash cache if possible) """
     try:
-        with open(path, 'rb') as f:
-            buf = f.read(block_size)
-            while buf:
-                new_hash.update(buf)
-                buf = f.read(block_size)
-        return new_hash.hexdigest()
+        return hash_cache.get_digest(path, typ)
     except FileNotFoundError:
         return -1
     except IOError as io_error:
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# mirror_health.py
+#
+# Copyright © 2013-2016 Antergos
+#
+# This file is part of Cnchi.
+#
+# Cnchi is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cnchi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# The following additional terms are in effect as per Section 7 of the license:
+#
+# The preservation of all legal notices and author attributions in
+# the material or in the Appropriate Legal Notices displayed
+# by works containing it is required.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cnchi; If not, see <http://www.gnu.org/licenses/>.
+
+
+""" Keeps track of mirror health while downloading packages """
+
+import logging
+import threading
+import time
+import urllib.parse
+
+# Weight of the newest sample in latency and throughput averages
+EWMA_ALPHA = 0.3
+
+# Consecutive failures needed to stop using a mirror for a while
+FAILURE_THRESHOLD = 2
+
+# Time (in seconds) a failing mirror is not used. It doubles each time
+# the mirror fails again, up to COOL_OFF_MAX
+COOL_OFF_BASE = 30
+COOL_OFF_MAX = 600
+
+
+def get_mirror(url):
+    """ Returns the mirror (scheme and host) of an url """
+    parts = urllib.parse.urlsplit(url)
+    return "{0}://{1}".format(parts.scheme, parts.netloc)
+
+
+def ewma(average, sample):
+    """ Exponentially weighted moving average """
+    if average is None:
+        return sample
+    return EWMA_ALPHA * sample + (1 - EWMA_ALPHA) * average
+
+
+class MirrorStats(object):
+    """ Health information of a mirror """
+
+    __slots__ = (
+        'successes', 'failures', 'consecutive_failures',
+        'latency', 'throughput', 'open_until', 'supports_ranges')
+
+    def __init__(self):
+        self.successes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        # Seconds until response headers arrive
+        self.latency = None
+        # Bytes per second
+        self.throughput = None
+        # Circuit breaker: mirror is not used until this time
+        self.open_until = 0
+        # False once the mirror has ignored a range request
+        self.supports_ranges = True
+
+    def is_open(self, now):
+        """ True if the mirror is cooling off after failing """
+        return now < self.open_until
+
+
+class MirrorHealth(object):
+    """ Stores mirror statistics shared by all download threads and
+        ranks mirror urls using them """
+
+    def __init__(self):
+        self.mirrors = {}
+        self.lock = threading.Lock()
+
+    def get_stats(self, url):
+        """ Returns (creating them if necessary) url's mirror stats.
+            Must be called with self.lock held """
+        mirror = get_mirror(url)
+        stats = self.mirrors.get(mirror)
+        if stats is None:
+            stats = MirrorStats()
+            self.mirrors[mirror] = stats
+        return stats
+
+    def record_success(self, url, latency, length, seconds):
+        """ A download of length bytes from url took seconds """
+        with self.lock:
+            stats = self.get_stats(url)
+            stats.successes += 1
+            stats.consecutive_failures = 0
+            stats.open_until = 0
+            stats.latency = ewma(stats.latency, latency)
+            if seconds > 0 and length > 0:
+                stats.throughput = ewma(stats.throughput, length / seconds)
+
+    def record_failure(self, url):
+        """ A download from url has failed """
+        with self.lock:
+            stats = self.get_stats(url)
+            stats.failures += 1
+            stats.consecutive_failures += 1
+            if stats.consecutive_failures >= FAILURE_THRESHOLD:
+                exponent = stats.consecutive_failures - FAILURE_THRESHOLD
+                cool_off = min(COOL_OFF_BASE * 2 ** exponent, COOL_OFF_MAX)
+                stats.open_until = time.monotonic() + cool_off
+                logging.debug(
+                    "Mirror %s failed %d times in a row, it won't be used for %d seconds",
+                    get_mirror(url),
+                    stats.consecutive_failures,
+                    cool_off)
+
+    def record_no_ranges(self, url):
+        """ url's mirror has answered a range request with the whole file.
+            It works, but it can't be used to download pieces of a file """
+        with self.lock:
+            stats = self.get_stats(url)
+            if stats.supports_ranges:
+                logging.debug("Mirror %s does not support range requests", get_mirror(url))
+            stats.supports_ranges = False
+
+    def is_healthy(self, url):
+        """ False while url's mirror is cooling off after failing """
+        with self.lock:
+            stats = self.mirrors.get(get_mirror(url))
+            return stats is None or not stats.is_open(time.monotonic())
+
+    def supports_ranges(self, url):
+        """ False if url's mirror is known to ignore range requests """
+        with self.lock:
+            stats = self.mirrors.get(get_mirror(url))
+            return stats is None or stats.supports_ranges
+
+    def get_throughput(self, url):
+        """ Returns measured throughput of url's mirror (or None) """
+        with self.lock:
+            stats = self.mirrors.get(get_mirror(url))
+            if stats is None:
+                return None
+            return stats.throughput
+
+    def get_sort_key(self):
+        """ Returns a function that gives the sort key (lower is better)
+            of an url using current mirror statistics. Mirrors that are
+            cooling off go last, the rest are sorted by their expected
+            throughput. Mirrors without measures are assumed to be as fast
+            as the average mirror (so they keep their relative order) """
+        now = time.monotonic()
+        with self.lock:
+            measured = [
+                stats.throughput for stats in self.mirrors.values()
+                if stats.throughput is not None]
+            default = sum(measured) / len(measured) if measured else 1
+            snapshot = {}
+            for mirror, stats in self.mirrors.items():
+                throughput = stats.throughput
+                if throughput is None:
+                    throughput = default
+                attempts = stats.successes + stats.failures
+                success_rate = (stats.successes + 1) / (attempts + 1)
+                snapshot[mirror] = (int(stats.is_open(now)), -throughput * success_rate)
+
+        unknown = (0, -default)
+
+        def key(url):
+            """ Sort key of url """
+            if not url:
+                return (2, 0)
+            return snapshot.get(get_mirror(url), unknown)
+
+        return key
+
+    def rank(self, urls):
+        """ Returns urls sorted by mirror health (see get_sort_key) """
+        return sorted(urls, key=self.get_sort_key())
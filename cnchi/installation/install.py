@@ -32,6 +32,7 @@ import queue
 import re
 import shutil
 import sys
+import threading
 import time
 
 import storage.filesystems as fs
@@ -42,10 +43,14 @@ import encfs
 import hardware.hardware as hardware
 import installation.pacman.pac as pac
 import misc.extra as misc
+from installation import deferred_tasks
 from installation import firewall
 from installation import mkinitcpio
+from installation import pipeline
 from installation import special_dirs
+from installation import step_scheduler
 from installation.download import download
+from installation.pacman import handle_pool
 from installation.storage import auto_partition
 from misc.extra import InstallError
 from misc.run_cmd import call, chroot_call
@@ -279,14 +284,22 @@ class Installation(object):
             message = template.format(type(ex).__name__, ex.args)
             logging.error(message)
 
-        logging.debug("Downloading packages...")
-        self.download_packages()
+        if self.settings.get('pipelined_install'):
+            # This mounts (binds) /dev and others to /DEST_DIR/dev and others
+            # (packages will be installed while others are downloaded)
+            special_dirs.mount(DEST_DIR)
 
-        # This mounts (binds) /dev and others to /DEST_DIR/dev and others
-        special_dirs.mount(DEST_DIR)
+            logging.debug("Downloading and installing packages...")
+            self.install_packages_pipelined()
+        else:
+            logging.debug("Downloading packages...")
+            self.download_packages()
 
-        logging.debug("Installing packages...")
-        self.install_packages()
+            # This mounts (binds) /dev and others to /DEST_DIR/dev and others
+            special_dirs.mount(DEST_DIR)
+
+            logging.debug("Installing packages...")
+            self.install_packages()
 
         logging.debug("Configuring system...")
         self.configure_system()
@@ -324,7 +337,7 @@ class Installation(object):
             except FileExistsError:
                 pass
 
-    def download_packages(self):
+    def download_packages(self, order=None, downloaded_cb=None):
         """ Downloads necessary packages """
 
         self.pacman_cache_dir = os.path.join(DEST_DIR, 'var/cache/pacman/pkg')
@@ -339,7 +352,10 @@ class Installation(object):
         # Metalinks have already been calculated before,
         # When downloadpackages class has been called in process.py to test
         # that Cnchi was able to create it before partitioning/formatting
-        download_packages.start(self.metalinks)
+        download_packages.start(
+            self.metalinks,
+            order=order,
+            downloaded_cb=downloaded_cb)
 
     def create_pacman_conf_file(self):
         """ Creates a temporary pacman.conf """
@@ -367,7 +383,7 @@ class Installation(object):
 
         # Init pyalpm
         try:
-            self.pacman = pac.Pac("/tmp/pacman.conf", self.callback_queue)
+            self.pacman = handle_pool.get_pac("/tmp/pacman.conf", self.callback_queue)
         except Exception as ex:
             self.pacman = None
             template = "Can't initialize pyalpm. An exception of type {0} occured. Arguments:\n{1!r}"
@@ -452,7 +468,7 @@ class Installation(object):
                             except Exception as err:
                                 logging.error(err)
 
-                self.pacman.refresh()
+                self.pacman.refresh(force=True)
 
                 result = self.pacman.install(pkgs=self.packages)
 
@@ -468,7 +484,7 @@ class Installation(object):
 
                     new_pacman_conf.write(line)
 
-            self.pacman.refresh()
+            self.pacman.refresh(force=True)
 
             result = self.pacman.install(pkgs=self.packages)
 
@@ -479,6 +495,83 @@ class Installation(object):
         # All downloading and installing has been done, so we hide progress bar
         self.queue_event('progress_bar', 'hide')
 
+    def install_packages_pipelined(self):
+        """ Installs packages in batches (by dependency level) while the
+            rest of them are still being downloaded """
+        for cache_dir in self.settings.get('xz_cache'):
+            self.pacman.handle.add_cachedir(cache_dir)
+
+        install_pipeline = pipeline.InstallPipeline(self.pacman, self.metalinks)
+
+        def download():
+            """ Download thread """
+            try:
+                self.download_packages(
+                    order=install_pipeline.get_download_order(),
+                    downloaded_cb=install_pipeline.package_downloaded)
+                install_pipeline.download_finished()
+            except Exception as download_error:
+                install_pipeline.download_finished(download_error)
+
+        download_thread = threading.Thread(target=download)
+        download_thread.start()
+
+        try:
+            result = install_pipeline.run()
+        except pac.pyalpm.error as install_error:
+            logging.error(install_error)
+            result = False
+        finally:
+            # Never leave the download thread behind, whatever the
+            # pipeline has raised
+            download_thread.join()
+
+        if install_pipeline.download_error:
+            raise install_pipeline.download_error
+
+        if not result:
+            # Install what is left (and retry if needed) the usual way
+            logging.warning("Pipelined installation failed, installing the remaining packages at once")
+            self.install_packages()
+            return
+
+        # Install packages that were not part of the pipeline (if any) and
+        # mark as explicitly installed the ones that the user asked for
+        # (pipeline installs all of them as dependencies). Requested names
+        # are resolved as pacman does: package, group and then provision
+        database = self.pacman.handle.get_localdb()
+        sync_index = self.pacman.get_sync_index()
+        explicit = []
+        remaining = []
+        for name in set(self.packages):
+            pkg = sync_index.find_package(name)
+            group_pkgs = None
+            if pkg is None:
+                group_pkgs = sync_index.find_group(name)
+                if not group_pkgs:
+                    pkg = sync_index.find_provider(name)
+            if group_pkgs:
+                explicit.extend(group_pkg.name for group_pkg in group_pkgs)
+            elif pkg is not None:
+                explicit.append(pkg.name)
+            else:
+                explicit.append(name)
+
+        for name in explicit:
+            if database.get_pkg(name) is None:
+                remaining.append(name)
+
+        if remaining:
+            logging.debug("Installing %d packages not installed by the pipeline", len(remaining))
+            if not self.pacman.install(pkgs=remaining):
+                txt = _("Can't install necessary packages. Cnchi can't continue.")
+                raise InstallError(txt)
+
+        self.pacman.set_explicit(name for name in explicit if name not in remaining)
+
+        # All downloading and installing has been done, so we hide progress bar
+        self.queue_event('progress_bar', 'hide')
+
     def is_running(self):
         """ Checks if thread is running """
         return self.running
@@ -1050,25 +1143,8 @@ class Installation(object):
                 zfs_version = file_name.split("-")[1]
         return zfs_version
 
-    def configure_system(self):
-        """ Final install steps
-            Set clock, language, timezone
-            Run mkinitcpio
-            Populate pacman keyring
-            Setup systemd services
-            ... and more """
-
-        self.queue_event('pulse', 'start')
-        self.queue_event('info', _("Configuring your new system"))
-
-        self.auto_fstab()
-        logging.debug("fstab file generated.")
-
-        # If SSD was detected copy udev rule for deadline scheduler
-        if self.ssd:
-            self.set_scheduler()
-            logging.debug("SSD udev rule copied successfully")
-
+    def configure_network(self):
+        """ Sets up network configuration in the new system """
         # Copy configured networks in Live medium to target system
         if self.settings.get("network_manager") == "NetworkManager":
             self.copy_network_config()
@@ -1087,7 +1163,9 @@ class Installation(object):
 
         logging.debug("Network configuration done.")
 
-        # Copy mirror list
+    @staticmethod
+    def copy_mirrorlist():
+        """ Copies mirror list """
         mirrorlist_src_path = '/etc/pacman.d/mirrorlist'
         mirrorlist_dst_path = os.path.join(DEST_DIR, 'etc/pacman.d/mirrorlist')
         try:
@@ -1100,12 +1178,8 @@ class Installation(object):
         except FileExistsError:
             logging.warning("File %s already exists.", mirrorlist_dst_path)
 
-        # Add Antergos repo to /etc/pacman.conf
-        self.update_pacman_conf()
-
-        logging.debug("pacman.conf has been created successfully")
-
-        # Enable some useful services
+    def enable_default_services(self):
+        """ Enables some useful services """
         services = []
 
         if self.desktop != "base":
@@ -1121,41 +1195,42 @@ class Installation(object):
 
         self.enable_services(services)
 
-        # Enable timesyncd service
-        if self.settings.get("use_timesyncd"):
-            timesyncd_path = os.path.join(
-                DEST_DIR,
-                "etc/systemd/timesyncd.conf")
-            try:
-                with open(timesyncd_path, 'w') as timesyncd:
-                    timesyncd.write("[Time]\n")
-                    timesyncd.write("NTP=0.arch.pool.ntp.org 1.arch.pool.ntp.org "
-                                    "2.arch.pool.ntp.org 3.arch.pool.ntp.org\n")
-                    timesyncd.write("FallbackNTP=0.pool.ntp.org 1.pool.ntp.org "
-                                    "0.fr.pool.ntp.org\n")
-            except FileNotFoundError as err:
-                logging.warning("Can't find %s file.", timesyncd_path)
-            chroot_call(['timedatectl', 'set-ntp', 'true'])
-
-        # Set timezone
+    def setup_timesyncd(self):
+        """ Enables timesyncd service """
+        if not self.settings.get("use_timesyncd"):
+            return
+        timesyncd_path = os.path.join(
+            DEST_DIR,
+            "etc/systemd/timesyncd.conf")
+        try:
+            with open(timesyncd_path, 'w') as timesyncd:
+                timesyncd.write("[Time]\n")
+                timesyncd.write("NTP=0.arch.pool.ntp.org 1.arch.pool.ntp.org "
+                                "2.arch.pool.ntp.org 3.arch.pool.ntp.org\n")
+                timesyncd.write("FallbackNTP=0.pool.ntp.org 1.pool.ntp.org "
+                                "0.fr.pool.ntp.org\n")
+        except FileNotFoundError as err:
+            logging.warning("Can't find %s file.", timesyncd_path)
+        chroot_call(['timedatectl', 'set-ntp', 'true'])
+
+    def set_timezone(self):
+        """ Sets timezone """
         zoneinfo_path = os.path.join(
             "/usr/share/zoneinfo",
             self.settings.get("timezone_zone"))
         chroot_call(['ln', '-s', zoneinfo_path, "/etc/localtime"])
         logging.debug("Timezone set.")
 
-        # Wait FOREVER until the user sets his params
+    def wait_user_info(self):
+        """ Waits until the user sets his params """
         # FIXME: We can wait here forever!
         while self.settings.get('user_info_done') is False:
             # Wait five seconds and try again
             time.sleep(5)
 
-        # Set user parameters
+    def setup_sudoers(self):
+        """ Allows the user to use sudo """
         username = self.settings.get('username')
-        fullname = self.settings.get('fullname')
-        password = self.settings.get('password')
-        hostname = self.settings.get('hostname')
-
         sudoers_dir = os.path.join(DEST_DIR, "etc/sudoers.d")
         if not os.path.exists(sudoers_dir):
             os.mkdir(sudoers_dir, 0o710)
@@ -1170,9 +1245,8 @@ class Installation(object):
             # Something bad must be happening, though.
             logging.error(io_error)
 
-        # Configure detected hardware
-        # NOTE: Because hardware can need extra repos, this code must run
-        # always after having called the update_pacman_conf method
+    def hardware_post_install(self):
+        """ Configures detected hardware """
         if self.hardware_install:
             try:
                 logging.debug("Running hardware drivers post-install jobs...")
@@ -1182,7 +1256,11 @@ class Installation(object):
                 message = template.format(type(ex).__name__, ex.args)
                 logging.error(message)
 
-        # Setup user
+    def setup_user(self):
+        """ Creates user account and sets user and root passwords """
+        username = self.settings.get('username')
+        fullname = self.settings.get('fullname')
+        password = self.settings.get('password')
 
         default_groups = 'wheel'
 
@@ -1215,7 +1293,13 @@ class Installation(object):
         cmd = ['chown', '-R', '{0}:users'.format(username), home_dir]
         chroot_call(cmd)
 
-        # Set hostname
+        # User password is the root password
+        self.change_user_password('root', password)
+        logging.debug("Set the same password to root.")
+
+    def set_hostname(self):
+        """ Sets hostname """
+        hostname = self.settings.get('hostname')
         hostname_path = os.path.join(DEST_DIR, "etc/hostname")
         if not os.path.exists(hostname_path):
             with open(hostname_path, "w") as hostname_file:
@@ -1223,11 +1307,8 @@ class Installation(object):
 
         logging.debug("Hostname set to %s", hostname)
 
-        # User password is the root password
-        self.change_user_password('root', password)
-        logging.debug("Set the same password to root.")
-
-        # Generate locales
+    def setup_locale(self):
+        """ Generates locales """
         locale = self.settings.get("locale")
         self.queue_event('info', _("Generating locales..."))
         self.uncomment_locale_gen(locale)
@@ -1241,9 +1322,8 @@ class Installation(object):
         # with open(environment_path, "w") as environment:
         #    environment.write('LANG={0}\n'.format(locale))
 
-        self.queue_event('info', _("Adjusting hardware clock..."))
-        self.auto_timesetting()
-
+    def setup_keymap(self):
+        """ Configures X and console keymaps """
         self.queue_event('info', _("Configuring keymap..."))
 
         if self.desktop != "base":
@@ -1251,43 +1331,38 @@ class Installation(object):
 
         self.set_vconsole_conf()
 
-        # Install configs for root
+    @staticmethod
+    def copy_root_skel():
+        """ Installs configs for root """
         chroot_call(['cp', '-av', '/etc/skel/.', '/root/'])
 
-        self.queue_event('info', _("Configuring hardware..."))
-
-        # Copy generated xorg.conf to target
+    @staticmethod
+    def copy_xorg_conf():
+        """ Copies generated xorg.conf to target """
         if os.path.exists("/etc/X11/xorg.conf"):
             src = "/etc/X11/xorg.conf"
             dst = os.path.join(DEST_DIR, 'etc/X11/xorg.conf')
             shutil.copy2(src, dst)
 
-        # Configure ALSA
-        #self.alsa_mixer_setup()
-        #logging.debug("Updated Alsa mixer settings")
-
-        # Set pulse
-        #if os.path.exists(os.path.join(DEST_DIR, "usr/bin/pulseaudio-ctl")):
-        #    chroot_run(['pulseaudio-ctl', 'normal'])
-
-        # Set fluidsynth audio system (in our case, pulseaudio)
-        self.set_fluidsynth()
-        logging.debug("Updated fluidsynth configuration file")
-
-        # Workaround for pacman-key bug FS#45351
-        # https://bugs.archlinux.org/task/45351
-        # We have to kill gpg-agent because if it stays around we can't
-        # reliably unmount the target partition.
+    @staticmethod
+    def stop_gpg_agent():
+        """ Workaround for pacman-key bug FS#45351
+            https://bugs.archlinux.org/task/45351
+            We have to kill gpg-agent because if it stays around we can't
+            reliably unmount the target partition. """
         logging.debug("Stopping gpg agent...")
         chroot_call(['killall', '-9', 'gpg-agent'])
 
-        # FIXME: Temporary workaround for spl and zfs packages
+    def install_zfs_modules(self):
+        """ FIXME: Temporary workaround for spl and zfs packages """
         if self.method == "zfs":
             zfs_version = self.get_zfs_version()
             logging.debug("Installing zfs modules v%s...", zfs_version)
             chroot_call(['dkms', 'install', 'spl/{0}'.format(zfs_version)])
             chroot_call(['dkms', 'install', 'zfs/{0}'.format(zfs_version)])
 
+    def run_mkinitcpio(self):
+        """ Creates initial ramdisk """
         # Let's start without using hwdetect for mkinitcpio.conf.
         # It should work out of the box most of the time.
         # This way we don't have to fix deprecated hooks.
@@ -1295,10 +1370,11 @@ class Installation(object):
         self.queue_event('info', _("Configuring System Startup..."))
         mkinitcpio.run(DEST_DIR, self.settings, self.mount_devices, self.blvm)
 
+    def run_postinstall_script(self):
+        """ Calls post-install script to fine tune our setup """
         logging.debug("Running Cnchi post-install script")
         keyboard_layout = self.settings.get("keyboard_layout")
         keyboard_variant = self.settings.get("keyboard_variant")
-        # Call post-install script to fine tune our setup
         script_path_postinstall = os.path.join(
             self.settings.get('cnchi'),
             "scripts",
@@ -1306,10 +1382,10 @@ class Installation(object):
         cmd = [
             "/usr/bin/bash",
             script_path_postinstall,
-            username,
+            self.settings.get('username'),
             DEST_DIR,
             self.desktop,
-            locale,
+            self.settings.get("locale"),
             str(self.vbox),
             keyboard_layout]
         # Keyboard variant is optional
@@ -1319,46 +1395,110 @@ class Installation(object):
         call(cmd, timeout=300)
         logging.debug("Post install script completed successfully.")
 
-        # Patch user-dirs-update-gtk.desktop
-        self.patch_user_dirs_update_gtk()
-        logging.debug("File user-dirs-update-gtk.desktop patched.")
-
-        # Set lightdm config including autologin if selected
-        if self.desktop != "base":
-            self.setup_display_manager()
-
-        # Configure user features (firewall, libreoffice language pack, ...)
-        self.setup_features()
-
-        # Encrypt user's home directory if requested
+    def encrypt_home(self):
+        """ Encrypts user's home directory if requested """
         # FIXME: This is not working atm
         if self.settings.get('encrypt_home'):
             self.queue_event('info', _("Encrypting user home dir..."))
-            encfs.setup(username, DEST_DIR)
+            encfs.setup(self.settings.get('username'), DEST_DIR)
             logging.debug("User home dir encrypted")
 
-        # Install boot loader (always after running mkinitcpio)
-        if self.settings.get('bootloader_install'):
-            try:
-                self.queue_event('info', _("Installing bootloader..."))
-                from installation.boot import loader
-                boot_loader = loader.Bootloader(
-                    DEST_DIR,
-                    self.settings,
-                    self.mount_devices)
-                boot_loader.install()
-            except Exception as ex:
-                template = "Cannot install bootloader. An exception of type {0} occured. Arguments:\n{1!r}"
-                message = template.format(type(ex).__name__, ex.args)
-                logging.error(message)
+    def install_bootloader(self):
+        """ Installs boot loader """
+        if not self.settings.get('bootloader_install'):
+            return
+        try:
+            self.queue_event('info', _("Installing bootloader..."))
+            from installation.boot import loader
+            boot_loader = loader.Bootloader(
+                DEST_DIR,
+                self.settings,
+                self.mount_devices)
+            boot_loader.install()
+        except Exception as ex:
+            template = "Cannot install bootloader. An exception of type {0} occured. Arguments:\n{1!r}"
+            message = template.format(type(ex).__name__, ex.args)
+            logging.error(message)
 
-        # Create an initial database for mandb
-        self.queue_event('info', _("Updating man pages..."))
-        chroot_call(["mandb", "--quiet"])
+    def configure_system(self):
+        """ Final install steps
+            Set clock, language, timezone
+            Run mkinitcpio
+            Populate pacman keyring
+            Setup systemd services
+            ... and more
+
+            Steps run in parallel when they do not depend on each other.
+            Steps that use the same resource (systemctl, user accounts,
+            pacman.conf...) never run at the same time """
+
+        self.queue_event('pulse', 'start')
+        self.queue_event('info', _("Configuring your new system"))
+
+        self.auto_fstab()
+        logging.debug("fstab file generated.")
+
+        # If SSD was detected copy udev rule for deadline scheduler
+        if self.ssd:
+            self.set_scheduler()
+            logging.debug("SSD udev rule copied successfully")
+
+        scheduler = step_scheduler.StepScheduler()
+        add = scheduler.add
+
+        add('network', self.configure_network, resources=['systemctl'])
+        add('mirrorlist', self.copy_mirrorlist)
+        # Add Antergos repo to /etc/pacman.conf
+        add('pacman_conf', self.update_pacman_conf, depends=['mirrorlist'])
+        add('services', self.enable_default_services, resources=['systemctl'])
+        add('timesyncd', self.setup_timesyncd, resources=['systemctl'])
+        add('timezone', self.set_timezone)
+        add('locale', self.setup_locale)
+        add('clock', self.auto_timesetting)
+        add('root_skel', self.copy_root_skel)
+        add('fluidsynth', self.set_fluidsynth)
+        add('user_info', self.wait_user_info)
+        add('sudoers', self.setup_sudoers, depends=['user_info'])
+        add('hostname', self.set_hostname, depends=['user_info'])
+        # NOTE: Because hardware can need extra repos, this code must run
+        # always after having called the update_pacman_conf method
+        add('hardware', self.hardware_post_install,
+            depends=['pacman_conf'],
+            resources=['systemctl', 'accounts'])
+        # Drivers write their files into xorg.conf.d, keymap may create it.
+        # Keep the original order (hardware first) so both never race on it
+        add('keymap', self.setup_keymap, depends=['hardware'])
+        add('xorg_conf', self.copy_xorg_conf, depends=['hardware'])
+        add('user', self.setup_user,
+            depends=['user_info', 'root_skel'],
+            resources=['systemctl', 'accounts'])
+        add('gpg_agent', self.stop_gpg_agent, depends=['hardware'])
+        add('zfs_modules', self.install_zfs_modules)
+        # mkinitcpio reads vconsole.conf (keymap hook) and may need
+        # modules from hardware drivers
+        add('mkinitcpio', self.run_mkinitcpio,
+            depends=['keymap', 'hardware', 'zfs_modules'])
+        # The script writes in user's home, lightdm, X and /etc/skel files.
+        # It has always run once mkinitcpio had finished, keep it that way
+        add('postinstall', self.run_postinstall_script,
+            depends=['user', 'locale', 'keymap', 'xorg_conf', 'mkinitcpio'])
+        # The desktop file is patched after the script, as it always was
+        add('user_dirs_gtk', self.patch_user_dirs_update_gtk, depends=['postinstall'])
+        if self.desktop != "base":
+            # Set lightdm config including autologin if selected
+            add('display_manager', self.setup_display_manager, depends=['postinstall'])
+        # Configure user features (firewall, libreoffice language pack, ...)
+        add('features', self.setup_features,
+            depends=['postinstall'],
+            resources=['systemctl', 'accounts'])
+        add('encrypt_home', self.encrypt_home, depends=['postinstall'])
+        # Install boot loader (always after running mkinitcpio)
+        add('bootloader', self.install_bootloader, depends=['mkinitcpio', 'postinstall'])
+        # man pages and pkgfile databases are not needed to boot, the new
+        # system will create them in its first boot
+        add('deferred_tasks', deferred_tasks.setup, resources=['systemctl'])
 
-        # Initialise pkgfile (pacman .files metadata explorer) database
-        logging.debug("Updating pkgfile database")
-        chroot_call(["pkgfile", "--update"])
+        scheduler.run()
 
         # Copy installer log to the new installation
         logging.debug("Copying install log to /var/log.")
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  handle_pool.py
+#
+#  Copyright © 2013-2016 Antergos
+#
+#  This file is part of Cnchi.
+#
+#  Cnchi is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Cnchi is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  The following additional terms are in effect as per Section 7 of the license:
+#
+#  The preservation of all legal notices and author attributions in
+#  the material or in the Appropriate Legal Notices displayed
+#  by works containing it is required.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Cnchi; If not, see <http://www.gnu.org/licenses/>.
+
+
+""" Keeps one alpm handle (Pac object) for each pacman.conf file, so all
+    installation phases share it (and its already refreshed databases) """
+
+import logging
+import os
+import shutil
+import threading
+
+import installation.pacman.pac as pac
+import installation.pacman.pacman_conf as config
+
+
+def get_sync_dir(pacman_config):
+    """ Returns directory where sync databases are stored """
+    return os.path.join(pacman_config.options["DBPath"], "sync")
+
+
+class HandlePool(object):
+    """ Pac objects by pacman.conf path """
+
+    def __init__(self):
+        # path: (pacman.conf modification time, Pac object)
+        self.pacs = {}
+        self.lock = threading.Lock()
+
+    def get(self, conf_path, callback_queue=None):
+        """ Returns the Pac object of conf_path. It is created if there is
+            none or if conf_path has been modified since it was created """
+        path = os.path.realpath(conf_path)
+        if not os.path.exists(path):
+            # Let Pac raise its usual error
+            return pac.Pac(conf_path, callback_queue)
+
+        mtime = os.stat(path).st_mtime_ns
+        with self.lock:
+            entry = self.pacs.get(path)
+            if entry is not None:
+                old_mtime, pacman = entry
+                if old_mtime == mtime and pacman.get_handle() is not None:
+                    if callback_queue is not None:
+                        pacman.callback_queue = callback_queue
+                    return pacman
+                logging.debug("%s has changed, creating a new alpm handle", path)
+                pacman.release()
+                del self.pacs[path]
+
+            self.seed_sync_dbs(config.PacmanConfig(path))
+            pacman = pac.Pac(path, callback_queue)
+            self.pacs[path] = (mtime, pacman)
+            return pacman
+
+    def seed_sync_dbs(self, pacman_config):
+        """ Copies sync databases already refreshed by other handles
+            (same repository name) to pacman_config's database path.
+            Their modification time is kept, so refreshing them only asks
+            the server if there is something newer.
+            Must be called with self.lock held """
+        dst_dir = get_sync_dir(pacman_config)
+        for _mtime, pacman in self.pacs.values():
+            src_dir = get_sync_dir(pacman.get_config())
+            if os.path.realpath(src_dir) == os.path.realpath(dst_dir):
+                continue
+            for repo in pacman_config.repos:
+                if repo not in pacman.refreshed:
+                    continue
+                name = "{0}.db".format(repo)
+                src = os.path.join(src_dir, name)
+                dst = os.path.join(dst_dir, name)
+                if os.path.exists(dst) or not os.path.exists(src):
+                    continue
+                try:
+                    os.makedirs(dst_dir, mode=0o755, exist_ok=True)
+                    shutil.copy2(src, dst)
+                    logging.debug("Database %s copied from %s", name, src_dir)
+                except OSError as err:
+                    logging.warning("Can't copy database %s to %s: %s", src, dst_dir, err)
+
+    def release(self):
+        """ Releases all alpm handles """
+        with self.lock:
+            for _mtime, pacman in self.pacs.values():
+                pacman.release()
+            self.pacs = {}
+
+
+# All installation phases share the same handles
+HANDLE_POOL = HandlePool()
+
+
+def get_pac(conf_path="/etc/pacman.conf", callback_queue=None):
+    """ Returns the shared Pac object of conf_path """
+    return HANDLE_POOL.get(conf_path, callback_queue)
+
+
+def release():
+    """ Releases all shared alpm handles """
+    HANDLE_POOL.release()
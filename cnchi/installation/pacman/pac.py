@@ -38,6 +38,8 @@ import math
 import os
 import queue
 import inspect
+import re
+import time
 import traceback
 from collections import OrderedDict
 
@@ -59,6 +61,120 @@ except ImportError as err:
 _DEFAULT_ROOT_DIR = "/"
 _DEFAULT_DB_PATH = "/var/lib/pacman"
 
+# Packages of these groups must be installed from the antergos repo
+ONE_REPO_GROUPS = ['cinnamon', 'mate', 'mate-extra']
+ONE_REPO = 'antergos'
+
+# Separates a provision name from its version ("sh=5.0")
+_VERSION_SEPARATOR = re.compile(r'[<>=]')
+
+# Alpm log lines containing any of these are not shown in Cnchi's log
+_IGNORED_LOG_LINES = re.compile('|'.join(re.escape(partial) for partial in [
+    'error 0',
+    'error 32',
+    'extracting',
+    'error 31 from alpm_db_get_pkg',
+    'command failed to execute correctly',
+    'extract: skipping dir extraction',
+    'loading package data for']))
+
+# Maximum progress updates sent to the GUI per second
+PROGRESS_RATE = 10
+
+
+class ProgressThrottle(object):
+    """ Coalesces alpm progress callbacks (there is one for each few
+        kilobytes downloaded or extracted), so the GUI gets at most
+        PROGRESS_RATE updates per second. Progress is identified by a state
+        tuple (phase, done, total, package index, package count), so an
+        unchanged state is never sent twice """
+
+    def __init__(self, queue_event):
+        self.queue_event = queue_event
+        self.interval = 1 / PROGRESS_RATE
+        self.last_flush = 0
+        self.state = None
+        self.percent = 0
+        self.text = None
+        self.sent_state = None
+        self.sent_text = None
+
+    def update(self, state, percent, text=None):
+        """ Stores new progress. It is sent now if the text has changed
+            (a new package) or if enough time has passed since last one """
+        self.state = state
+        self.percent = percent
+        now = time.monotonic()
+        if text is not None and text != self.text:
+            self.text = text
+            self.flush(now)
+        elif now - self.last_flush >= self.interval:
+            self.flush(now)
+
+    def flush(self, now=None):
+        """ Sends pending progress (if any) """
+        if self.state is None or self.state == self.sent_state:
+            return
+        if self.text != self.sent_text:
+            self.queue_event('info', self.text)
+            self.sent_text = self.text
+        self.queue_event('percent', self.percent)
+        self.sent_state = self.state
+        self.last_flush = now or time.monotonic()
+
+
+class SyncIndex(object):
+    """ Name, provision and group lookup tables of all sync databases.
+        When more than one repo has a name, the first one in pacman.conf
+        wins (as pacman does) """
+
+    def __init__(self, pacman):
+        # name: package
+        self.names = {}
+        # provision name: package
+        self.provides = {}
+        # group name: packages (of the first repo that has the group)
+        self.groups = {}
+
+        one_repo_names = {}
+        for database in pacman.get_syncdbs():
+            groups = {}
+            repo_names = {}
+            for pkg in pacman.get_pkgcache(database):
+                repo_names[pkg.name] = pkg
+                self.names.setdefault(pkg.name, pkg)
+                for provision in pkg.provides:
+                    self.provides.setdefault(_VERSION_SEPARATOR.split(provision, 1)[0], pkg)
+                for group in pkg.groups:
+                    groups.setdefault(group, []).append(pkg)
+            for group, pkgs in groups.items():
+                self.groups.setdefault(group, pkgs)
+            if database.name == ONE_REPO:
+                for group in ONE_REPO_GROUPS:
+                    for pkg in groups.get(group, []):
+                        one_repo_names[pkg.name] = repo_names[pkg.name]
+
+        # Packages of ONE_REPO_GROUPS are sourced from ONE_REPO only
+        self.names.update(one_repo_names)
+
+        logging.debug(
+            "Sync index created (%d packages, %d provisions, %d groups)",
+            len(self.names),
+            len(self.provides),
+            len(self.groups))
+
+    def find_package(self, name):
+        """ Returns the package called name (or None) """
+        return self.names.get(name)
+
+    def find_group(self, name):
+        """ Returns the packages of group name (or None) """
+        return self.groups.get(name)
+
+    def find_provider(self, name):
+        """ Returns a package that provides name (or None) """
+        return self.provides.get(name)
+
 
 class Pac:
     """ Communicates with libalpm using pyalpm """
@@ -87,6 +203,20 @@ class Pac:
 
         self.last_event = {}
 
+        # Progress callbacks are sent to the GUI through this
+        self.progress = ProgressThrottle(self.queue_event)
+
+        # Sync databases and their package lists (see get_syncdbs and
+        # get_pkgcache), kept while databases are not updated
+        self.syncdbs = None
+        self.pkgcaches = {}
+
+        # Sync databases already refreshed using this handle
+        self.refreshed = set()
+
+        # Lookup tables of sync packages (see get_sync_index)
+        self.sync_index = None
+
         if not os.path.exists(conf_path):
             raise pyalpm.error
 
@@ -140,14 +270,38 @@ class Pac:
         # Downloading callback
         self.handle.fetchcb = None
 
+    def get_syncdbs(self):
+        """ Returns sync databases (in pacman.conf order) """
+        if self.syncdbs is None:
+            self.syncdbs = self.handle.get_syncdbs()
+        return self.syncdbs
+
+    def get_pkgcache(self, database):
+        """ Returns the packages of a sync database. pyalpm builds a new
+            list each time pkgcache is accessed, so it is stored here """
+        pkgcache = self.pkgcaches.get(database.name)
+        if pkgcache is None:
+            pkgcache = database.pkgcache
+            self.pkgcaches[database.name] = pkgcache
+        return pkgcache
+
+    def get_sync_index(self):
+        """ Returns lookup tables of sync packages (created once per handle
+            and each time a database is updated) """
+        if self.sync_index is None:
+            self.sync_index = SyncIndex(self)
+        return self.sync_index
+
     def release(self):
         """ Release alpm handle """
+        self.syncdbs = None
+        self.pkgcaches = {}
+        self.sync_index = None
         if self.handle is not None:
             del self.handle
             self.handle = None
 
-    @staticmethod
-    def finalize_transaction(transaction):
+    def finalize_transaction(self, transaction):
         """ Commit a transaction """
         all_ok = False
         try:
@@ -161,6 +315,8 @@ class Pac:
             logging.error(msg, pyalpm_error)
             traceback.print_exc()
         finally:
+            # Send last (throttled) progress update
+            self.progress.flush()
             logging.debug("Releasing alpm transaction...")
             transaction.release()
             logging.debug("Alpm transaction done.")
@@ -219,19 +375,31 @@ class Pac:
 
         return self.finalize_transaction(transaction)
 
-    def refresh(self):
-        """ Sync databases like pacman -Sy """
+    def refresh(self, force=False):
+        """ Sync databases like pacman -Sy (pacman -Syy if force is True).
+            If not forced, databases already refreshed with this handle are
+            skipped and the rest are only downloaded if the server has a
+            newer version (libalpm sends an If-Modified-Since header) """
         if self.handle is None:
             logging.error("alpm is not initialised")
             raise pyalpm.error
 
-        force = True
         res = True
-        for database in self.handle.get_syncdbs():
+        for database in self.get_syncdbs():
+            if not force and database.name in self.refreshed:
+                continue
             transaction = self.init_transaction()
             if transaction:
-                database.update(force)
+                updated = database.update(force)
                 transaction.release()
+                self.refreshed.add(database.name)
+                if updated:
+                    # Packages stored in the old list are no longer valid
+                    self.pkgcaches.pop(database.name, None)
+                    self.sync_index = None
+                    logging.debug("Database %s updated", database.name)
+                else:
+                    logging.debug("Database %s is up to date", database.name)
             else:
                 res = False
         return res
@@ -256,59 +424,48 @@ class Pac:
         # Discard duplicates
         pkgs = list(set(pkgs))
 
-        # `alpm.handle.get_syncdbs()` returns a list (the order is important) so we
-        # have to ensure we don't clobber the priority of the repos.
-        repos = OrderedDict()
-        repo_order = []
-        one_repo_groups = ['cinnamon', 'mate', 'mate-extra']
-        db_match = [db for db in self.handle.get_syncdbs() if 'antergos' == db.name]
-        antdb = OrderedDict()
-        antdb['antergos'] = db_match[0]
-        one_repo_groups = [antdb['antergos'].read_grp(one_repo_group)
-                           for one_repo_group in one_repo_groups]
-        one_repo_pkgs = {pkg for one_repo_group in one_repo_groups
-                         for pkg in one_repo_group[1] if one_repo_group}
-
-        for syncdb in self.handle.get_syncdbs():
-            repo_order.append(syncdb)
-            repos[syncdb.name] = syncdb
+        # The index respects the priority of the repos (and installs
+        # ONE_REPO_GROUPS packages from the antergos repo only)
+        sync_index = self.get_sync_index()
+        logging.debug('REPO DB ORDER IS: %s', self.get_syncdbs())
 
-        targets = []
-        logging.debug('REPO DB ORDER IS: %s', repo_order)
+        # name: sync package
+        targets = {}
 
         for name in pkgs:
-            _repos = repos
+            pkg = sync_index.find_package(name)
 
-            if name in one_repo_pkgs:
-                # pkg should be sourced from the antergos repo only.
-                _repos = antdb
-
-            result_ok, pkg = self.find_sync_package(name, _repos)
-
-            if result_ok:
+            if pkg is not None:
                 # Check that added package is not in our conflicts list
                 if pkg.name not in conflicts:
-                    targets.append(pkg.name)
+                    targets[pkg.name] = pkg
+                continue
+
+            # Couldn't find the package, check if it's a group
+            group_pkgs = sync_index.find_group(name)
+            if group_pkgs is not None:
+                # It's a group
+                for group_pkg in group_pkgs:
+                    # Check that added package is not in our conflicts list
+                    # Ex: connman conflicts with netctl(openresolv),
+                    # which is installed by default with base group
+                    if group_pkg.name not in conflicts:
+                        targets[group_pkg.name] = sync_index.find_package(group_pkg.name)
+                continue
+
+            # Last chance, a package that provides it
+            pkg = sync_index.find_provider(name)
+            if pkg is not None:
+                logging.debug("Package %s provides '%s'", pkg.name, name)
+                if pkg.name not in conflicts:
+                    targets.setdefault(pkg.name, pkg)
             else:
-                # Couldn't find the package, check if it's a group
-                group_pkgs = self.get_group_pkgs(name)
-                if group_pkgs is not None:
-                    # It's a group
-                    for group_pkg in group_pkgs:
-                        # Check that added package is not in our conflicts list
-                        # Ex: connman conflicts with netctl(openresolv),
-                        # which is installed by default with base group
-                        if group_pkg.name not in conflicts:
-                            targets.append(group_pkg.name)
-                else:
-                    # No, it wasn't neither a package nor a group. As we don't
-                    # know if this error is fatal or not, we'll register it and
-                    # we'll allow to continue.
-                    logging.error("Can't find a package or group called '%s'", name)
+                # No, it wasn't neither a package nor a group. As we don't
+                # know if this error is fatal or not, we'll register it and
+                # we'll allow to continue.
+                logging.error("Can't find a package or group called '%s'", name)
 
-        # Discard duplicates
-        targets = list(set(targets))
-        logging.debug(targets)
+        logging.debug(list(targets))
 
         if len(targets) == 0:
             logging.error("No targets found")
@@ -327,15 +484,48 @@ class Pac:
             logging.error("Can't initialize alpm transaction")
             return False
 
-        for i in range(0, num_targets):
-            result_ok, pkg = self.find_sync_package(targets.pop(), repos)
-            if result_ok:
-                transaction.add_pkg(pkg)
-            else:
-                logging.warning(pkg)
+        for pkg in targets.values():
+            transaction.add_pkg(pkg)
 
         return self.finalize_transaction(transaction)
 
+    def install_sync_pkgs(self, pkgs, options=None):
+        """ Install a list of already found sync packages (pyalpm objects).
+            Used to install packages in batches, so options usually
+            have 'mode' set to pyalpm.PKG_REASON_DEPEND """
+
+        if self.handle is None:
+            logging.error("alpm is not initialised")
+            raise pyalpm.error
+
+        if len(pkgs) == 0:
+            logging.error("Package list is empty")
+            raise pyalpm.error
+
+        self.total_packages_to_download = len(pkgs)
+
+        transaction = self.init_transaction(options)
+
+        if transaction is None:
+            logging.error("Can't initialize alpm transaction")
+            return False
+
+        for pkg in pkgs:
+            transaction.add_pkg(pkg)
+
+        return self.finalize_transaction(transaction)
+
+    def set_explicit(self, pkg_names):
+        """ Mark installed packages as explicitly installed
+            (like pacman -D --asexplicit) """
+        database = self.handle.get_localdb()
+        for pkg_name in pkg_names:
+            pkg = database.get_pkg(pkg_name)
+            if pkg is None:
+                logging.warning("Can't set install reason of %s, it is not installed", pkg_name)
+            else:
+                self.handle.set_pkgreason(pkg, pyalpm.PKG_REASON_EXPLICIT)
+
     def upgrade(self, pkgs, conflicts=None, options=None):
         """ Install a list package tarballs like pacman -U """
 
@@ -385,12 +575,7 @@ class Pac:
 
     def get_group_pkgs(self, group):
         """ Get group's packages """
-        for repo in self.handle.get_syncdbs():
-            grp = repo.read_grp(group)
-            if grp is not None:
-                name, pkgs = grp
-                return pkgs
-        return None
+        return self.get_sync_index().find_group(group)
 
     def get_packages_info(self, pkg_names=None):
         """ Get information about packages like pacman -Si """
@@ -399,14 +584,14 @@ class Pac:
         packages_info = {}
         if len(pkg_names) == 0:
             # Store info from all packages from all repos
-            for repo in self.handle.get_syncdbs():
-                for pkg in repo.pkgcache:
+            for repo in self.get_syncdbs():
+                for pkg in self.get_pkgcache(repo):
                     packages_info[pkg.name] = pkginfo.get_pkginfo(
                         pkg,
                         level=2,
                         style='sync')
         else:
-            repos = OrderedDict((database.name, database) for database in self.handle.get_syncdbs())
+            repos = OrderedDict((database.name, database) for database in self.get_syncdbs())
             for pkg_name in pkg_names:
                 result_ok, pkg = self.find_sync_package(pkg_name, repos)
                 if result_ok:
@@ -421,7 +606,7 @@ class Pac:
 
     def get_package_info(self, pkg_name):
         """ Get information about packages like pacman -Si """
-        repos = OrderedDict((database.name, database) for database in self.handle.get_syncdbs())
+        repos = OrderedDict((database.name, database) for database in self.get_syncdbs())
         result_ok, pkg = self.find_sync_package(pkg_name, repos)
         if result_ok:
             info = pkginfo.get_pkginfo(pkg, level=2, style='sync')
@@ -552,21 +737,7 @@ class Pac:
         # Log everything to cnchi-alpm.log
         self.logger.debug(line)
 
-        ignore = False
-        partials = ['error 0',
-                    'error 32',
-                    'extracting',
-                    'error 31 from alpm_db_get_pkg',
-                    'command failed to execute correctly',
-                    'extract: skipping dir extraction',
-                    'loading package data for']
-
-        for partial in partials:
-            if partial in line:
-                ignore = True
-                break
-
-        if ignore or not level:
+        if not level or _IGNORED_LOG_LINES.search(line):
             return
 
         if level == pyalpm.LOG_ERROR:
@@ -579,14 +750,12 @@ class Pac:
 
     def cb_progress(self, target, percent, total, current):
         """ Shows install progress """
+        state = ('install', percent, 100, current, total)
         if target:
             msg = _("Installing {0} ({1}/{2})").format(target, current, total)
-            self.queue_event('info', msg)
-            percent = current / total
-            self.queue_event('percent', percent)
+            self.progress.update(state, current / total, msg)
         else:
-            percent /= 100
-            self.queue_event('percent', percent)
+            self.progress.update(state, percent / 100)
 
     def cb_dl(self, filename, tx, total):
         """ Shows downloading progress """
@@ -612,8 +781,10 @@ class Pac:
                 # text = _("Downloading {0}... ({1}/{2})").format(filename, i, n)
                 text = _("Downloading {0}...").format(filename)
 
-            self.queue_event('info', text)
-            self.queue_event('percent', 0)
+            state = (
+                'download', tx, total,
+                self.downloaded_packages, self.total_packages_to_download)
+            self.progress.update(state, 0, text)
         else:
             # Compute a progress indicator
             if self.last_dl_total_size > 0:
@@ -625,19 +796,18 @@ class Pac:
             # Update progress only if it has grown
             if progress > self.last_dl_progress:
                 self.last_dl_progress = progress
-                self.queue_event('percent', progress)
+                state = (
+                    'download', tx, total,
+                    self.downloaded_packages, self.total_packages_to_download)
+                self.progress.update(state, progress)
+                if tx == total:
+                    # Do not leave the file unfinished in the GUI
+                    self.progress.flush()
 
     def is_package_installed(self, package_name):
         """ Check if package is already installed """
         database = self.handle.get_localdb()
-        pkgs = database.search(*[package_name])
-        names = []
-        for pkg in pkgs:
-            names.append(pkg.name)
-        if package_name in names:
-            return True
-        else:
-            return False
+        return database.get_pkg(package_name) is not None
 
     def setup_logger(self):
         """ Configure our logger """
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# pipeline.py
+#
+# Copyright © 2013-2016 Antergos
+#
+# This file is part of Cnchi.
+#
+# Cnchi is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cnchi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# The following additional terms are in effect as per Section 7 of the license:
+#
+# The preservation of all legal notices and author attributions in
+# the material or in the Appropriate Legal Notices displayed
+# by works containing it is required.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cnchi; If not, see <http://www.gnu.org/licenses/>.
+
+
+""" Installs packages while the rest of them are still being downloaded """
+
+import logging
+import re
+import threading
+
+try:
+    import pyalpm
+except ImportError:
+    pass
+
+# Separates a dependency name from its version ("glibc>=2.26")
+VERSION_SEPARATOR = re.compile(r'[<>=]')
+
+
+def get_dependency_name(dependency):
+    """ Returns the package name of a dependency (or provision) """
+    return VERSION_SEPARATOR.split(dependency, 1)[0]
+
+
+def get_components(graph):
+    """ Tarjan's algorithm (iterative version). Returns the strongly
+        connected components of graph (packages that depend on each other).
+        A component is always returned after the components it depends on """
+    index = {}
+    lowlink = {}
+    stack = []
+    on_stack = set()
+    components = []
+    counter = 0
+
+    for root in graph:
+        if root in index:
+            continue
+        index[root] = lowlink[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, iter(graph[root]))]
+        while work:
+            node, children = work[-1]
+            for child in children:
+                if child not in index:
+                    index[child] = lowlink[child] = counter
+                    counter += 1
+                    stack.append(child)
+                    on_stack.add(child)
+                    work.append((child, iter(graph[child])))
+                    break
+                elif child in on_stack:
+                    lowlink[node] = min(lowlink[node], index[child])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                if lowlink[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member == node:
+                            break
+                    components.append(component)
+    return components
+
+
+class InstallPipeline(object):
+    """ Sorts packages by dependency depth (level) so they can be downloaded
+        in that order. Each time all packages of the next levels have been
+        downloaded (and verified), they are installed in one transaction """
+
+    def __init__(self, pacman, metalinks):
+        self.pacman = pacman
+        self.metalinks = metalinks
+
+        # Sync package (pyalpm object) of each metalink
+        self.pkgs = self.get_sync_pkgs()
+
+        # Packages of each level (level 0 does not depend on any other)
+        self.level_pkgs = self.get_levels()
+        self.levels = {}
+        for level, identities in enumerate(self.level_pkgs):
+            for identity in identities:
+                self.levels[identity] = level
+
+        # Packages not downloaded yet in each level
+        self.pending = [len(identities) for identities in self.level_pkgs]
+
+        self.download_done = False
+        self.download_error = None
+        self.condition = threading.Condition()
+
+    def get_sync_pkgs(self):
+        """ Finds the sync package that will be downloaded for each metalink
+            (the one with the same file name) """
+        pkgs = {}
+        syncdbs = self.pacman.get_syncdbs()
+        for identity, element in self.metalinks.items():
+            for database in syncdbs:
+                pkg = database.get_pkg(identity)
+                if pkg is not None and pkg.filename == element.filename:
+                    pkgs[identity] = pkg
+                    break
+            else:
+                # It will be installed at the end, with the packages
+                # that are not part of the pipeline
+                logging.warning("Can't find sync package for %s", element.filename)
+        return pkgs
+
+    def get_levels(self):
+        """ Returns a list with the packages of each dependency level """
+        # Which package satisfies each name (package names first, provisions after)
+        providers = {identity: identity for identity in self.pkgs}
+        for identity, pkg in self.pkgs.items():
+            for provision in pkg.provides:
+                providers.setdefault(get_dependency_name(provision), identity)
+
+        graph = {}
+        for identity, pkg in self.pkgs.items():
+            dependencies = set()
+            for dependency in pkg.depends:
+                provider = providers.get(get_dependency_name(dependency))
+                if provider is not None and provider != identity:
+                    dependencies.add(provider)
+            graph[identity] = dependencies
+
+        levels = {}
+        level_pkgs = []
+        for component in get_components(graph):
+            members = set(component)
+            level = 0
+            for identity in component:
+                for dependency in graph[identity]:
+                    if dependency not in members:
+                        level = max(level, levels[dependency] + 1)
+            for identity in component:
+                levels[identity] = level
+            while len(level_pkgs) <= level:
+                level_pkgs.append([])
+            level_pkgs[level].extend(component)
+
+        logging.debug(
+            "%d packages sorted in %d dependency levels",
+            len(levels),
+            len(level_pkgs))
+        return level_pkgs
+
+    def get_download_order(self):
+        """ Returns the position of each package in the download queue """
+        return self.levels
+
+    def package_downloaded(self, element):
+        """ Called (from download threads) when a package is in the cache """
+        with self.condition:
+            level = self.levels.get(element.identity)
+            if level is not None:
+                self.pending[level] -= 1
+                self.condition.notify_all()
+
+    def download_finished(self, error=None):
+        """ Called when all downloads have finished (or failed) """
+        with self.condition:
+            self.download_done = True
+            self.download_error = error
+            self.condition.notify_all()
+
+    def run(self):
+        """ Installs packages as soon as their levels are downloaded.
+            Returns False if something fails """
+        installed_levels = 0
+        total_levels = len(self.level_pkgs)
+
+        while installed_levels < total_levels:
+            with self.condition:
+                while self.pending[installed_levels] > 0 and not self.download_done:
+                    self.condition.wait()
+                # All levels already downloaded go in the same transaction
+                last_level = installed_levels
+                while last_level < total_levels and self.pending[last_level] == 0:
+                    last_level += 1
+
+            if last_level == installed_levels:
+                # Download has finished before downloading this level
+                return False
+
+            batch = []
+            for level in range(installed_levels, last_level):
+                batch.extend(self.pkgs[identity] for identity in self.level_pkgs[level])
+
+            logging.debug(
+                "Installing %d packages (dependency levels %d to %d of %d)",
+                len(batch),
+                installed_levels,
+                last_level - 1,
+                total_levels)
+
+            # Install reason is fixed later (see Installation.install_packages_pipelined)
+            options = {'mode': pyalpm.PKG_REASON_DEPEND}
+            if not self.pacman.install_sync_pkgs(batch, options=options):
+                return False
+
+            installed_levels = last_level
+
+        return True
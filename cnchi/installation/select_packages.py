@@ -39,7 +39,7 @@ except ImportError as err:
 import desktop_info
 import info
 
-from installation import pacman as pac
+from installation.pacman import handle_pool
 import misc.extra as misc
 from misc.extra import InstallError
 
@@ -119,9 +119,9 @@ class SelectPackages(object):
     @misc.raise_privileges
     def refresh_pacman_databases(self):
         """ Updates pacman databases """
-        # Init pyalpm
+        # Init pyalpm (the handle is kept to create the download list)
         try:
-            pacman = pac.Pac("/etc/pacman.conf", self.callback_queue)
+            pacman = handle_pool.get_pac("/etc/pacman.conf", self.callback_queue)
         except Exception as ex:
             template = "Can't initialize pyalpm. An exception of type {0} occured. Arguments:\n{1!r}"
             message = template.format(type(ex).__name__, ex.args)
@@ -134,15 +134,6 @@ class SelectPackages(object):
             txt = _("Can't refresh pacman databases.")
             raise InstallError(txt)
 
-        try:
-            pacman.release()
-            del pacman
-        except Exception as ex:
-            template = "Can't release pyalpm. An exception of type {0} occured. Arguments:\n{1!r}"
-            message = template.format(type(ex).__name__, ex.args)
-            logging.error(message)
-            raise InstallError(message)
-
     def get_desktop_lib(self):
         """ Returns which widget library our desktop will need """
         for lib in desktop_info.LIBS:
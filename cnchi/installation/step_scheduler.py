@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# step_scheduler.py
+#
+# Copyright © 2013-2016 Antergos
+#
+# This file is part of Cnchi.
+#
+# Cnchi is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cnchi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# The following additional terms are in effect as per Section 7 of the license:
+#
+# The preservation of all legal notices and author attributions in
+# the material or in the Appropriate Legal Notices displayed
+# by works containing it is required.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cnchi; If not, see <http://www.gnu.org/licenses/>.
+
+
+""" Runs independent installation steps at the same time """
+
+import logging
+import queue
+import threading
+import time
+
+# Steps that can run at the same time
+MAX_WORKERS = 4
+
+
+class Step(object):
+    """ An installation step. It runs after the steps it depends on have
+        finished and while no other running step uses its resources """
+
+    def __init__(self, name, function, depends, resources):
+        self.name = name
+        self.function = function
+        self.depends = depends
+        self.resources = resources
+        self.start_time = None
+        self.end_time = None
+
+    def get_duration(self):
+        """ Returns wall time (in seconds) used by the step """
+        if self.start_time is None or self.end_time is None:
+            return 0
+        return self.end_time - self.start_time
+
+
+class StepWorker(threading.Thread):
+    """ Runs the steps it gets from the scheduler """
+
+    def __init__(self, scheduler, steps_queue):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.scheduler = scheduler
+        self.steps_queue = steps_queue
+
+    def run(self):
+        while True:
+            step = self.steps_queue.get()
+            if step is None:
+                break
+            error = None
+            step.start_time = time.monotonic()
+            try:
+                step.function()
+            except Exception as ex:
+                error = ex
+            step.end_time = time.monotonic()
+            self.scheduler.step_finished(step, error)
+
+
+class StepScheduler(object):
+    """ Runs steps in a worker pool, respecting their dependencies and
+        not running at the same time steps that share a resource
+        (a file, a database, a chroot tool that can't run twice...) """
+
+    def __init__(self, max_workers=MAX_WORKERS):
+        self.max_workers = max_workers
+        self.steps = []
+        self.steps_by_name = {}
+
+        self.pending = []
+        self.finished = set()
+        self.running = 0
+        self.busy_resources = set()
+        self.error = None
+        self.condition = threading.Condition()
+
+    def add(self, name, function, depends=None, resources=None):
+        """ Adds a step. Steps in depends must have been added before,
+            so the steps graph can't have cycles """
+        depends = tuple(depends or ())
+        for dependency in depends:
+            if dependency not in self.steps_by_name:
+                raise ValueError(
+                    "Step {0} depends on unknown step {1}".format(name, dependency))
+        if name in self.steps_by_name:
+            raise ValueError("Step {0} already exists".format(name))
+        step = Step(name, function, depends, frozenset(resources or ()))
+        self.steps.append(step)
+        self.steps_by_name[name] = step
+
+    def is_ready(self, step):
+        """ True if step can be started now. Must be called with
+            self.condition held """
+        for dependency in step.depends:
+            if dependency not in self.finished:
+                return False
+        return self.busy_resources.isdisjoint(step.resources)
+
+    def step_finished(self, step, error):
+        """ Called by workers when a step has finished """
+        with self.condition:
+            self.running -= 1
+            self.busy_resources -= step.resources
+            self.finished.add(step.name)
+            if error is not None and self.error is None:
+                logging.error("Step %s has failed: %s", step.name, error)
+                self.error = error
+            self.condition.notify_all()
+
+    def run(self):
+        """ Runs all steps. If a step fails, no more steps are started and
+            its exception is raised once the running ones have finished """
+        steps_queue = queue.Queue()
+        workers = []
+        for _index in range(min(self.max_workers, len(self.steps))):
+            worker = StepWorker(self, steps_queue)
+            worker.start()
+            workers.append(worker)
+
+        start_time = time.monotonic()
+        self.pending = list(self.steps)
+
+        with self.condition:
+            while self.running > 0 or (self.pending and self.error is None):
+                if self.error is None:
+                    # Start ready steps in the order they were added
+                    for step in list(self.pending):
+                        if self.running >= self.max_workers:
+                            break
+                        if self.is_ready(step):
+                            self.pending.remove(step)
+                            self.running += 1
+                            self.busy_resources |= step.resources
+                            steps_queue.put(step)
+                self.condition.wait()
+
+        for _worker in workers:
+            steps_queue.put(None)
+        for worker in workers:
+            worker.join()
+
+        self.log_times(time.monotonic() - start_time)
+
+        if self.error is not None:
+            raise self.error
+
+    def get_critical_path(self):
+        """ Returns the longest chain of dependent steps (the time the
+            steps would need with unlimited workers) and its duration """
+        paths = {}
+        for step in self.steps:
+            longest = ([], 0)
+            for dependency in step.depends:
+                if paths[dependency][1] > longest[1]:
+                    longest = paths[dependency]
+            paths[step.name] = (
+                longest[0] + [step.name],
+                longest[1] + step.get_duration())
+        if not paths:
+            return [], 0
+        return max(paths.values(), key=lambda path: path[1])
+
+    def log_times(self, wall_time):
+        """ Logs how much time each step has needed """
+        total_time = 0
+        for step in self.steps:
+            if step.end_time is not None:
+                total_time += step.get_duration()
+                logging.debug("Step %s took %.2f seconds", step.name, step.get_duration())
+        path, path_time = self.get_critical_path()
+        logging.debug(
+            "%d steps took %.2f seconds (%.2f seconds if run one after another)",
+            len(self.finished),
+            wall_time,
+            total_time)
+        logging.debug(
+            "Critical path (%.2f seconds): %s",
+            path_time,
+            " -> ".join(path))
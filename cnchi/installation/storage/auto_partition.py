@@ -362,6 +362,8 @@ class AutoPartition(object):
                 mode = 0o755
             os.chmod(path, mode)
 
+        # Device has a new filesystem
+        fs.invalidate_info()
         fs_uuid = fs.get_uuid(device)
         fs_label = fs.get_label(device)
         msg = "Device details: %s UUID=%s LABEL=%s"
@@ -742,6 +744,7 @@ class AutoPartition(object):
 
         # Wait until /dev initialized correct devices
         call(["udevadm", "settle"])
+        fs.invalidate_info()
 
         devices = self.get_devices()
 
@@ -29,10 +29,12 @@
 
 """ Functions to work with file systems """
 
+import json
 import subprocess
 import shlex
 import logging
 import os
+import threading
 
 import misc.extra as misc
 
@@ -45,6 +47,110 @@ NAMES = [
 
 COMMON_MOUNT_POINTS = ['/', '/boot', '/boot/efi', '/home', '/usr', '/var']
 
+# Kernel uevent counter. It changes each time a device is added, removed
+# or changed (a new partition table, a new filesystem...)
+_UEVENT_SEQNUM_PATH = "/sys/kernel/uevent_seqnum"
+
+# lsblk columns and the blkid tags they are returned as
+_BLKID_TAGS = {
+    'uuid': 'UUID',
+    'label': 'LABEL',
+    'fstype': 'TYPE',
+    'partuuid': 'PARTUUID',
+    'partlabel': 'PARTLABEL'}
+
+
+def get_uevent_seqnum():
+    """ Returns the kernel uevent sequence number (None if unknown) """
+    try:
+        with open(_UEVENT_SEQNUM_PATH) as seqnum_file:
+            return seqnum_file.read().strip()
+    except OSError:
+        return None
+
+
+class BlockDevices(object):
+    """ Block devices information, read from one lsblk call and kept
+        until a device changes (or invalidate is called) """
+
+    def __init__(self):
+        # device path: lsblk info
+        self.devices = {}
+        self.seqnum = None
+        self.valid = False
+        self.lock = threading.Lock()
+
+    def invalidate(self):
+        """ Forces reading devices again next time they are needed """
+        with self.lock:
+            self.valid = False
+
+    def is_valid(self):
+        """ False if devices have not been read yet or if udev has seen
+            changes since then. Must be called with self.lock held """
+        if not self.valid:
+            return False
+        seqnum = get_uevent_seqnum()
+        return seqnum is None or seqnum == self.seqnum
+
+    def get_devices(self):
+        """ Returns all block devices info, by path """
+        with self.lock:
+            if not self.is_valid():
+                if self.seqnum is not None:
+                    # Wait for udev to process the pending events so
+                    # lsblk gets up to date information
+                    call(["udevadm", "settle"], warning=False)
+                self.seqnum = get_uevent_seqnum()
+                self.devices = read_block_devices()
+                self.valid = True
+            return self.devices
+
+    def get(self, part):
+        """ Returns lsblk info of device part (empty if not found) """
+        devices = self.get_devices()
+        info = devices.get(part)
+        if info is None:
+            # part may be a symlink (/dev/AntergosVG/AntergosRoot...)
+            info = devices.get(os.path.realpath(part), {})
+        return info
+
+
+def add_block_devices(devices, entries):
+    """ Adds lsblk entries (and their children) to devices """
+    for entry in entries:
+        for key in ('name', 'kname', 'path'):
+            if entry.get(key):
+                devices[entry[key]] = entry
+        add_block_devices(devices, entry.get('children', []))
+
+
+@misc.raise_privileges
+def read_block_devices():
+    """ Reads all block devices info with just one lsblk call """
+    devices = {}
+    # -p: full device paths, -b: sizes in bytes, -O: all columns
+    cmd = ['lsblk', '-J', '-p', '-b', '-O']
+    try:
+        output = subprocess.check_output(cmd, stderr=subprocess.DEVNULL)
+        entries = json.loads(output.decode())['blockdevices']
+    except (OSError, subprocess.CalledProcessError, ValueError, KeyError) as err:
+        logging.warning("Can't read block devices info: %s", err)
+        return devices
+    add_block_devices(devices, entries)
+    return devices
+
+
+# All callers share the same devices information
+BLOCK_DEVICES = BlockDevices()
+
+
+def invalidate_info():
+    """ Devices information must be read again (a partition has been
+        created or formatted...) """
+    BLOCK_DEVICES.invalidate()
+
+
 def get_uuid(part):
     """ Get partition UUID """
     info = get_info(part)
@@ -70,60 +176,36 @@ def get_label(part):
         return ""
 
 
-@misc.raise_privileges
 def get_info(part):
-    """ Get partition info using blkid """
-
-    ret = ''
+    """ Get partition info (as blkid tags) """
     partdic = {}
-    # Do not try to get extended partition info
-    if part and not misc.is_partition_extended(part):
-        # -c /dev/null means no cache
-        cmd = ['blkid', '-c', '/dev/null', part]
-        call(cmd)
-
-        for info in ret.split():
-            if '=' in info:
-                info = info.split('=')
-                partdic[info[0]] = info[1].strip('"')
-
+    if part:
+        info = BLOCK_DEVICES.get(part)
+        for column, tag in _BLKID_TAGS.items():
+            if info.get(column):
+                partdic[tag] = info[column]
     return partdic
 
 
-@misc.raise_privileges
 def get_type(part):
-    """ Get filesystem type using blkid """
+    """ Get filesystem type """
     ret = ''
-    if part and not misc.is_partition_extended(part):
-        cmd = ['blkid', '-o', 'value', '-s', 'TYPE', part]
-        ret = call(cmd)
-
+    if part:
+        ret = BLOCK_DEVICES.get(part).get('fstype') or ''
     return ret
 
 
 def get_pknames():
     """ PKNAME: internal parent kernel device name """
     pknames = {}
-    info = None
-    cmd = ['lsblk', '-o', 'NAME,PKNAME', '-l']
-    info = call(cmd)
-    if info:
-        info = info.split('\n')
-        # skip header
-        info = info[1:]
-        skip_list = ["disk", "rom", "loop", "arch_root-image"]
-        for line in info:
-            skip_line = False
-            for skip in skip_list:
-                if skip in line:
-                    skip_line = True
-                    break
-            if not skip_line:
-                line = line.split()
-                try:
-                    pknames[line[0]] = line[1]
-                except IndexError as err:
-                    pass
+    skip_types = ["disk", "rom", "loop"]
+    for path, info in BLOCK_DEVICES.get_devices().items():
+        if path != info.get('name') or not info.get('pkname'):
+            continue
+        name = os.path.basename(path)
+        if info.get('type') in skip_types or name == "arch_root-image":
+            continue
+        pknames[name] = os.path.basename(info['pkname'])
     return pknames
 
 
@@ -152,6 +234,7 @@ def label_fs(fstype, part, label):
     if fstype in ladic:
         cmd = shlex.split(ladic[fstype] % vars())
         call(cmd)
+        invalidate_info()
     else:
         # Not being able to label a partition shouldn't worry us much
         logging.warning("Can't label %s (%s) with label %s", part, fstype, label)
@@ -237,7 +320,9 @@ def create_fs(part, fstype, label='', other_opts=''):
     cmd += " %(part)s"
 
     cmd = shlex.split(cmd % vars())
-    return call(cmd)
+    ret = call(cmd)
+    invalidate_info()
+    return ret
 
 
 @misc.raise_privileges
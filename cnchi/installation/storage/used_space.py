@@ -32,13 +32,265 @@
 import subprocess
 import shlex
 import logging
+import os
+import struct
 
 import misc.extra as misc
 
+# Bytes read at once when a bitmap or allocation table must be scanned
+_READ_CHUNK_SIZE = 1024 * 1024
+
+# Number of bits set in each byte value (int.bit_count needs Python 3.10)
+_BITS_SET = bytes(bin(value).count('1') for value in range(256))
+
+_EXT_SUPERBLOCK_OFFSET = 1024
+_EXT_MAGIC = 0xEF53
+_EXT_FEATURE_INCOMPAT_64BIT = 0x80
+
+_BTRFS_SUPERBLOCK_OFFSET = 0x10000
+_BTRFS_MAGIC = b'_BHRfS_M'
+
+_XFS_MAGIC = b'XFSB'
+
+_NTFS_OEM_ID = b'NTFS    '
+# $Bitmap is always the 7th MFT record
+_NTFS_BITMAP_RECORD = 6
+_NTFS_ATTR_DATA = 0x80
+_NTFS_ATTR_END = 0xFFFFFFFF
+# Update sequence entries protect 512 byte strides, whatever the sector size
+_NTFS_FIXUP_STRIDE = 512
+
+_FAT32_FSINFO_LEAD_SIG = 0x41615252
+_FAT32_FSINFO_STRUCT_SIG = 0x61417272
+_FAT32_FREE_UNKNOWN = 0xFFFFFFFF
+
+
+def read_at(fd, size, offset):
+    """ Reads exactly size bytes at offset (ValueError if it can't) """
+    data = os.pread(fd, size, offset)
+    if len(data) != size:
+        raise ValueError("Unexpected end of device")
+    return data
+
+
+def read_ext_used(fd):
+    """ Reads used space of an ext2/3/4 filesystem from its superblock """
+    sblock = read_at(fd, 1024, _EXT_SUPERBLOCK_OFFSET)
+    if struct.unpack_from('<H', sblock, 0x38)[0] != _EXT_MAGIC:
+        return None
+    blocks, free = struct.unpack_from('<I4xI', sblock, 0x04)
+    incompat = struct.unpack_from('<I', sblock, 0x60)[0]
+    if incompat & _EXT_FEATURE_INCOMPAT_64BIT:
+        blocks_hi, free_hi = struct.unpack_from('<I4xI', sblock, 0x150)
+        blocks |= blocks_hi << 32
+        free |= free_hi << 32
+    return (blocks - free) / blocks
+
+
+def read_btrfs_used(fd):
+    """ Reads used space of a btrfs filesystem from its superblock """
+    sblock = read_at(fd, 0x1000, _BTRFS_SUPERBLOCK_OFFSET)
+    if sblock[0x40:0x48] != _BTRFS_MAGIC:
+        return None
+    total, used = struct.unpack_from('<QQ', sblock, 0x70)
+    return used / total
+
+
+def read_xfs_used(fd):
+    """ Reads used space of a XFS filesystem from its primary superblock """
+    sblock = read_at(fd, 512, 0)
+    if sblock[0:4] != _XFS_MAGIC:
+        return None
+    blocks = struct.unpack_from('>Q', sblock, 8)[0]
+    free = struct.unpack_from('>Q', sblock, 144)[0]
+    return (blocks - free) / blocks
+
+
+def count_bits(fd, runs, cluster_size, nbits):
+    """ Counts set bits in the first nbits of a bitmap stored in runs
+        of (cluster, number of clusters) """
+    count = 0
+    remaining = (nbits + 7) // 8
+    for lcn, length in runs:
+        offset = lcn * cluster_size
+        run_size = min(length * cluster_size, remaining)
+        remaining -= run_size
+        while run_size > 0:
+            size = min(run_size, _READ_CHUNK_SIZE)
+            data = read_at(fd, size, offset)
+            if remaining == 0 and size == run_size and nbits % 8:
+                # Do not count bits past the end of the bitmap
+                data = data[:-1] + bytes([data[-1] & ((1 << (nbits % 8)) - 1)])
+            count += sum(data.translate(_BITS_SET))
+            offset += size
+            run_size -= size
+        if remaining == 0:
+            break
+    return count
+
+
+def get_ntfs_runs(attr):
+    """ Decodes the data runs (mapping pairs) of a non resident attribute """
+    runs = []
+    pos = struct.unpack_from('<H', attr, 0x20)[0]
+    lcn = 0
+    while pos < len(attr) and attr[pos] != 0:
+        header = attr[pos]
+        len_size = header & 0x0F
+        offset_size = header >> 4
+        pos += 1
+        length = int.from_bytes(attr[pos:pos + len_size], 'little')
+        pos += len_size
+        if offset_size == 0:
+            # Sparse run
+            raise ValueError("Sparse $Bitmap")
+        lcn += int.from_bytes(attr[pos:pos + offset_size], 'little', signed=True)
+        pos += offset_size
+        runs.append((lcn, length))
+    return runs
+
+
+def read_ntfs_used(fd):
+    """ Reads used space of a NTFS filesystem from its $Bitmap """
+    boot = read_at(fd, 512, 0)
+    if boot[3:11] != _NTFS_OEM_ID:
+        return None
+    sector_size, sectors_per_cluster = struct.unpack_from('<HB', boot, 0x0B)
+    total_sectors, mft_lcn = struct.unpack_from('<QQ', boot, 0x28)
+    record_clusters = struct.unpack_from('<b', boot, 0x40)[0]
+    cluster_size = sector_size * sectors_per_cluster
+    clusters = total_sectors // sectors_per_cluster
+    if record_clusters < 0:
+        record_size = 1 << -record_clusters
+    else:
+        record_size = record_clusters * cluster_size
+
+    offset = mft_lcn * cluster_size + _NTFS_BITMAP_RECORD * record_size
+    record = bytearray(read_at(fd, record_size, offset))
+    if record[0:4] != b'FILE':
+        return None
+
+    # Undo the update sequence (the last two bytes of each 512 bytes)
+    usa_offset, usa_count = struct.unpack_from('<HH', record, 4)
+    for index in range(1, usa_count):
+        end = index * _NTFS_FIXUP_STRIDE
+        if end > record_size:
+            break
+        pos = usa_offset + index * 2
+        record[end - 2:end] = record[pos:pos + 2]
+
+    pos = struct.unpack_from('<H', record, 0x14)[0]
+    while pos + 8 <= record_size:
+        attr_type, attr_len = struct.unpack_from('<II', record, pos)
+        if attr_type == _NTFS_ATTR_END or attr_len == 0:
+            break
+        if attr_type == _NTFS_ATTR_DATA and record[pos + 8]:
+            attr = bytes(record[pos:pos + attr_len])
+            used = count_bits(fd, get_ntfs_runs(attr), cluster_size, clusters)
+            return used / clusters
+        pos += attr_len
+    return None
+
+
+def count_free_fat_entries(fd, offset, fat_size, bits, clusters):
+    """ Counts free entries of a FAT table """
+    free = 0
+    if bits == 12:
+        table = read_at(fd, fat_size, offset)
+        for cluster in range(2, clusters + 2):
+            pos = cluster * 3 // 2
+            value = table[pos] | (table[pos + 1] << 8)
+            if cluster & 1:
+                value >>= 4
+            if value & 0xFFF == 0:
+                free += 1
+        return free
+
+    entry_size = bits // 8
+    mask = 0xFFFF if bits == 16 else 0x0FFFFFFF
+    unpack = struct.Struct('<H' if bits == 16 else '<I').iter_unpack
+    # Skip the two reserved entries
+    start = 2 * entry_size
+    end = (clusters + 2) * entry_size
+    while start < end:
+        size = min(end - start, _READ_CHUNK_SIZE)
+        for (value,) in unpack(read_at(fd, size, offset + start)):
+            if value & mask == 0:
+                free += 1
+        start += size
+    return free
+
+
+def read_fat_used(fd):
+    """ Reads used space of a FAT filesystem from its BPB (and FSInfo
+        sector or allocation table) """
+    boot = read_at(fd, 512, 0)
+    if boot[510:512] != b'\x55\xAA':
+        return None
+    (sector_size, sectors_per_cluster, reserved, num_fats, root_entries,
+     total_sectors, _media, fat_sectors) = struct.unpack_from('<HBHBHHBH', boot, 0x0B)
+    if not sector_size or not sectors_per_cluster or not num_fats:
+        return None
+    if total_sectors == 0:
+        total_sectors = struct.unpack_from('<I', boot, 0x20)[0]
+    fsinfo_sector = 0
+    if fat_sectors == 0:
+        fat_sectors, fsinfo_sector = struct.unpack_from('<I8xH', boot, 0x24)
+
+    root_sectors = (root_entries * 32 + sector_size - 1) // sector_size
+    data_start = reserved + num_fats * fat_sectors + root_sectors
+    clusters = (total_sectors - data_start) // sectors_per_cluster
+    if clusters <= 0:
+        return None
+    if clusters < 4085:
+        bits = 12
+    elif clusters < 65525:
+        bits = 16
+    else:
+        bits = 32
+
+    free = _FAT32_FREE_UNKNOWN
+    if bits == 32 and fsinfo_sector not in (0, 0xFFFF):
+        fsinfo = read_at(fd, 512, fsinfo_sector * sector_size)
+        lead_sig = struct.unpack_from('<I', fsinfo, 0)[0]
+        struct_sig, free = struct.unpack_from('<II', fsinfo, 484)
+        if lead_sig != _FAT32_FSINFO_LEAD_SIG or struct_sig != _FAT32_FSINFO_STRUCT_SIG:
+            free = _FAT32_FREE_UNKNOWN
+    if free == _FAT32_FREE_UNKNOWN or free > clusters:
+        # No (valid) free clusters count, read the allocation table
+        free = count_free_fat_entries(
+            fd, reserved * sector_size, fat_sectors * sector_size, bits, clusters)
+
+    cluster_size = sector_size * sectors_per_cluster
+    used = data_start * sector_size + (clusters - free) * cluster_size
+    return used / (total_sectors * sector_size)
+
+
+@misc.raise_privileges
+def read_used(part, reader):
+    """ Gets used space in part using reader (one of the read_*_used
+        functions). Returns None if it can't """
+    try:
+        fd = os.open(part, os.O_RDONLY)
+    except OSError as err:
+        logging.warning("Can't open %s: %s", part, err)
+        return None
+    try:
+        return reader(fd)
+    except (OSError, ValueError, ZeroDivisionError, struct.error) as err:
+        logging.warning("Can't read used space of %s: %s", part, err)
+        return None
+    finally:
+        os.close(fd)
+
 
 @misc.raise_privileges
 def get_used_ntfs(part):
     """ Gets used space in a NTFS partition """
+    used = read_used(part, read_ntfs_used)
+    if used is not None:
+        return used
+
     used = 0
     try:
         result = subprocess.check_output(["ntfsinfo", "-mf", part])
@@ -64,6 +316,10 @@ def get_used_ntfs(part):
 @misc.raise_privileges
 def get_used_ext(part):
     """ Gets used space in an ext4 partition """
+    used = read_used(part, read_ext_used)
+    if used is not None:
+        return used
+
     used = 0
     try:
         result = subprocess.check_output(["dumpe2fs", "-h", part])
@@ -89,6 +345,10 @@ def get_used_ext(part):
 @misc.raise_privileges
 def get_used_fat(part):
     """ Gets used space in a FAT partition """
+    used = read_used(part, read_fat_used)
+    if used is not None:
+        return used
+
     used = 0
     try:
         result = subprocess.check_output(["fsck.fat", "-n", "-v", part])
@@ -178,6 +438,10 @@ def get_used_reiser(part):
 @misc.raise_privileges
 def get_used_btrfs(part, show_error=True):
     """ Gets used space in a Btrfs partition """
+    used = read_used(part, read_btrfs_used)
+    if used is not None:
+        return used
+
     used = 0
     try:
         result = subprocess.check_output(["btrfs", "filesystem", "show", part])
@@ -218,6 +482,10 @@ def get_used_btrfs(part, show_error=True):
 @misc.raise_privileges
 def get_used_xfs(part):
     """ Gets used space in a XFS partition """
+    used = read_used(part, read_xfs_used)
+    if used is not None:
+        return used
+
     used = 0
     try:
         cmd = "xfs_db -c 'sb 0' -c 'print dblocks' -c 'print fdblocks' -r {0}"
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# cache.py
+#
+# Copyright © 2013-2016 Antergos
+#
+# This file is part of Cnchi.
+#
+# Cnchi is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cnchi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# The following additional terms are in effect as per Section 7 of the license:
+#
+# The preservation of all legal notices and author attributions in
+# the material or in the Appropriate Legal Notices displayed
+# by works containing it is required.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cnchi; If not, see <http://www.gnu.org/licenses/>.
+
+
+""" Stores parsed data in the user's cache folder, so it does not need
+    to be parsed again while its source files do not change """
+
+import logging
+import os
+import pickle
+
+CACHE_DIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+    'cnchi')
+
+
+def get_cache_path(name):
+    """ Returns the path of a cache file """
+    return os.path.join(CACHE_DIR, name)
+
+
+def load(cache_path, key):
+    """ Returns data stored in cache_path (None if it does not exist,
+        can't be read or was stored with another key) """
+    try:
+        with open(cache_path, 'rb') as cache_file:
+            cache_key, data = pickle.load(cache_file)
+    except (IOError, EOFError, ValueError, pickle.UnpicklingError) as err:
+        logging.debug("Cannot load cache %s: %s", cache_path, err)
+        return None
+    if cache_key != key:
+        logging.debug("Cache %s is out of date", cache_path)
+        return None
+    return data
+
+
+def save(cache_path, key, data):
+    """ Stores data (and the key it belongs to) in cache_path """
+    try:
+        os.makedirs(os.path.dirname(cache_path), mode=0o755, exist_ok=True)
+        tmp_path = cache_path + ".tmp"
+        with open(tmp_path, 'wb') as cache_file:
+            pickle.dump((key, data), cache_file, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, cache_path)
+    except IOError as err:
+        logging.warning("Cannot save cache %s: %s", cache_path, err)
@@ -21,6 +21,7 @@
 
 """ Parse base.xml """
 
+import hashlib
 import logging
 import os
 from gi.repository import GObject
@@ -31,6 +32,15 @@ try:
 except ImportError as err:
     import xml.etree.ElementTree as eTree
 
+try:
+    import misc.cache as cache
+except ImportError:
+    import cache
+
+# Parsed keyboard info is stored here
+KEYBOARD_CACHE_PATH = cache.get_cache_path('keyboard_names.cache')
+KEYBOARD_CACHE_VERSION = 1
+
 
 class Model(GObject.GObject):
     """ Represents a keyboard model """
@@ -60,19 +70,40 @@ class Variant(GObject.GObject):
 
 
 class Layout(GObject.GObject):
-    """ Keymap layout """
-    def __init__(self, name, short_description, description, language_list):
+    """ Keymap layout. Its variants are not created until they are needed """
+    def __init__(self, name, short_description, description, language_list,
+                 variant_entries=None):
         GObject.GObject.__init__(self)
         self.name = name
         self.short_description = short_description
         self.description = description
         self.language_list = language_list
-        self.variants = {}
+        # (name, short_description, description, language_list) of each variant
+        self._variant_entries = variant_entries or []
+        self._variants = None
 
     def __repr__(self):
         """ Return layout description """
         return self.description
 
+    @property
+    def variants(self):
+        """ Layout variants, by name """
+        if self._variants is None:
+            self._variants = OrderedDict(
+                (entry[0], Variant(*entry)) for entry in self._variant_entries)
+        return self._variants
+
+    @variants.setter
+    def variants(self, variants):
+        self._variants = variants
+
+    def has_variants(self):
+        """ Check if layout has variants (without creating them) """
+        if self._variants is None:
+            return bool(self._variant_entries)
+        return bool(self._variants)
+
     def add_variant(self, variant):
         """ Add new layout variant """
         self.variants[variant.name] = variant
@@ -83,11 +114,98 @@ class Layout(GObject.GObject):
             sorted(self.variants.items(), key=lambda t: str(t[1])))
 
 
+def get_item_text(config_item, tag, default=None):
+    """ Returns the text of the tag child of config_item """
+    item = config_item.find(tag)
+    if item is None:
+        return default
+    return item.text
+
+
+def get_item_languages(config_item):
+    """ Returns the languages of config_item """
+    return [lang.text for lang in config_item.iterfind('languageList/iso639Id')]
+
+
+def get_item_entry(config_item):
+    """ Returns (name, short_description, description, language_list) """
+    return (
+        get_item_text(config_item, 'name'),
+        get_item_text(config_item, 'shortDescription'),
+        get_item_text(config_item, 'description'),
+        get_item_languages(config_item))
+
+
+def read_base_xml(filename):
+    """ Reads models, layouts and variants from xkb base.xml file.
+        Layouts and variants are sorted by description """
+    xml_tree = eTree.parse(filename)
+    xml_root = xml_tree.getroot()
+
+    models = {}
+    for config_item in xml_root.iterfind('modelList/model/configItem'):
+        name = get_item_text(config_item, 'name', "")
+        models[name] = (
+            get_item_text(config_item, 'description', ""),
+            get_item_text(config_item, 'vendor', ""))
+
+    layouts = []
+    variants = {}
+    for layout in xml_root.iterfind('layoutList/layout'):
+        config_item = layout.find('configItem')
+        if config_item is None:
+            continue
+        entry = get_item_entry(config_item)
+        layouts.append(entry)
+        variant_entries = [
+            get_item_entry(variant_item)
+            for variant_item in layout.iterfind('variantList/variant/configItem')]
+        variant_entries.sort(key=lambda variant_entry: str(variant_entry[2]))
+        variants[entry[0]] = variant_entries
+    layouts.sort(key=lambda layout_entry: str(layout_entry[2]))
+
+    # Description: name indexes (first one found if repeated)
+    layout_names = {}
+    variant_names = {}
+    for entry in layouts:
+        layout_names.setdefault(str(entry[2]), entry[0])
+        for variant_entry in variants[entry[0]]:
+            variant_names.setdefault(str(variant_entry[2]), variant_entry[0])
+
+    return {
+        'models': models,
+        'layouts': layouts,
+        'variants': variants,
+        'layout_names': layout_names,
+        'variant_names': variant_names}
+
+
+def get_cache_key(filename):
+    """ Returns a key that changes when filename changes """
+    key = hashlib.sha256(str(KEYBOARD_CACHE_VERSION).encode())
+    with open(filename, 'rb') as xml_file:
+        key.update(xml_file.read())
+    return key.hexdigest()
+
+
+def load_keyboard_data(filename, cache_path=KEYBOARD_CACHE_PATH):
+    """ Returns keyboard info from cache (or from filename if the cache
+        does not exist or is out of date) """
+    key = get_cache_key(filename)
+    data = cache.load(cache_path, key)
+    if data is None:
+        data = read_base_xml(filename)
+        cache.save(cache_path, key, data)
+    return data
+
+
 class KeyboardNames(object):
     """ Read all keyboard info (models, layouts and variants) """
     def __init__(self, filename):
         self.models = None
         self.layouts = None
+        self._layout_names = {}
+        self._variant_names = {}
         self._filename = filename
         self._load_file()
 
@@ -95,79 +213,29 @@ class KeyboardNames(object):
         """ Clear all data """
         self.models = {}
         self.layouts = {}
+        self._layout_names = {}
+        self._variant_names = {}
 
     def _load_file(self):
-        """ Load info from xml file """
+        """ Load info from xml file (or from its cache) """
         if not os.path.exists(self._filename):
             logging.error("Can't find %s file!", self._filename)
             return
 
         self._clear()
 
-        xml_tree = eTree.parse(self._filename)
-        xml_root = xml_tree.getroot()
-
-        for model in xml_root.iter('model'):
-            for config_item in model.iter('configItem'):
-                model_name = ""
-                model_description = ""
-                model_vendor = ""
-                for item in config_item:
-                    if item.tag == "name":
-                        model_name = item.text
-                    elif item.tag == "description":
-                        model_description = item.text
-                    elif item.tag == "vendor":
-                        model_vendor = item.text
-                # Store model
-                self.models[model_name] = Model(
-                    model_name,
-                    model_description,
-                    model_vendor)
-
-        for layout in xml_root.iter('layout'):
-            for layout_item in layout:
-                layout_language_list = []
-                if layout_item.tag == "configItem":
-                    for item in layout_item:
-                        if item.tag == "name":
-                            layout_name = item.text
-                        elif item.tag == "shortDescription":
-                            layout_short_description = item.text
-                        elif item.tag == "description":
-                            layout_description = item.text
-                        elif item.tag == "languageList":
-                            for lang in item:
-                                layout_language_list.append(lang.text)
-                    self.layouts[layout_name] = Layout(
-                        layout_name,
-                        layout_short_description,
-                        layout_description,
-                        layout_language_list)
-
-                if layout_item.tag == "variantList":
-                    for variant in layout_item:
-                        variant_language_list = []
-                        for config_item in variant:
-                            for item in config_item:
-                                if item.tag == "name":
-                                    variant_name = item.text
-                                elif item.tag == "shortDescription":
-                                    variant_short_description = item.text
-                                elif item.tag == "description":
-                                    variant_description = item.text
-                                elif item.tag == "languageList":
-                                    for lang in item:
-                                        variant_language_list.append(lang.text)
-
-                            self.layouts[layout_name].add_variant(
-                                Variant(
-                                    variant_name,
-                                    variant_short_description,
-                                    variant_description,
-                                    variant_language_list))
-
-        self.sort_layouts()
+        data = load_keyboard_data(self._filename)
+
+        for name, (description, vendor) in data['models'].items():
+            self.models[name] = Model(name, description, vendor)
+
+        # Layouts are already sorted
+        self.layouts = OrderedDict()
+        for entry in data['layouts']:
+            self.layouts[entry[0]] = Layout(*entry, data['variants'][entry[0]])
+
+        self._layout_names = data['layout_names']
+        self._variant_names = data['variant_names']
 
     def sort_layouts(self):
         """ Sort stored layouts """
@@ -196,21 +264,18 @@ class KeyboardNames(object):
 
     def get_layout_by_description(self, description):
         """ Get layout by its description """
-        for name in self.layouts:
-            if description == str(self.layouts[name]):
-                return self.layouts[name]
-        return None
+        name = self.get_layout_name_by_description(description)
+        if name is None:
+            return None
+        return self.layouts[name]
 
     def get_layout_name_by_description(self, description):
         """ Get layout name by its description """
-        for name in self.layouts:
-            if description == str(self.layouts[name]):
-                return name
-        return None
+        return self._layout_names.get(description)
 
     def has_variants(self, name):
         """ Check if layout has variants """
-        return bool(self.layouts[name].variants)
+        return self.layouts[name].has_variants()
 
     def get_variants(self, name):
         """ Get layout variants """
@@ -233,11 +298,7 @@ class KeyboardNames(object):
 
     def get_variant_name_by_description(self, description):
         """ Get variant name by its description """
-        for layout_name in self.layouts:
-            for variant_name in self.layouts[layout_name].variants:
-                if description == str(self.layouts[layout_name].variants[variant_name]):
-                    return variant_name
-        return None
+        return self._variant_names.get(description)
 
 
 def test():
@@ -38,6 +38,8 @@ import math
 import sys
 import logging
 
+import cairo
+
 import gi
 gi.require_version('PangoCairo', '1.0')
 gi.require_version('Gtk', '3.0')
@@ -64,6 +66,16 @@ OLSEN_MAP_TIMEZONES_PATH = "/usr/share/cnchi/data/locale/timezones.xml"
 
 BUBBLE_TEXT_FONT = "Sans 9"
 
+# Bubble margins and corner radius
+BUBBLE_MARGIN_TOP = 12.0
+BUBBLE_MARGIN_BOTTOM = 12.0
+BUBBLE_MARGIN_START = 24.0
+BUBBLE_MARGIN_END = 24.0
+BUBBLE_ROUNDED = 9.0
+
+# Map surfaces (background plus an offset highlight) kept in memory
+MAP_SURFACES_CACHE_SIZE = 8
+
 # COLOR_CODES is (offset, red, green, blue, alpha)
 COLOR_CODES = [
     (-11.0, 43, 0, 0, 255),
@@ -105,6 +117,80 @@ COLOR_CODES = [
     (12.75, 254, 74, 100, 248),
     (13.0, 255, 85, 153, 250)]
 
+# (red, green, blue, alpha): offset (first one in COLOR_CODES if repeated)
+COLOR_OFFSETS = {
+    (red, green, blue, alpha): offset
+    for (offset, red, green, blue, alpha) in reversed(COLOR_CODES)}
+
+# Minimum size (in pixels) of the cells of the locations grid
+LOCATION_GRID_MIN_CELL_SIZE = 8
+
+
+class LocationGrid(object):
+    """ Locations projected to map coordinates and stored in a grid of
+        cells, so the nearest one to a point can be found checking only
+        the cells around it """
+
+    def __init__(self, locations, width, height):
+        self.width = width
+        self.height = height
+        # About one location per cell, whatever the map size is
+        self.cell_size = max(
+            LOCATION_GRID_MIN_CELL_SIZE,
+            int(math.sqrt(width * height / max(1, len(locations)))))
+        self.columns = max(1, int(math.ceil(width / self.cell_size)))
+        self.rows = max(1, int(math.ceil(height / self.cell_size)))
+
+        # (column, row): [(index, x, y, location)]
+        self.cells = {}
+        for index, location in enumerate(locations):
+            pointx = TimezoneMap.convert_longitude_to_x(
+                location.get_property('longitude'), width)
+            pointy = TimezoneMap.convert_latitude_to_y(
+                location.get_property('latitude'), height)
+            cell = self.get_cell(pointx, pointy)
+            self.cells.setdefault(cell, []).append((index, pointx, pointy, location))
+
+    def get_cell(self, x, y):
+        """ Returns the cell where point (x, y) is """
+        column = TimezoneMap.clamp(int(x // self.cell_size), 0, self.columns - 1)
+        row = TimezoneMap.clamp(int(y // self.cell_size), 0, self.rows - 1)
+        return column, row
+
+    def get_ring(self, column, row, radius):
+        """ Yields the cells at radius cells from (column, row) """
+        if radius == 0:
+            yield column, row
+            return
+        for cell_column in range(column - radius, column + radius + 1):
+            yield cell_column, row - radius
+            yield cell_column, row + radius
+        for cell_row in range(row - radius + 1, row + radius):
+            yield column - radius, cell_row
+            yield column + radius, cell_row
+
+    def find_nearest(self, x, y):
+        """ Returns the nearest location to point (x, y) """
+        column, row = self.get_cell(x, y)
+        # (distance, index, location)
+        nearest = None
+        max_radius = max(self.columns, self.rows)
+        for radius in range(max_radius + 1):
+            for cell in self.get_ring(column, row, radius):
+                for index, pointx, pointy, location in self.cells.get(cell, []):
+                    dx = pointx - x
+                    dy = pointy - y
+                    dist = dx * dx + dy * dy
+                    # On a tie, keep the first location (as a linear search would)
+                    if nearest is None or (dist, index) < nearest[:2]:
+                        nearest = (dist, index, location)
+            # Points in cells further away are, at least, radius cells away
+            if nearest is not None and nearest[0] <= (radius * self.cell_size) ** 2:
+                break
+        if nearest is None:
+            return None
+        return nearest[2]
+
 
 class TimezoneMap(Gtk.Widget):
     """ CnchiWidget that allows to select user's timezone """
@@ -125,9 +211,22 @@ class TimezoneMap(Gtk.Widget):
         self._show_offset = False
 
         self._tz_location = None
+        self._location_grid = None
 
         self._bubble_text = ""
 
+        # Location under the pointer (shown instead of the selected one)
+        self._preview_location = None
+        self._preview_text = ""
+        self._dragging = False
+
+        # Background with the offset highlight, by (offset, sensitive)
+        self._map_surfaces = {}
+        # Offset (taking DST into account) of each location
+        self._location_offsets = {}
+        # Area used by the pin and the bubble the last time they were drawn
+        self._overlay_rect = None
+
         self.olsen_map_timezones = []
         self.load_olsen_map_timezones()
 
@@ -207,6 +306,9 @@ class TimezoneMap(Gtk.Widget):
                 allocation.height,
                 GdkPixbuf.InterpType.BILINEAR)
 
+        self._map_surfaces = {}
+        self._overlay_rect = None
+
         if self._color_map is not None:
             del self._color_map
             self._color_map = None
@@ -219,6 +321,13 @@ class TimezoneMap(Gtk.Widget):
         # self._visible_map_pixels = self._color_map.get_pixels()
         # self._visible_map_rowstride = self._color_map.get_rowstride()
 
+        grid = self._location_grid
+        if grid is None or (grid.width, grid.height) != (allocation.width, allocation.height):
+            self._location_grid = LocationGrid(
+                self.tzdb.get_locations(),
+                allocation.width,
+                allocation.height)
+
         if self.get_realized():
             self.get_window().move_resize(
                 allocation.x,
@@ -242,7 +351,10 @@ class TimezoneMap(Gtk.Widget):
         attr.event_mask = (
             self.get_events() |
             Gdk.EventMask.EXPOSURE_MASK |
-            Gdk.EventMask.BUTTON_PRESS_MASK)
+            Gdk.EventMask.BUTTON_PRESS_MASK |
+            Gdk.EventMask.BUTTON_RELEASE_MASK |
+            Gdk.EventMask.POINTER_MOTION_MASK |
+            Gdk.EventMask.LEAVE_NOTIFY_MASK)
         wat = Gdk.WindowAttributesType
         mask = wat.X | wat.Y | wat.VISUAL
         window = Gdk.Window(self.get_parent_window(), attr, mask)
@@ -256,34 +368,25 @@ class TimezoneMap(Gtk.Widget):
 
         self.set_window(window)
 
-    def draw_text_bubble(self, cr, pointx, pointy):
-        """ Draw bubble with information text """
-        margin_top = 12.0
-        margin_bottom = 12.0
-        margin_start = 24.0
-        margin_end = 24.0
-
-        # Corner radius
-        rounded = 9.0
-
-        if not self._bubble_text:
-            return
-
-        alloc = self.get_allocation()
-
-        layout = PangoCairo.create_layout(cr)
-
+    def create_bubble_layout(self, text):
+        """ Creates the pango layout of the bubble text """
+        layout = self.create_pango_layout()
         font_description = Pango.font_description_from_string(BUBBLE_TEXT_FONT)
         layout.set_font_description(font_description)
-
         layout.set_alignment(Pango.Alignment.CENTER)
         layout.set_spacing(3)
-        layout.set_markup(self._bubble_text)
+        layout.set_markup(text)
+        return layout
+
+    def get_bubble_rect(self, layout, pointx, pointy):
+        """ Returns bubble position and size (x, y, width, height) """
+        alloc = self.get_allocation()
+
         (ink_rect, logical_rect) = layout.get_pixel_extents()
 
         # Calculate the bubble size based on the text layout size
-        width = logical_rect.width + margin_start + margin_end
-        height = logical_rect.height + margin_top + margin_bottom
+        width = logical_rect.width + BUBBLE_MARGIN_START + BUBBLE_MARGIN_END
+        height = logical_rect.height + BUBBLE_MARGIN_TOP + BUBBLE_MARGIN_BOTTOM
 
         if pointx < alloc.width / 2:
             x = pointx + 20
@@ -296,6 +399,60 @@ class TimezoneMap(Gtk.Widget):
         x = self.clamp(x, 0, alloc.width - width)
         y = self.clamp(y, 0, alloc.height - height)
 
+        return x, y, width, height
+
+    def get_location_point(self, location):
+        """ Returns location coordinates in the map """
+        alloc = self.get_allocation()
+        longitude = location.get_property('longitude')
+        latitude = location.get_property('latitude')
+
+        pointx = self.convert_longitude_to_x(longitude, alloc.width)
+        pointy = self.convert_latitude_to_y(latitude, alloc.height)
+
+        # pointx = self.clamp(math.floor(pointx), 0, alloc.width)
+        # pointy = self.clamp(math.floor(pointy), 0, alloc.height)
+
+        if pointy > alloc.height:
+            pointy = alloc.height
+
+        return pointx, pointy
+
+    def get_overlay_rect(self, location, text):
+        """ Returns the area (x, y, width, height) used by the pin and
+            the bubble of location """
+        pointx, pointy = self.get_location_point(location)
+        rects = []
+        if text:
+            layout = self.create_bubble_layout(text)
+            rects.append(self.get_bubble_rect(layout, pointx, pointy))
+        if self._pin is not None:
+            rects.append((
+                pointx - PIN_HOT_POINT_X,
+                pointy - PIN_HOT_POINT_Y,
+                self._pin.get_width(),
+                self._pin.get_height()))
+        if not rects:
+            return None
+        # Add a pixel around it, for antialiasing
+        left = int(math.floor(min(rect[0] for rect in rects))) - 1
+        top = int(math.floor(min(rect[1] for rect in rects))) - 1
+        right = int(math.ceil(max(rect[0] + rect[2] for rect in rects))) + 1
+        bottom = int(math.ceil(max(rect[1] + rect[3] for rect in rects))) + 1
+        return left, top, right - left, bottom - top
+
+    def draw_text_bubble(self, cr, pointx, pointy, text=None):
+        """ Draw bubble with information text """
+        if text is None:
+            text = self._bubble_text
+
+        if not text:
+            return
+
+        layout = self.create_bubble_layout(text)
+        x, y, width, height = self.get_bubble_rect(layout, pointx, pointy)
+        rounded = BUBBLE_ROUNDED
+
         cr.save()
         cr.translate(x, y)
 
@@ -312,89 +469,155 @@ class TimezoneMap(Gtk.Widget):
 
         # And finally draw the text
         cr.set_source_rgb(1, 1, 1)
-        cr.move_to(margin_start, margin_top)
+        cr.move_to(BUBBLE_MARGIN_START, BUBBLE_MARGIN_TOP)
         PangoCairo.show_layout(cr, layout)
         cr.restore()
 
-    def do_draw(self, cr):
-        """ Draw widget """
-        alloc = self.get_allocation()
-
-        # Paint background
-        if self._background is not None:
-            Gdk.cairo_set_source_pixbuf(cr, self._background, 0, 0)
-            cr.paint()
-
-        if not self._show_offset:
-            return
-
-        # Paint highlight
-        offset = self._selected_offset
-
-        if self.is_sensitive():
+    def get_highlight(self, offset, sensitive):
+        """ Returns offset highlight scaled to the widget size (None if
+            it can't be loaded) """
+        if sensitive:
             filename = "timezone_%g.png" % offset
         else:
             filename = "timezone_%g_dim.png" % offset
 
         path = os.path.join(TIMEZONEMAP_IMAGES_PATH, filename)
+        alloc = self.get_allocation()
         try:
             orig_highlight = GdkPixbuf.Pixbuf.new_from_file(path)
         except Exception as ex:
             print("Can't load {0} image file".format(path))
             print(ex)
-            return
+            return None
 
-        highlight = orig_highlight.scale_simple(
+        return orig_highlight.scale_simple(
             alloc.width,
             alloc.height,
             GdkPixbuf.InterpType.BILINEAR)
 
-        Gdk.cairo_set_source_pixbuf(cr, highlight, 0, 0)
+    def get_map_surface(self, offset):
+        """ Returns a surface with the background and the highlight of
+            offset (if it is not None) already painted """
+        sensitive = self.is_sensitive()
+        key = (offset, sensitive)
+        surface = self._map_surfaces.pop(key, None)
+        if surface is None:
+            if len(self._map_surfaces) >= MAP_SURFACES_CACHE_SIZE:
+                # Forget the least recently used one
+                del self._map_surfaces[next(iter(self._map_surfaces))]
+            alloc = self.get_allocation()
+            surface = self.get_window().create_similar_surface(
+                cairo.CONTENT_COLOR_ALPHA,
+                alloc.width,
+                alloc.height)
+            cr = cairo.Context(surface)
+
+            if self._background is not None:
+                Gdk.cairo_set_source_pixbuf(cr, self._background, 0, 0)
+                cr.paint()
+
+            if offset is not None:
+                highlight = self.get_highlight(offset, sensitive)
+                if highlight is not None:
+                    Gdk.cairo_set_source_pixbuf(cr, highlight, 0, 0)
+                    cr.paint()
+
+        # Most recently used surfaces are kept at the end
+        self._map_surfaces[key] = surface
+        return surface
+
+    def get_shown_location(self):
+        """ Returns the location that is shown in the map (the one under
+            the pointer or, if none, the selected one), its offset and
+            its bubble text """
+        if self._preview_location is not None:
+            return (
+                self._preview_location,
+                self.get_location_offset(self._preview_location),
+                self._preview_text)
+        if not self._show_offset:
+            return None, None, ""
+        return self._tz_location, self._selected_offset, self._bubble_text
+
+    def do_draw(self, cr):
+        """ Draw widget """
+        location, offset, text = self.get_shown_location()
+
+        # Paint background and highlight. Only the invalidated area is
+        # painted, as cairo context is already clipped to it
+        cr.set_source_surface(self.get_map_surface(offset), 0, 0)
         cr.paint()
 
-        del highlight
-        del orig_highlight
+        if location is None:
+            self._overlay_rect = None
+            return
 
-        if self._tz_location:
-            longitude = self._tz_location.get_property('longitude')
-            latitude = self._tz_location.get_property('latitude')
+        pointx, pointy = self.get_location_point(location)
 
-            pointx = self.convert_longitude_to_x(longitude, alloc.width)
-            pointy = self.convert_latitude_to_y(latitude, alloc.height)
+        # Draw text bubble
+        self.draw_text_bubble(cr, pointx, pointy, text)
 
-            # pointx = self.clamp(math.floor(pointx), 0, alloc.width)
-            # pointy = self.clamp(math.floor(pointy), 0, alloc.height)
+        # Draw pin
+        if self._pin is not None:
+            Gdk.cairo_set_source_pixbuf(
+                cr,
+                self._pin,
+                pointx - PIN_HOT_POINT_X,
+                pointy - PIN_HOT_POINT_Y)
+            cr.paint()
 
-            if pointy > alloc.height:
-                pointy = alloc.height
+        self._overlay_rect = self.get_overlay_rect(location, text)
 
-            # Draw text bubble
-            self.draw_text_bubble(cr, pointx, pointy)
+    def queue_draw_overlay(self, old_offset):
+        """ Redraws the pin and the bubble. If the highlighted offset has
+            changed, the whole map is redrawn """
+        location, offset, text = self.get_shown_location()
+        if offset != old_offset or self._overlay_rect is None:
+            self.queue_draw()
+            return
 
-            # Draw pin
-            if self._pin is not None:
-                Gdk.cairo_set_source_pixbuf(
-                    cr,
-                    self._pin,
-                    pointx - PIN_HOT_POINT_X,
-                    pointy - PIN_HOT_POINT_Y)
-                cr.paint()
+        # Old pin and bubble must be erased
+        self.queue_draw_area(*self._overlay_rect)
+        if location is not None:
+            rect = self.get_overlay_rect(location, text)
+            if rect is not None:
+                self.queue_draw_area(*rect)
 
-    def set_location(self, tz_location):
-        """ Set map location """
-        self._tz_location = tz_location
+    def set_preview_location(self, location):
+        """ Shows location (None to show the selected one again) """
+        if location is self._preview_location:
+            return
+        old_offset = self.get_shown_location()[1]
+        self._preview_location = location
+        if location is not None:
+            self._preview_text = self.get_bubble_text(location)
+        else:
+            self._preview_text = ""
+        self.queue_draw_overlay(old_offset)
 
-        if tz_location is not None:
-            info = self._tz_location.get_info()
+    def get_location_offset(self, location):
+        """ Returns location UTC offset (in hours) as used by the map """
+        offset = self._location_offsets.get(location.zone)
+        if offset is None:
+            info = location.get_info()
 
             daylight_offset = 0
 
-            if self._tz_location.is_dst():
+            if location.is_dst():
                 if info.get_daylight() == 1:
                     daylight_offset = -1.0
 
-            seconds = tz_location.get_utc_offset().total_seconds()
-            self._selected_offset = seconds / 3600.0 + daylight_offset
+            seconds = location.get_utc_offset().total_seconds()
+            offset = seconds / 3600.0 + daylight_offset
+            self._location_offsets[location.zone] = offset
+        return offset
+
+    def set_location(self, tz_location):
+        """ Set map location """
+        self._tz_location = tz_location
+
+        if tz_location is not None:
+            self._selected_offset = self.get_location_offset(tz_location)
 
             self.emit("location-changed", self._tz_location)
 
@@ -412,64 +635,72 @@ class TimezoneMap(Gtk.Widget):
         rowstride = self._color_map.get_rowstride()
         pixels = self._color_map.get_pixels()
 
-        my_red = pixels[int(rowstride * y + x * 4)]
-        my_green = pixels[int(rowstride * y + x * 4) + 1]
-        my_blue = pixels[int(rowstride * y + x * 4) + 2]
-        my_alpha = pixels[int(rowstride * y + x * 4) + 3]
-
-        for color_code in COLOR_CODES:
-            (offset, red, green, blue, alpha) = color_code
-            if (red == my_red and
-                    green == my_green and
-                    blue == my_blue and
-                    alpha == my_alpha):
-                self._selected_offset = offset
-                break
+        pos = int(rowstride * y + x * 4)
+        color = tuple(pixels[pos:pos + 4])
 
-        self.queue_draw()
+        offset = COLOR_OFFSETS.get(color)
+        if offset is not None:
+            self._selected_offset = offset
 
-        # Work out the co-ordinates
-        allocation = self.get_allocation()
-        width = allocation.width
-        height = allocation.height
-
-        nearest_tz_location = None
-
-        # Impossible distance
-        small_dist = -1
+        self.queue_draw()
 
-        for tz_location in self.tzdb.get_locations():
-            longitude = tz_location.get_property('longitude')
-            latitude = tz_location.get_property('latitude')
+        return self.get_nearest_location(x, y)
 
-            pointx = self.convert_longitude_to_x(longitude, width)
-            pointy = self.convert_latitude_to_y(latitude, height)
+    def get_nearest_location(self, x, y):
+        """ Returns the nearest location to map position (x, y) """
+        allocation = self.get_allocation()
+        grid = self._location_grid
+        if grid is None or (grid.width, grid.height) != (allocation.width, allocation.height):
+            grid = LocationGrid(
+                self.tzdb.get_locations(),
+                allocation.width,
+                allocation.height)
+            self._location_grid = grid
 
-            dx = pointx - x
-            dy = pointy - y
+        return grid.find_nearest(x, y)
 
-            dist = dx * dx + dy * dy
+    def select_location_at(self, x, y):
+        """ Selects the nearest location to map position (x, y) """
+        self._preview_location = None
+        self._preview_text = ""
 
-            if small_dist == -1 or dist < small_dist:
-                nearest_tz_location = tz_location
-                small_dist = dist
+        nearest_tz_location = self.get_loc_for_xy(x, y)
 
-        return nearest_tz_location
+        if nearest_tz_location is not None:
+            self.set_bubble_text(nearest_tz_location)
+            self.set_location(nearest_tz_location)
+            self.queue_draw()
 
     def do_button_press_event(self, event):
         """ The button press event virtual method """
 
         # Make sure it was the first button
         if event.button == 1:
-            x = int(event.x)
-            y = int(event.y)
+            self._dragging = True
+            self.select_location_at(int(event.x), int(event.y))
+        return True
+
+    def do_button_release_event(self, event):
+        """ Selects the location where the pointer was dragged to """
+        if event.button == 1 and self._dragging:
+            self._dragging = False
+            if self._preview_location is not None:
+                self.select_location_at(int(event.x), int(event.y))
+        return True
 
-            nearest_tz_location = self.get_loc_for_xy(x, y)
+    def do_motion_notify_event(self, event):
+        """ Previews the nearest location to the pointer """
+        location = self.get_nearest_location(event.x, event.y)
+        if not self._dragging and location is self._tz_location:
+            # Selected location is already shown
+            location = None
+        self.set_preview_location(location)
+        return True
 
-            if nearest_tz_location is not None:
-                self.set_bubble_text(nearest_tz_location)
-                self.set_location(nearest_tz_location)
-                self.queue_draw()
+    def do_leave_notify_event(self, event):
+        """ Shows the selected location again """
+        if not self._dragging:
+            self.set_preview_location(None)
         return True
 
     def set_timezone(self, time_zone):
@@ -496,18 +727,23 @@ class TimezoneMap(Gtk.Widget):
 
         return ret
 
-    def set_bubble_text(self, location):
-        """ Set text that will be shown inside a bubble """
+    @staticmethod
+    def get_bubble_text(location):
+        """ Returns the text shown inside the bubble of location """
         tzinfo = location.get_info()
         dt_now = datetime.now(tzinfo)
         current_time = "%02d:%02d" % (dt_now.hour, dt_now.minute)
         city_name = location.get_info().tzname("").split("/")[1]
         city_name = city_name.replace("_", " ")
         country_name = location.get_property('human_country')
-        self._bubble_text = "{0}, {1}\n{2}".format(
+        return "{0}, {1}\n{2}".format(
             city_name,
             country_name,
             current_time)
+
+    def set_bubble_text(self, location):
+        """ Set text that will be shown inside a bubble """
+        self._bubble_text = self.get_bubble_text(location)
         self.queue_draw()
 
     def get_location(self):
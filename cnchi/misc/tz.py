@@ -32,11 +32,28 @@ import xml.dom.minidom
 import hashlib
 import logging
 
+try:
+    import zoneinfo
+except ImportError:
+    # Python < 3.9
+    zoneinfo = None
+
 from gi.repository import GObject, GLib
 
+try:
+    import misc.cache as cache
+except ImportError:
+    import cache
+
+ZONEINFO_PATH = '/usr/share/zoneinfo'
 TZ_DATA_FILE = '/usr/share/zoneinfo/zone.tab'
+TZ_VERSION_FILE = '/usr/share/zoneinfo/tzdata.zi'
 ISO_3166_FILE = '/usr/share/xml/iso-codes/iso_3166.xml'
 
+# Locations read from TZ_DATA_FILE and ISO_3166_FILE are stored here
+TZ_CACHE_PATH = cache.get_cache_path('tz.cache')
+TZ_CACHE_VERSION = 1
+
 
 def _seconds_since_epoch(my_datetime):
     # TODO cjwatson 2006-02-23: %s escape is not portable
@@ -247,13 +264,58 @@ class Location(object):
         self.longitude = _parse_position(longitude, 3)
 
         # Grab md5sum of the timezone file for later comparison
-        try:
-            zone_path = os.path.join('/usr/share/zoneinfo', self.zone)
-            with open(zone_path, 'rb') as tz_file:
-                self.md5sum = hashlib.md5(tz_file.read()).digest()
-        except IOError:
-            self.md5sum = None
-
+        self.md5sum = get_md5sum(self.zone)
+
+        self._info = None
+        self._offsets = None
+
+    @classmethod
+    def from_cache(cls, entry):
+        """ Creates a location from a cached entry (see get_cache_entry) """
+        location = cls.__new__(cls)
+        (location.country, location.human_country, location.zone,
+         location.comment, location.latitude, location.longitude,
+         location.md5sum) = entry
+        location.human_zone = location.zone.replace('_', ' ').split('/')[-1]
+        location._info = None
+        location._offsets = None
+        return location
+
+    def get_cache_entry(self):
+        """ Returns the location data that is stored in the cache """
+        return (self.country, self.human_country, self.zone, self.comment,
+                self.latitude, self.longitude, self.md5sum)
+
+    @property
+    def info(self):
+        """ System tzinfo of the location zone """
+        if self._info is None:
+            self._info = SystemTzInfo(self.zone)
+        return self._info
+
+    def _get_offsets(self):
+        """ Computes (only once) the current UTC offsets, zone letters
+            and DST flag of the location """
+        if self._offsets is None:
+            if zoneinfo is not None:
+                try:
+                    now = datetime.datetime.now(zoneinfo.ZoneInfo(self.zone))
+                    utc_offset = now.utcoffset()
+                    dst = now.dst() or datetime.timedelta(0)
+                    self._offsets = (
+                        utc_offset,
+                        utc_offset - dst,
+                        now.tzname(),
+                        int(bool(dst)))
+                except (ValueError, OSError, zoneinfo.ZoneInfoNotFoundError) as err:
+                    logging.warning("Cannot read timezone %s: %s", self.zone, err)
+            if self._offsets is None:
+                self._offsets = self._get_system_offsets()
+        return self._offsets
+
+    def _get_system_offsets(self):
+        """ Gets offsets using the system time functions (slow, as
+            they need to change the process timezone) """
         try:
             today = datetime.datetime.today()
         except (ValueError, OverflowError):
@@ -263,11 +325,31 @@ class Location(object):
             # although the UTC offset and zone letters may be wrong.
             today = datetime.datetime.fromtimestamp(0)
 
-        self.info = SystemTzInfo(self.zone)
-        self.utc_offset = self.info.utcoffset(today)
-        self.raw_utc_offset = self.info.rawutcoffset(today)
-        self.zone_letters = self.info.tzname_letters(today)
-        self.isdst = self.info.is_dst(today)
+        return (
+            self.info.utcoffset(today),
+            self.info.rawutcoffset(today),
+            self.info.tzname_letters(today),
+            self.info.is_dst(today))
+
+    @property
+    def utc_offset(self):
+        """ UTC offset (DST included) """
+        return self._get_offsets()[0]
+
+    @property
+    def raw_utc_offset(self):
+        """ UTC offset (DST not included) """
+        return self._get_offsets()[1]
+
+    @property
+    def zone_letters(self):
+        """ Zone abbreviation (CET, PST...) """
+        return self._get_offsets()[2]
+
+    @property
+    def isdst(self):
+        """ 1 if the zone is in DST now """
+        return self._get_offsets()[3]
 
     def get_property(self, prop):
         """ Get object property (see above) """
@@ -278,16 +360,65 @@ class Location(object):
         setattr(self, prop, value)
 
 
+def get_md5sum(zone):
+    """ Returns md5sum of the zone timezone file (None if not found) """
+    try:
+        zone_path = os.path.join(ZONEINFO_PATH, zone)
+        with open(zone_path, 'rb') as tz_file:
+            return hashlib.md5(tz_file.read()).digest()
+    except IOError:
+        return None
+
+
+def get_cache_key():
+    """ Returns a key that changes when tzdata or iso-codes change """
+    key = hashlib.sha256(str(TZ_CACHE_VERSION).encode())
+    try:
+        with open(TZ_VERSION_FILE, 'rb') as version_file:
+            # First line is "# version 2016j"
+            key.update(version_file.readline())
+    except IOError:
+        pass
+    for path in (TZ_DATA_FILE, ISO_3166_FILE):
+        with open(path, 'rb') as data_file:
+            key.update(data_file.read())
+    return key.hexdigest()
+
+
+def load_cached_locations(key, cache_path=TZ_CACHE_PATH):
+    """ Returns cached locations (None if there is no valid cache) """
+    entries = cache.load(cache_path, key)
+    if entries is None:
+        return None
+    return [Location.from_cache(entry) for entry in entries]
+
+
+def save_cached_locations(key, locations, cache_path=TZ_CACHE_PATH):
+    """ Stores locations in cache """
+    entries = [loc.get_cache_entry() for loc in locations]
+    cache.save(cache_path, key, entries)
+
+
+def read_locations():
+    """ Reads locations from TZ_DATA_FILE """
+    locations = []
+    iso3166 = Iso3166()
+    with open(TZ_DATA_FILE) as tzdata:
+        for line in tzdata:
+            if line.startswith('#'):
+                continue
+            locations.append(Location(line, iso3166))
+    return locations
+
+
 class _Database(object):
     """ Store all ISO 3166 information """
     def __init__(self):
-        self.locations = []
-        iso3166 = Iso3166()
-        with open(TZ_DATA_FILE) as tzdata:
-            for line in tzdata:
-                if line.startswith('#'):
-                    continue
-                self.locations.append(Location(line, iso3166))
+        key = get_cache_key()
+        self.locations = load_cached_locations(key)
+        if self.locations is None:
+            self.locations = read_locations()
+            save_cached_locations(key, self.locations)
 
         # Build mappings from timezone->location and country->locations
         self.cc_to_locs = {}
@@ -309,17 +440,12 @@ class _Database(object):
             # city-zones, like "US/Eastern" or "Mexico/General".  So first,
             # we check if the timezone is known.  If it isn't, we search for
             # one with the same md5sum and make a reference to it
-            try:
-                zone_path = os.path.join('/usr/share/zoneinfo', tz)
-                with open(zone_path, 'rb') as tz_file:
-                    md5sum = hashlib.md5(tz_file.read()).digest()
-
+            md5sum = get_md5sum(tz)
+            if md5sum is not None:
                 for loc in self.locations:
                     if md5sum == loc.md5sum:
                         self.tz_to_loc[tz] = loc
                         return loc
-            except IOError:
-                pass
 
             # If not found, oh well, just warn and move on.
             logging.error('Could not understand timezone %s', tz)
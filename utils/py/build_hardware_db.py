@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  build_hardware_db.py
+#
+#  Copyright © 2013-2016 Antergos
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+""" This script compiles the match tables of all hardware driver modules
+    into data/hardware.db, so Cnchi does not need to import all of them
+    to know which drivers support the user's devices.
+    The pre-commit hook runs it (after bumping Cnchi's version) and so does
+    the run script. Cnchi won't use a database built for another version
+    or for other driver modules """
+
+import os
+import sys
+
+CNCHI_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+sys.path.append(os.path.join(CNCHI_PATH, "cnchi"))
+
+import hardware.hardware as hardware
+
+
+def main():
+    """ Builds hardware database """
+    hardware_path = os.path.join(CNCHI_PATH, "cnchi", "hardware")
+    db_path = os.path.join(CNCHI_PATH, "data", "hardware.db")
+    if len(sys.argv) > 1:
+        db_path = sys.argv[1]
+    hardware.build_database(db_path, hardware_path)
+    print("Hardware database written to", db_path)
+
+
+if __name__ == '__main__':
+    main()